@@ -0,0 +1,465 @@
+import os, re, json
+import sys
+import time
+import random
+import shutil
+import asyncio
+import argparse
+import tempfile
+import subprocess
+import resource
+import tracemalloc
+from types import SimpleNamespace
+
+import bot
+import validator
+import usertable
+from storage import open_storage, atomic_write, SqliteStorage, STAT_FIELDS
+from outbox import Outbox
+
+# ================= BENCHMARK =================
+# Drives the real handlers with fake Update/Context objects and a stub Bot
+# that records sends instead of calling Telegram.
+#
+#   python bench.py --users 100000 --verified 100000 --ops 20000
+#   python bench.py --storage sqlite --mix proof=5,balance=3,start=1,withdraw=1
+#   python bench.py --links [--corpus links.txt]
+#   python bench.py --startup --users 1000000
+
+# Cold start on 1M users (JSON backend: storage open, then the RSS the
+# process settles at) should stay within these, see --startup
+STARTUP_TARGET_S = 1.0
+STARTUP_TARGET_MIB = 150
+# While the user browser / search indexes build after startup, no update
+# may wait longer than this for the event loop, and the RSS once they are
+# built stays within STARTUP_TARGET_MIB
+STALL_TARGET_S = 0.1
+
+# ---- fakes ----
+class StubBot:
+    def __init__(self):
+        self.sent = 0
+
+    async def get_chat_member(self, chat_id, user_id):
+        return SimpleNamespace(status="member")
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent += 1
+
+class StubMessage:
+    def __init__(self, bot_, text):
+        self.bot = bot_
+        self.text = text
+
+    async def reply_text(self, text, **kwargs):
+        self.bot.sent += 1
+
+class StubJobQueue:
+    def run_once(self, callback, when, **kwargs):
+        pass
+
+def make_update(bot_, uid, text):
+    user = SimpleNamespace(
+        id=uid, full_name=f"Bench User {uid}",
+        first_name="Bench", username=f"bench{uid}"
+    )
+    return SimpleNamespace(
+        effective_user=user,
+        effective_chat=SimpleNamespace(id=uid),
+        message=StubMessage(bot_, text),
+        callback_query=None,
+        get_bot=lambda: bot_
+    )
+
+def make_context(bot_, user_data=None):
+    return SimpleNamespace(
+        bot=bot_,
+        user_data=user_data if user_data is not None else {},
+        args=[],
+        job_queue=StubJobQueue()
+    )
+
+# ---- datasets ----
+def vid_for(i):
+    return str(1000000000 + i)
+
+def build_dataset(kind, data_dir, n_users, n_verified):
+    """Write n_users users and n_verified verified IDs straight to disk."""
+    os.makedirs(data_dir, exist_ok=True)
+    if kind == "json":
+        users = ((str(i), f"User {i}", f"user{i}", 100000, i % 7) for i in range(n_users))
+        table = "users-000000000000.dat"
+        atomic_write(f"{data_dir}/{table}", usertable.build(None, list(users), {}, {}))
+        verified = {vid_for(i): 500 for i in range(n_verified)}
+        with open(f"{data_dir}/snapshot.json", "w") as f:
+            json.dump({"seq": 0, "money": "paise", "table": table, "verified": verified}, f)
+        return
+    st = SqliteStorage(f"{data_dir}/bot.db")
+    st.open()
+    with st.tx():
+        st.db.executemany(
+            "INSERT INTO users (uid, name, username, balance, proofs) VALUES (?, ?, ?, ?, ?)",
+            ((str(i), f"User {i}", f"user{i}", 100000, i % 7) for i in range(n_users))
+        )
+        st.db.executemany(
+            "INSERT INTO verified (vid, amount) VALUES (?, ?)",
+            ((vid_for(i), 500) for i in range(n_verified))
+        )
+    st.reconcile()
+    st.close()
+
+# ---- workload ----
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        name, weight = part.split("=")
+        mix[name.strip()] = float(weight)
+    return mix
+
+class Workload:
+    def __init__(self, bot_, n_users, n_verified, seed):
+        self.bot = bot_
+        self.n_users = n_users
+        self.n_verified = n_verified
+        self.rng = random.Random(seed)
+        self.next_new = n_users
+
+    def existing(self):
+        return self.rng.randrange(self.n_users)
+
+    def op_start(self):
+        # One in four starts comes from a new user
+        if self.rng.random() < 0.25:
+            uid = self.next_new
+            self.next_new += 1
+        else:
+            uid = self.existing()
+        return bot.start(make_update(self.bot, uid, "/start"), make_context(self.bot))
+
+    def op_balance(self):
+        uid = self.existing()
+        return bot.balance(make_update(self.bot, uid, "💰 Balance"), make_context(self.bot))
+
+    def op_proof(self):
+        uid = self.existing()
+        # Half the links carry a (possibly already used) verified ID
+        if self.rng.random() < 0.5:
+            ref = vid_for(self.rng.randrange(self.n_verified))
+        else:
+            ref = str(self.rng.randrange(10 ** 9, 10 ** 10))
+        link = f"https://t.me/SomeBot?start={ref}"
+        return bot.proof_link(make_update(self.bot, uid, link), make_context(self.bot))
+
+    def op_history(self):
+        uid = self.existing()
+        return bot.history(make_update(self.bot, uid, "📜 History"), make_context(self.bot))
+
+    def op_withdraw(self):
+        uid = self.existing()
+        ctx = make_context(self.bot, {"method": "UPI", "detail": "bench@upi"})
+        return bot.wd_amount(make_update(self.bot, uid, "5"), ctx)
+
+    def pick(self, names, weights):
+        return self.rng.choices(names, weights)[0]
+
+def percentile(sorted_ns, p):
+    if not sorted_ns:
+        return 0
+    k = min(int(len(sorted_ns) * p / 100), len(sorted_ns) - 1)
+    return sorted_ns[k]
+
+def fmt_ms(ns):
+    return f"{ns / 1e6:8.3f}"
+
+def peak_rss_mib():
+    try:
+        # ru_maxrss survives exec, so a child of a big process reads its
+        # parent's peak; VmHWM starts over
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        rss //= 1024
+    return rss / 1024
+
+def rss_mib():
+    """Current RSS; the peak where /proc is not available."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return peak_rss_mib()
+
+async def longest_stall(out):
+    """Keep out[0] at the longest the event loop went without a turn, until cancelled."""
+    last = time.perf_counter()
+    while True:
+        await asyncio.sleep(0.001)
+        now = time.perf_counter()
+        out[0] = max(out[0], now - last - 0.001)
+        last = now
+
+async def run(args):
+    data_dir = args.data or tempfile.mkdtemp(prefix="bench-")
+    print(f"📦 Building dataset: {args.users} users, {args.verified} verified IDs ({args.storage})")
+    t0 = time.perf_counter()
+    build_dataset(args.storage, data_dir, args.users, args.verified)
+    print(f"   built in {time.perf_counter() - t0:.2f}s at {data_dir}")
+
+    if args.trace_memory:
+        tracemalloc.start()
+
+    t0 = time.perf_counter()
+    bot.storage = open_storage(args.storage, data_dir)
+    load_s = time.perf_counter() - t0
+    stub = StubBot()
+    bot.outbox = Outbox(f"{data_dir}/outbox.db")
+    bot.outbox.open(stub)
+
+    work = Workload(stub, args.users, args.verified, args.seed)
+    mix = parse_mix(args.mix)
+    names = list(mix)
+    weights = [mix[n] for n in names]
+    ops = {n: getattr(work, f"op_{n}") for n in names}
+    timings = {n: [] for n in names}
+
+    clock = time.perf_counter_ns
+    started = clock()
+    for _ in range(args.ops):
+        name = work.pick(names, weights)
+        t = clock()
+        await ops[name]()
+        timings[name].append(clock() - t)
+    elapsed = (clock() - started) / 1e9
+
+    flush_t = clock()
+    await bot.storage.flush()
+    flush_ms = (clock() - flush_t) / 1e6
+
+    print(f"\n⏱  Storage open: {load_s:.3f}s   final flush: {flush_ms:.1f}ms")
+    print(f"{'handler':<10}{'count':>8}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for name in names:
+        ns = sorted(timings[name])
+        if ns:
+            print(f"{name:<10}{len(ns):>8}{fmt_ms(percentile(ns, 50)):>10}"
+                  f"{fmt_ms(percentile(ns, 99)):>10}{fmt_ms(ns[-1]):>10}")
+    print(f"\n🚀 Throughput: {args.ops / elapsed:,.0f} updates/s over {elapsed:.2f}s")
+    print("📊 Totals: " + ", ".join(
+        f"{f}={v}" for f, v in zip(STAT_FIELDS, bot.storage.totals())
+    ))
+    if args.trace_memory:
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"🧠 Peak traced memory: {peak / 2 ** 20:.1f} MiB")
+    print(f"🧠 Peak RSS: {peak_rss_mib():.1f} MiB")
+
+    await bot.outbox.close()
+    bot.storage.close()
+    if not args.data and not args.keep:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+# ---- cold start ----
+def open_only(args):
+    """In a fresh process: what a restart on args.data costs. Prints JSON."""
+    result = {"base_mib": peak_rss_mib()}
+    t0 = time.perf_counter()
+    st = open_storage(args.storage, args.data)
+    result["open_s"] = time.perf_counter() - t0
+    result["open_mib"] = peak_rss_mib()
+    rng = random.Random(args.seed)
+    t = time.perf_counter_ns()
+    for _ in range(1000):
+        st.get_user(str(rng.randrange(args.users)))
+    result["lookup_us"] = (time.perf_counter_ns() - t) / 1000 / 1000
+    asyncio.run(first_queries(args, st, result))
+    st.close()
+    print(json.dumps(result))
+
+async def first_queries(args, st, result):
+    """
+    What the bot does after a restart: start building the indexes, with an
+    admin browsing by balance and searching straight away.
+    """
+    stall = [0.0]
+    watcher = asyncio.create_task(longest_stall(stall))
+    t0 = time.perf_counter()
+    build = asyncio.create_task(st.prepare_indexes())
+    await st.prepare_indexes()
+    st.browse_users("balance", 10)
+    result["browse_s"] = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    await st.prepare_indexes()
+    st.search_users(f"user{args.users // 2}", 10)
+    result["find_s"] = time.perf_counter() - t0
+    await build
+    watcher.cancel()
+    result["stall_s"] = stall[0]
+    result["index_mib"] = rss_mib()
+    result["index_peak_mib"] = peak_rss_mib()
+
+def run_startup(args):
+    data_dir = args.data or tempfile.mkdtemp(prefix="bench-")
+    print(f"📦 Building dataset: {args.users} users, {args.verified} verified IDs ({args.storage})")
+    t0 = time.perf_counter()
+    build_dataset(args.storage, data_dir, args.users, args.verified)
+    print(f"   built in {time.perf_counter() - t0:.2f}s at {data_dir}")
+    out = subprocess.run(
+        [sys.executable, __file__, "--open-only", "--storage", args.storage,
+         "--data", data_dir, "--users", str(args.users), "--seed", str(args.seed)],
+        capture_output=True, text=True, check=True
+    )
+    r = json.loads(out.stdout.splitlines()[-1])
+    print(f"\n⏱  Storage open: {r['open_s']:.3f}s (target {STARTUP_TARGET_S}s at 1M users)")
+    print(f"🧠 RSS: {r['base_mib']:.1f} MiB after imports, {r['open_mib']:.1f} MiB once open "
+          f"(target {STARTUP_TARGET_MIB} MiB at 1M users)")
+    print(f"🔎 get_user on a cold user: {r['lookup_us']:.1f}µs")
+    print(f"📋 First browse by balance: {r['browse_s']:.2f}s (waits for the index build), "
+          f"then /find: {r['find_s'] * 1000:.1f}ms")
+    print(f"⏳ Longest event-loop stall meanwhile: {r['stall_s'] * 1000:.1f}ms "
+          f"(target {STALL_TARGET_S * 1000:.0f}ms)")
+    print(f"🧠 RSS with the indexes: {r['index_mib']:.1f} MiB (peak {r['index_peak_mib']:.1f} MiB)")
+    ok = r["open_s"] <= STARTUP_TARGET_S and r["open_mib"] <= STARTUP_TARGET_MIB
+    print(f"{'✅' if ok else '❌'} Cold start {'within' if ok else 'over'} target")
+    ok = r["stall_s"] <= STALL_TARGET_S and r["index_mib"] <= STARTUP_TARGET_MIB
+    print(f"{'✅' if ok else '❌'} Index build {'within' if ok else 'over'} target")
+    if not args.data and not args.keep:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+# ---- link validator ----
+def legacy_is_valid_url(url):
+    """The validator proof_link used before validator.py, for comparison."""
+    url = url.strip()
+    for pattern in (r'^https?://', r'^www\.', r'^[a-zA-Z0-9]+://'):
+        if re.search(pattern, url, re.IGNORECASE):
+            return True
+    referral_patterns = [
+        r'^[a-zA-Z0-9]{8,}$',
+        r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$',
+        r'^[a-zA-Z0-9]+=[a-zA-Z0-9]+',
+        r'^ref/[a-zA-Z0-9]+',
+        r'^invite/[a-zA-Z0-9]+',
+        r'^[a-zA-Z0-9]{5,}/[a-zA-Z0-9]{5,}',
+    ]
+    for pattern in referral_patterns:
+        if re.fullmatch(pattern, url, re.IGNORECASE):
+            return True
+    for word in ['.com', '.in', '.org', '.net', '.co', '.io', '.me', '.app']:
+        if word in url.lower():
+            return True
+    return False
+
+def legacy_proof_scan(link):
+    """The legacy check plus the digit scan find_verified used to do itself."""
+    return legacy_is_valid_url(link), validator.DIGIT_RUN.findall(link)
+
+# Shapes seen in proof submissions; {n} is a numeric referral id
+LINK_SHAPES = [
+    "https://t.me/SomeBot?start={n}",
+    "https://t.me/SomeBot?start=ref_{n}",
+    "t.me/SomeBot?start={n}",
+    "tg://resolve?domain=SomeBot&start={n}",
+    "https://telegram.me/EarnBot?start={n}&utm_source=share",
+    "http://www.example.com/invite?code={n}",
+    "https://play.google.com/store/apps/details?id=com.example.app&referrer=ref%3D{n}",
+    "https://app.example.in/r/{n}",
+    "www.rewards.co/signup?ref={n}",
+    "https://example.app/join/{n}#top",
+    "ref/{n}",
+    "invite/{n}",
+    "code={n}",
+    "{n}",
+    "EARN{n}",
+    "Abcde/{n}",
+    "user{n}@mail.com",
+    "my code is {n} pls check",
+    "done ✅",
+    "sent the link above",
+    "",
+]
+
+def link_corpus(n, rng):
+    return [
+        rng.choice(LINK_SHAPES).format(n=rng.randrange(10 ** 9, 10 ** 10))
+        for _ in range(n)
+    ]
+
+def time_per_link(fn, links, rounds=5):
+    """Best-of-rounds mean nanoseconds per call."""
+    best = None
+    for _ in range(rounds):
+        t = time.perf_counter_ns()
+        for link in links:
+            fn(link)
+        ns = (time.perf_counter_ns() - t) / len(links)
+        best = ns if best is None else min(best, ns)
+    return best
+
+def run_links(args):
+    if args.corpus:
+        with open(args.corpus, encoding="utf-8") as f:
+            links = [line.rstrip("\n") for line in f]
+    else:
+        links = link_corpus(args.ops, random.Random(args.seed))
+    print(f"🔗 {len(links)} links ({args.corpus or 'synthetic corpus'})")
+    kinds = {}
+    mismatches = []
+    for link in links:
+        res = validator.check(link)
+        kinds[res.kind or res.reason] = kinds.get(res.kind or res.reason, 0) + 1
+        if (res.reason is None) != legacy_is_valid_url(link):
+            mismatches.append(link)
+    rows = [
+        ("legacy is_valid_url", time_per_link(legacy_is_valid_url, links)),
+        ("legacy + digit scan", time_per_link(legacy_proof_scan, links)),
+        ("validator.check", time_per_link(validator.check, links)),
+    ]
+    print(f"{'validator':<22}{'ns/link':>10}{'links/s':>14}")
+    for name, ns in rows:
+        print(f"{name:<22}{ns:>10,.0f}{1e9 / ns:>14,.0f}")
+    # validator.check does both jobs of the old proof path
+    print(f"\n⚡ Speedup over legacy + digit scan: {rows[1][1] / rows[2][1]:.1f}x")
+    print("📊 Kinds: " + ", ".join(f"{k}={v}" for k, v in sorted(kinds.items())))
+    print(f"{'✅' if not mismatches else '❌'} Disagreements with the legacy function: {len(mismatches)}")
+    for link in mismatches[:10]:
+        print(f"   {link!r}")
+
+def main():
+    p = argparse.ArgumentParser(description="Benchmark the bot handlers on synthetic data")
+    p.add_argument("--storage", choices=("json", "sqlite"), default="json")
+    p.add_argument("--users", type=int, default=10000)
+    p.add_argument("--verified", type=int, default=10000)
+    p.add_argument("--ops", type=int, default=10000)
+    p.add_argument("--mix", default="proof=4,balance=3,start=2,withdraw=1",
+                   help="handler=weight,... from start, balance, proof, withdraw, history")
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--data", help="data directory to use (default: a temp dir)")
+    p.add_argument("--keep", action="store_true", help="keep the temp data directory")
+    p.add_argument("--trace-memory", action="store_true",
+                   help="track peak Python allocations (slows the run)")
+    p.add_argument("--links", action="store_true",
+                   help="benchmark the link validator on --ops synthetic links instead")
+    p.add_argument("--corpus", help="with --links: file of real links, one per line")
+    p.add_argument("--startup", action="store_true",
+                   help="measure a cold start (storage open, RSS) in a fresh process instead")
+    p.add_argument("--open-only", action="store_true",
+                   help="used by --startup: time opening the existing --data directory")
+    args = p.parse_args()
+    if args.open_only:
+        open_only(args)
+    elif args.startup:
+        run_startup(args)
+    elif args.links or args.corpus:
+        run_links(args)
+    else:
+        asyncio.run(run(args))
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,13 @@
 
-import os, json
-import threading
+import io
+import os
 import re
+import csv
+import time
+import random
+import asyncio
+from contextlib import asynccontextmanager
+from collections import OrderedDict
 from telegram import (
     Update, ReplyKeyboardMarkup,
     InlineKeyboardMarkup, InlineKeyboardButton
@@ -9,21 +15,138 @@ from telegram import (
 from telegram.ext import (
     ApplicationBuilder, CommandHandler,
     MessageHandler, ConversationHandler,
-    CallbackQueryHandler, ContextTypes, filters
+    CallbackQueryHandler, ChatMemberHandler,
+    BaseUpdateProcessor, ContextTypes, filters
 )
+from telegram.error import BadRequest
+from storage import (
+    open_storage, checkpoint, browse_cursor,
+    MAIN, PROOF, WITHDRAW, REFUND, ADMIN_ADD, ADMIN_REMOVE, PAID
+)
+from outbox import Outbox
+from broadcast import Broadcaster
+from persistence import SqlitePersistence
+from precheck import Precheck
+import validator
+import metrics
+import money
 
 # ================= CONFIG =================
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 ADMIN_ID = int(os.getenv("ADMIN_ID", "0"))
 FORCE_JOIN_CHANNEL = "@TaskByZahid"
 
+# force_join results are cached per user: members for JOIN_TTL seconds,
+# non-members for JOIN_NEG_TTL, at most JOIN_CACHE_SIZE users (LRU)
+JOIN_TTL = int(os.getenv("JOIN_TTL", "600"))
+JOIN_NEG_TTL = int(os.getenv("JOIN_NEG_TTL", "30"))
+JOIN_CACHE_SIZE = int(os.getenv("JOIN_CACHE_SIZE", "50000"))
+# Admin panels are rendered once per version of the data they show and
+# served from memory until it changes, at most RENDER_CACHE_SIZE (LRU)
+RENDER_CACHE_SIZE = int(os.getenv("RENDER_CACHE_SIZE", "1024"))
+
+# Webhook mode is used when WEBHOOK_URL (public https base URL) is set,
+# otherwise the bot long-polls. Set WEBHOOK_LISTEN=127.0.0.1 when a local
+# reverse proxy terminates TLS and forwards WEBHOOK_PATH to WEBHOOK_PORT.
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or None
+
+# Only the update types the handlers in main() consume
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY, Update.CHAT_MEMBER]
+
+# Updates from different users are handled in parallel, up to this many
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "64"))
+
 DATA = "data"
-USERS = f"{DATA}/users.json"
-VERIFIED = f"{DATA}/verified.json"  # Now stores as {"user_id": amount}
-os.makedirs(DATA, exist_ok=True)
+# "json" keeps data/users.json + data/verified.json, "sqlite" uses data/bot.db
+STORAGE = os.getenv("STORAGE", "json")
+
+# json backend: ledger appends are fsynced every FLUSH_INTERVAL seconds,
+# or sooner once FLUSH_BATCH records have piled up; a full snapshot is
+# written every SNAPSHOT_INTERVAL seconds
+FLUSH_INTERVAL = int(os.getenv("FLUSH_INTERVAL", "10"))
+FLUSH_BATCH = int(os.getenv("FLUSH_BATCH", "200"))
+SNAPSHOT_INTERVAL = int(os.getenv("SNAPSHOT_INTERVAL", "600"))
+# How often the running statistics are recounted from the data
+RECONCILE_INTERVAL = int(os.getenv("RECONCILE_INTERVAL", "3600"))
+
+# Proof submissions per user: up to PROOF_BURST at once, refilled at
+# PROOF_RATE per minute. The same link is refused for PROOF_DUP_TTL seconds
+# after it earned a credit and PROOF_RETRY_TTL seconds after a rejection
+PROOF_RATE = float(os.getenv("PROOF_RATE", "6"))
+PROOF_BURST = int(os.getenv("PROOF_BURST", "3"))
+PROOF_DUP_TTL = int(os.getenv("PROOF_DUP_TTL", "86400"))
+PROOF_RETRY_TTL = int(os.getenv("PROOF_RETRY_TTL", "300"))
+
+# Conversation states and user_data are saved to data/state.db every
+# PERSIST_INTERVAL seconds (and on shutdown), only what changed
+PERSIST_INTERVAL = int(os.getenv("PERSIST_INTERVAL", "30"))
+
+# Outgoing notifications: per-chat and global send rates (messages/sec)
+# and how many sends may be in flight at once
+OUTBOX_CHAT_RATE = float(os.getenv("OUTBOX_CHAT_RATE", "1"))
+OUTBOX_GLOBAL_RATE = float(os.getenv("OUTBOX_GLOBAL_RATE", "25"))
+OUTBOX_CONCURRENCY = int(os.getenv("OUTBOX_CONCURRENCY", "8"))
+# When > 0, "New Proof" notices reach the admin as one summary message
+# every PROOF_DIGEST_INTERVAL seconds instead of one message each
+PROOF_DIGEST_INTERVAL = int(os.getenv("PROOF_DIGEST_INTERVAL", "0"))
+# A broadcast keeps at most this many of its messages in the outbox, so
+# other notifications wait behind no more than BROADCAST_WINDOW sends
+BROADCAST_WINDOW = int(os.getenv("BROADCAST_WINDOW", "50"))
+
+# Verified IDs from an admin upload are written VER_BATCH at a time
+VER_BATCH = int(os.getenv("VER_BATCH", "5000"))
+
+# Maintenance jobs wait their interval plus a random delay of up to their
+# jitter before each run; an interval of 0 turns a job off.
+# Backups of users and verified IDs go to data/backups, newest BACKUP_KEEP
+# kept (0 keeps all)
+BACKUP_INTERVAL = int(os.getenv("BACKUP_INTERVAL", "86400"))
+BACKUP_JITTER = int(os.getenv("BACKUP_JITTER", "3600"))
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", "7"))
+# Verified IDs are removed once their campaign's ttl runs out, and in any
+# campaign once VERIFIED_MAX_AGE seconds old (0: no overall limit)
+VERIFIED_MAX_AGE = int(os.getenv("VERIFIED_MAX_AGE", "0"))
+EXPIRE_INTERVAL = int(os.getenv("EXPIRE_INTERVAL", "3600"))
+EXPIRE_JITTER = int(os.getenv("EXPIRE_JITTER", "300"))
+# Conversations, user_data and uploads untouched for STATE_MAX_AGE seconds
+# are deleted
+STATE_MAX_AGE = int(os.getenv("STATE_MAX_AGE", "604800"))
+PURGE_INTERVAL = int(os.getenv("PURGE_INTERVAL", "3600"))
+PURGE_JITTER = int(os.getenv("PURGE_JITTER", "300"))
+# SQLite write-ahead logs are folded back and truncated
+COMPACT_INTERVAL = int(os.getenv("COMPACT_INTERVAL", "21600"))
+COMPACT_JITTER = int(os.getenv("COMPACT_JITTER", "1800"))
+
+# Several bot processes can share one data directory (STORAGE=sqlite only).
+# Worker i serves webhooks on 127.0.0.1:WORKER_PORT_BASE+i behind
+# router.py, which sends all updates of a user to the same worker.
+# Worker 0 also delivers the shared outbox and runs the periodic jobs.
+WORKERS = int(os.getenv("WORKERS", "1"))
+WORKER_ID = int(os.getenv("WORKER_ID", "0"))
+WORKER_PORT_BASE = int(os.getenv("WORKER_PORT_BASE", "8450"))
 
-# Thread lock for file operations
-file_lock = threading.Lock()
+# Prometheus-style /metrics endpoint; METRICS_PORT=0 turns it off
+# (each worker uses METRICS_PORT + WORKER_ID)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+
+# Storage calls that get their own latency series
+TIMED_STORAGE_OPS = (
+    "get_user", "ensure_user", "adjust_balance", "find_verified",
+    "consume_verified_id", "add_verified", "totals",
+    "browse_users", "search_users", "request_withdrawal",
+    "resolve_withdrawals", "pending_withdrawals", "history"
+)
+
+# Opened in on_startup
+storage = None
+outbox = None
+broadcaster = None
+metrics_server = None
 
 # ================= STATES =================
 (
@@ -31,93 +154,213 @@ file_lock = threading.Lock()
     WD_METHOD, WD_DETAIL, WD_AMOUNT,
     ADD_BAL_USER, ADD_BAL_AMOUNT,
     REM_BAL_USER, REM_BAL_AMOUNT,
-    ADD_VER_IDS, VER_AMOUNT
-) = range(10)
+    ADD_VER_IDS, VER_AMOUNT,
+    BC_TEXT, BC_CONFIRM,
+    VER_CONFIRM
+) = range(13)
 
 # ================= UTILS =================
-def load(p, d):
-    with file_lock:
-        if not os.path.exists(p):
-            with open(p, "w") as f: 
-                json.dump(d, f)
-        with open(p) as f: 
-            return json.load(f)
-
-def save(p, d):
-    with file_lock:
-        with open(p, "w") as f: 
-            json.dump(d, f, indent=2)
-
 def menu():
     return ReplyKeyboardMarkup(
         [["📤 Submit Proof"],
          ["💰 Balance", "💸 Withdraw"],
-         ["🆘 Support"]],
+         ["📜 History", "🆘 Support"]],
         resize_keyboard=True
     )
 
+async def expired(update, context, *keys):
+    """
+    True, after telling the user, if user_data lacks a key this step needs:
+    the conversation sat idle until purge_job dropped its user_data.
+    """
+    if all(key in context.user_data for key in keys):
+        return False
+    await update.effective_message.reply_text(
+        "⌛ This request expired. Please start again.", reply_markup=menu()
+    )
+    context.user_data.clear()
+    return True
+
 def admin_menu():
     return ReplyKeyboardMarkup(
         [["➕ Add Balance", "➖ Remove Balance"],
-         ["📋 Add Verified IDs"],
+         ["📋 Add Verified IDs", "🎯 Campaigns"],
          ["👥 Total Users", "📊 User Details"],
+         ["💸 Pending Withdrawals", "📢 Broadcast"],
          ["🏠 Main Menu"]],
         resize_keyboard=True
     )
 
+class MembershipCache:
+    """LRU of user id -> (is_member, expires_at)."""
+    def __init__(self, ttl, neg_ttl, size):
+        self.ttl = ttl
+        self.neg_ttl = neg_ttl
+        self.size = size
+        self.entries = OrderedDict()
+
+    def get(self, uid):
+        entry = self.entries.get(uid)
+        if entry is None:
+            return None
+        if entry[1] < time.monotonic():
+            del self.entries[uid]
+            return None
+        self.entries.move_to_end(uid)
+        return entry[0]
+
+    def put(self, uid, is_member):
+        ttl = self.ttl if is_member else self.neg_ttl
+        self.entries[uid] = (is_member, time.monotonic() + ttl)
+        self.entries.move_to_end(uid)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, uid):
+        self.entries.pop(uid, None)
+
+join_cache = MembershipCache(JOIN_TTL, JOIN_NEG_TTL, JOIN_CACHE_SIZE)
+
+class RenderCache:
+    """LRU of (panel, ...) key -> (storage.version(data), rendered panel)."""
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+
+    def get(self, key, data, render):
+        """The cached panel while `data` is unchanged, else render()'s."""
+        version = storage.version(data)
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] == version:
+            self.entries.move_to_end(key)
+            metrics.inc("render_cache_total", panel=key[0], result="hit")
+            return entry[1]
+        metrics.inc("render_cache_total", panel=key[0], result="miss")
+        panel = render()
+        self.entries[key] = (version, panel)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+        return panel
+
+render_cache = RenderCache(RENDER_CACHE_SIZE)
+
+MEMBER_STATUSES = ("member", "administrator", "creator")
+
 async def force_join(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    uid = update.effective_user.id
+    cached = join_cache.get(uid)
+    if cached is not None:
+        metrics.inc("join_cache_total", result="hit")
+        return cached
+    metrics.inc("join_cache_total", result="miss")
+    start = time.perf_counter()
     try:
         chat_member = await context.bot.get_chat_member(
             FORCE_JOIN_CHANNEL, 
-            update.effective_user.id
+            uid
         )
-        return chat_member.status in ("member", "administrator", "creator")
     except:
+        # API errors are not cached; the next press asks again
+        metrics.observe("force_join_api_seconds", time.perf_counter() - start, result="error")
         return False
+    metrics.observe("force_join_api_seconds", time.perf_counter() - start, result="ok")
+    joined = chat_member.status in MEMBER_STATUSES
+    join_cache.put(uid, joined)
+    return joined
+
+async def channel_member_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Keep join_cache fresh from chat_member updates (bot must be channel admin)."""
+    change = update.chat_member
+    if f"@{change.chat.username}".lower() != FORCE_JOIN_CHANNEL.lower():
+        return
+    member = change.new_chat_member
+    join_cache.put(member.user.id, member.status in MEMBER_STATUSES)
 
 def is_admin(user_id):
     return user_id == ADMIN_ID
 
-def is_valid_url(url):
-    """
-    Check if the input is a valid URL.
-    Supports http, https, and common app referral links.
-    """
-    url = url.strip()
-    
-    # Common URL patterns
-    url_patterns = [
-        r'^https?://',  # http:// or https://
-        r'^www\.',      # www.domain.com
-        r'^[a-zA-Z0-9]+://',  # protocol://
-    ]
-    
-    # Check if it matches any URL pattern
-    for pattern in url_patterns:
-        if re.search(pattern, url, re.IGNORECASE):
-            return True
-    
-    # Check for common referral link patterns
-    referral_patterns = [
-        r'^[a-zA-Z0-9]{8,}$',  # Short codes (at least 8 chars)
-        r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$',  # Email format
-        r'^[a-zA-Z0-9]+=[a-zA-Z0-9]+',  # key=value format
-        r'^ref/[a-zA-Z0-9]+',  # ref/CODE format
-        r'^invite/[a-zA-Z0-9]+',  # invite/CODE format
-        r'^[a-zA-Z0-9]{5,}/[a-zA-Z0-9]{5,}',  # code1/code2 format
-    ]
-    
-    for pattern in referral_patterns:
-        if re.fullmatch(pattern, url, re.IGNORECASE):
-            return True
-    
-    # Check if it contains common domain words (for user-friendly messages)
-    domain_words = ['.com', '.in', '.org', '.net', '.co', '.io', '.me', '.app']
-    for word in domain_words:
-        if word in url.lower():
-            return True
-    
-    return False
+# ================= CONCURRENCY =================
+class KeyedLocks:
+    """One asyncio.Lock per key, dropped again once nobody holds or waits on it."""
+    def __init__(self):
+        self.locks = {}  # key -> [lock, users]
+
+    @asynccontextmanager
+    async def __call__(self, key):
+        entry = self.locks.get(key)
+        if entry is None:
+            entry = self.locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self.locks[key]
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Process updates concurrently, but strictly in order for each user."""
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        self.user_locks = KeyedLocks()
+
+    async def process_update(self, update, coroutine):
+        # The user's lock is taken before a concurrency slot, so a user's
+        # queued updates wait outside the semaphore and one user holds at
+        # most one slot (process_update is final only to type checkers)
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is None:
+            await super().process_update(update, coroutine)
+            return
+        async with self.user_locks(user.id):
+            await super().process_update(update, coroutine)
+
+    async def do_process_update(self, update, coroutine):
+        await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+# ================= STORE =================
+flush_scheduled = False
+
+def after_write(context):
+    """Bring the next flush forward once the backend has enough buffered."""
+    global flush_scheduled
+    if storage.flush_due() and not flush_scheduled:
+        flush_scheduled = True
+        context.job_queue.run_once(flush_job, 0)
+
+async def flush_job(context: ContextTypes.DEFAULT_TYPE):
+    global flush_scheduled
+    flush_scheduled = False
+    start = time.perf_counter()
+    await storage.flush()
+    metrics.observe("storage_seconds", time.perf_counter() - start, op="flush")
+
+async def index_job(context: ContextTypes.DEFAULT_TYPE):
+    """Build the user browser / search indexes off the event loop after startup."""
+    start = time.perf_counter()
+    await storage.prepare_indexes()
+    metrics.observe("storage_seconds", time.perf_counter() - start, op="index")
+
+async def snapshot_job(context: ContextTypes.DEFAULT_TYPE):
+    start = time.perf_counter()
+    await storage.snapshot()
+    metrics.observe("storage_seconds", time.perf_counter() - start, op="snapshot")
+
+async def reconcile_job(context: ContextTypes.DEFAULT_TYPE):
+    drifted = storage.reconcile()
+    if drifted:
+        print(f"Stats drift corrected: {drifted}")
+
+async def digest_job(context: ContextTypes.DEFAULT_TYPE):
+    outbox.digest_flush("📥 New Proofs")
 
 # ================= START =================
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -132,16 +375,18 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    users = load(USERS, {})
     uid = str(update.effective_user.id)
-    if uid not in users:
-        users[uid] = {
-            "balance": 0, 
-            "proofs": 0, 
-            "name": update.effective_user.full_name,
-            "username": update.effective_user.username
-        }
-    save(USERS, users)
+    _, created = storage.ensure_user(
+        uid,
+        update.effective_user.full_name,
+        update.effective_user.username
+    )
+    if created:
+        after_write(context)
+    elif storage.is_blocked(uid):
+        # Back after blocking the bot, so broadcasts reach them again
+        storage.set_blocked(uid, False)
+        after_write(context)
 
     await update.message.reply_text(
         f"👋 Welcome {update.effective_user.first_name}!\n"
@@ -153,6 +398,8 @@ async def check_join_callback(update: Update, context: ContextTypes.DEFAULT_TYPE
     query = update.callback_query
     await query.answer()
     
+    # The user says they just joined, so don't trust a cached "no"
+    join_cache.invalidate(update.effective_user.id)
     if not await force_join(update, context):
         await query.edit_message_text("❌ Still not in channel. Join and try /start")
         return
@@ -165,25 +412,89 @@ async def balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Join channel first using /start")
         return
     
-    users = load(USERS, {})
-    uid = str(update.effective_user.id)
+    user = storage.get_user(str(update.effective_user.id))
     
-    if uid not in users:
+    if user is None:
         await update.message.reply_text("❌ User not found. Use /start")
         return
     
-    bal = users[uid]["balance"]
-    proofs = users[uid]["proofs"]
+    bal = user["balance"]
+    proofs = user["proofs"]
     await update.message.reply_text(
-        f"💰 Balance: ₹{bal}\n"
+        f"💰 Balance: ₹{money.fmt(bal)}\n"
         f"📊 Proofs Submitted: {proofs}"
     )
 
+# ================= HISTORY =================
+HISTORY_SIZE = 10
+HISTORY_MAX = 50
+
+EVENT_LABELS = {
+    PROOF: "✅ Proof",
+    WITHDRAW: "💸 Withdrawal",
+    REFUND: "↩️ Refund",
+    PAID: "🏦 Paid out",
+    ADMIN_ADD: "➕ Added by admin",
+    ADMIN_REMOVE: "➖ Removed by admin"
+}
+
+def render_history(title, events):
+    msg = f"{title}\n━━━━━━━━━━━━━━\n\n"
+    for e in events:
+        line = time.strftime("%d %b %y %H:%M", time.gmtime(e["ts"]))
+        line += f" • {EVENT_LABELS.get(e['kind'], e['kind'])}"
+        if e["amount"]:
+            sign = "+" if e["amount"] > 0 else "-"
+            line += f" {sign}₹{money.fmt(abs(e['amount']))}"
+        if e["ref"] is not None:
+            line += f" • ID {e['ref']}" if e["kind"] == PROOF else f" • #{e['ref']}"
+        msg += line + "\n"
+    return msg + "\n🕒 Times are UTC"
+
+async def history(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await force_join(update, context):
+        await update.message.reply_text("❌ Join channel first using /start")
+        return
+    
+    events = storage.history(str(update.effective_user.id), HISTORY_SIZE)
+    if not events:
+        await update.message.reply_text("📜 No transactions yet")
+        return
+    
+    await update.message.reply_text(render_history("📜 RECENT TRANSACTIONS", events))
+
+async def user_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update.effective_user.id):
+        return
+    
+    try:
+        uid = context.args[0]
+        count = int(context.args[1]) if len(context.args) > 1 else HISTORY_SIZE
+    except (IndexError, ValueError):
+        await update.message.reply_text("📝 Usage: /history <user id> [count]")
+        return
+    
+    user = storage.get_user(uid)
+    if user is None:
+        await update.message.reply_text("❌ User not found")
+        return
+    
+    events = storage.history(uid, max(1, min(count, HISTORY_MAX)))
+    if not events:
+        await update.message.reply_text(f"📜 No transactions for {uid}")
+        return
+    
+    await update.message.reply_text(render_history(
+        f"📜 HISTORY: {user.get('name') or 'Unknown'} ({uid})", events
+    ))
+
 # ================= SUPPORT =================
 async def support(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("🆘 Support: @DTXZAHID")
 
 # ================= SUBMIT PROOF =================
+proof_gate = Precheck(PROOF_RATE / 60, PROOF_BURST, PROOF_DUP_TTL, PROOF_RETRY_TTL)
+
 async def submit_proof(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await force_join(update, context):
         await update.message.reply_text("❌ Join channel first using /start")
@@ -207,7 +518,8 @@ async def proof_link(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = str(update.effective_user.id)
     
     # Validate the link
-    if not is_valid_url(link):
+    checked = validator.check(link)
+    if checked.reason is not None:
         cancel_kb = InlineKeyboardMarkup([
             [InlineKeyboardButton("❌ Cancel", callback_data="cancel_proof")]
         ])
@@ -219,60 +531,60 @@ async def proof_link(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return PROOF_LINK
     
-    # Load all data
-    verified = load(VERIFIED, {})  # Now dictionary: {user_id: amount}
-    users = load(USERS, {})
+    # Floods and repeats are answered from memory, before any storage work
+    key, reason = proof_gate.check(uid, link)
+    metrics.inc("proof_precheck_total", result=reason or "pass")
+    if reason is not None:
+        if reason == "rate":
+            msg = f"⏳ Too many submissions. Try again in {int(proof_gate.retry_in(uid)) + 1}s."
+        elif reason == "repeat":
+            msg = "⚠️ You already submitted this link."
+        else:
+            msg = "❌ Proof rejected! (Invalid/Fake/Used link)"
+        await update.message.reply_text(msg, reply_markup=menu())
+        return ConversationHandler.END
     
     # Initialize user if not exists
-    if uid not in users:
-        users[uid] = {
-            "balance": 0, 
-            "proofs": 0, 
-            "name": update.effective_user.full_name,
-            "username": update.effective_user.username
-        }
+    user, _ = storage.ensure_user(
+        uid,
+        update.effective_user.full_name,
+        update.effective_user.username
+    )
     
     status = "REJECTED"
     added = 0
-    used_verified_id = None
     
-    # Check if link contains any verified ID
-    for vid, amount in verified.items():
-        if str(vid) in link:
+    # Check if link contains any verified ID, and whose campaign it is
+    found = storage.find_verified(checked.ids) if checked.ids else None
+    campaign = None
+    if found is not None:
+        vid, campaign = found
+        # Credits the user and removes the ID in one step
+        amount = storage.consume_verified_id(vid, uid)
+        if amount is not None:
             status = "VERIFIED"
-            used_verified_id = vid
             added = amount
-            
-            # Add to user's balance
-            users[uid]["balance"] += added
-            users[uid]["proofs"] += 1
-            
-            # Remove used verified ID from dictionary
-            if vid in verified:
-                del verified[vid]
-            break
-    
-    save(USERS, users)
-    save(VERIFIED, verified)
+    proof_gate.record(uid, key, status == "VERIFIED")
+    
+    after_write(context)
     
     # Send to admin
-    try:
-        await context.bot.send_message(
-            ADMIN_ID,
-            f"📥 New Proof\n"
-            f"👤 {users[uid]['name']}\n"
-            f"🆔 {uid}\n"
-            f"✅ {status}\n"
-            f"💰 +₹{added}\n"
-            f"🔗 {link[:100]}{'...' if len(link) > 100 else ''}"
-        )
-    except:
-        pass
+    outbox.send(
+        ADMIN_ID,
+        f"📥 New Proof\n"
+        f"👤 {user['name']}\n"
+        f"🆔 {uid}\n"
+        f"✅ {status}\n"
+        + (f"🎯 {campaign}\n" if status == "VERIFIED" else "")
+        + f"💰 +₹{money.fmt(added)}\n"
+        f"🔗 {link[:100]}{'...' if len(link) > 100 else ''}",
+        digest=PROOF_DIGEST_INTERVAL > 0
+    )
     
     # Respond to user
     if status == "VERIFIED":
         if added > 0:
-            msg = f"✅ Proof verified!\n💰 ₹{added} added to balance."
+            msg = f"✅ Proof verified!\n💰 ₹{money.fmt(added)} added to balance."
         else:
             msg = "✅ Proof verified! Amount was 0."
     else:
@@ -293,15 +605,32 @@ async def cancel_proof_callback(update: Update, context: ContextTypes.DEFAULT_TY
     return ConversationHandler.END
 
 # ================= WITHDRAW =================
+# Minimum withdrawal per method, in paise
+MIN_WITHDRAW = {"UPI": 500, "VSV": 200, "FXL": 500}
+
+def withdraw_panel(uid):
+    """The method prompt for uid, or None if there is nothing to withdraw."""
+    user = storage.get_user(uid)
+    if user is None or user["balance"] <= 0:
+        return None
+    return (
+        f"💸 Choose Withdrawal Method\n\n"
+        f"💰 Your Balance: ₹{money.fmt(user['balance'])}\n\n"
+        f"📋 Minimum Amount:\n"
+        f"• UPI: ₹5\n"
+        f"• VSV (Wallet): ₹2\n"
+        f"• FXL: ₹5"
+    )
+
 async def withdraw(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await force_join(update, context):
         await update.message.reply_text("❌ Join channel first using /start")
         return ConversationHandler.END
     
-    users = load(USERS, {})
     uid = str(update.effective_user.id)
+    text = withdraw_panel(uid)
     
-    if uid not in users or users[uid]["balance"] <= 0:
+    if text is None:
         await update.message.reply_text("❌ Insufficient balance")
         return ConversationHandler.END
     
@@ -314,15 +643,7 @@ async def withdraw(update: Update, context: ContextTypes.DEFAULT_TYPE):
          InlineKeyboardButton("❌ Cancel", callback_data="cancel")]
     ])
     
-    await update.message.reply_text(
-        f"💸 Choose Withdrawal Method\n\n"
-        f"💰 Your Balance: ₹{users[uid]['balance']}\n\n"
-        f"📋 Minimum Amount:\n"
-        f"• UPI: ₹5\n"
-        f"• VSV (Wallet): ₹2\n"
-        f"• FXL: ₹5",
-        reply_markup=kb
-    )
+    await update.message.reply_text(text, reply_markup=kb)
     return WD_METHOD
 
 async def wd_method(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -347,6 +668,9 @@ async def wd_method(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def wd_detail(update: Update, context: ContextTypes.DEFAULT_TYPE):
     detail = update.message.text.strip()
     
+    if await expired(update, context, "method"):
+        return ConversationHandler.END
+    
     # Validate UPI ID format if method is UPI
     if context.user_data["method"] == "UPI":
         # Basic UPI validation (contains @ or .)
@@ -359,87 +683,77 @@ async def wd_detail(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     context.user_data["detail"] = detail
     
-    users = load(USERS, {})
-    uid = str(update.effective_user.id)
-    bal = users[uid]["balance"]
+    bal = storage.get_user(str(update.effective_user.id))["balance"]
     
     method = context.user_data["method"]
-    min_amt = 5.0 if method == "UPI" else (2.0 if method == "VSV" else 5.0)
+    min_amt = MIN_WITHDRAW[method]
     
     await update.message.reply_text(
         f"💵 Enter withdrawal amount\n\n"
-        f"💰 Available Balance: ₹{bal}\n"
-        f"📋 Minimum Amount: ₹{min_amt}\n"
+        f"💰 Available Balance: ₹{money.fmt(bal)}\n"
+        f"📋 Minimum Amount: ₹{money.fmt(min_amt)}\n"
         f"💳 Method: {method}"
     )
     return WD_AMOUNT
 
 async def wd_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
-        amt = float(update.message.text)
-    except:
-        await update.message.reply_text("❌ Please enter a valid amount (numbers only)")
+        amt = money.parse(update.message.text)
+    except ValueError:
+        await update.message.reply_text("❌ Please enter a valid amount (numbers only, at most 2 decimal places)")
         return WD_AMOUNT
     
+    if await expired(update, context, "method", "detail"):
+        return ConversationHandler.END
+    
     method = context.user_data["method"]
-    min_amt = 5.0 if method == "UPI" else (2.0 if method == "VSV" else 5.0)
+    min_amt = MIN_WITHDRAW[method]
     
-    users = load(USERS, {})
     uid = str(update.effective_user.id)
+    user = storage.get_user(uid)
     
-    if uid not in users:
+    if user is None:
         await update.message.reply_text("❌ User not found")
         return ConversationHandler.END
     
     if amt < min_amt:
-        await update.message.reply_text(f"❌ Minimum withdrawal for {method} is ₹{min_amt}")
+        await update.message.reply_text(f"❌ Minimum withdrawal for {method} is ₹{money.fmt(min_amt)}")
         return ConversationHandler.END
     
-    if amt > users[uid]["balance"]:
-        await update.message.reply_text(f"❌ Insufficient balance. You have ₹{users[uid]['balance']}")
+    if amt > user["balance"]:
+        await update.message.reply_text(f"❌ Insufficient balance. You have ₹{money.fmt(user['balance'])}")
         return ConversationHandler.END
     
-    # Check for decimal places
-    if '.' in update.message.text:
-        decimal_places = len(update.message.text.split('.')[1])
-        if decimal_places > 2:
-            await update.message.reply_text("❌ Maximum 2 decimal places allowed")
-            return WD_AMOUNT
-    
-    # Deduct balance
-    users[uid]["balance"] -= amt
-    save(USERS, users)
+    # Deduct balance and queue the request (re-checked atomically by the backend)
+    res = storage.request_withdrawal(uid, amt, method, context.user_data["detail"])
+    if res is None:
+        await update.message.reply_text("❌ Insufficient balance")
+        return ConversationHandler.END
+    rid = res[0]
+    after_write(context)
     
-    # Send to admin
+    # Send to admin; the outbox keeps retrying, so no refund is needed
     kb = InlineKeyboardMarkup([
-        [InlineKeyboardButton("✅ Approve", callback_data=f"done:{uid}:{amt}"),
-         InlineKeyboardButton("❌ Reject", callback_data=f"rej:{uid}:{amt}")]
+        [InlineKeyboardButton("✅ Approve", callback_data=f"done:{rid}"),
+         InlineKeyboardButton("❌ Reject", callback_data=f"rej:{rid}")]
     ])
     
-    try:
-        await context.bot.send_message(
-            ADMIN_ID,
-            f"💸 WITHDRAWAL REQUEST\n"
-            f"━━━━━━━━━━━━━━━━━━\n"
-            f"👤 User: {users[uid]['name']}\n"
-            f"🆔 ID: {uid}\n"
-            f"💰 Amount: ₹{amt}\n"
-            f"📋 Method: {method}\n"
-            f"🔧 Details: {context.user_data['detail']}\n"
-            f"━━━━━━━━━━━━━━━━━━",
-            reply_markup=kb
-        )
-    except Exception as e:
-        print(f"Error sending to admin: {e}")
-        # Refund if failed to notify admin
-        users[uid]["balance"] += amt
-        save(USERS, users)
-        await update.message.reply_text("❌ Error processing request. Please try again.")
-        return ConversationHandler.END
+    outbox.send(
+        ADMIN_ID,
+        f"💸 WITHDRAWAL REQUEST #{rid}\n"
+        f"━━━━━━━━━━━━━━━━━━\n"
+        f"👤 User: {user['name']}\n"
+        f"🆔 ID: {uid}\n"
+        f"💰 Amount: ₹{money.fmt(amt)}\n"
+        f"📋 Method: {method}\n"
+        f"🔧 Details: {context.user_data['detail']}\n"
+        f"━━━━━━━━━━━━━━━━━━",
+        reply_markup=kb
+    )
     
     await update.message.reply_text(
         f"✅ Withdrawal Request Sent!\n\n"
-        f"• Amount: ₹{amt}\n"
+        f"• Amount: ₹{money.fmt(amt)}\n"
         f"• Method: {method}\n"
         f"• Details: {context.user_data['detail']}\n\n"
         f"⏳ Processing time: 24-48 hours\n"
@@ -450,6 +764,22 @@ async def wd_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data.clear()
     return ConversationHandler.END
 
+def withdrawal_notice(amount, approve):
+    if approve:
+        return (
+            f"✅ WITHDRAWAL APPROVED!\n\n"
+            f"💰 Amount: ₹{money.fmt(amount)}\n"
+            f"✅ Status: Completed\n\n"
+            f"Thank you for using our service!"
+        )
+    return (
+        f"❌ WITHDRAWAL REJECTED\n\n"
+        f"💰 Amount: ₹{money.fmt(amount)}\n"
+        f"❌ Status: Rejected\n"
+        f"💸 Refunded to your balance\n\n"
+        f"Contact support if you have questions."
+    )
+
 async def wd_action(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -458,37 +788,31 @@ async def wd_action(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     parts = query.data.split(':')
-    action = parts[0]
-    uid = parts[1]
-    amount = float(parts[2])
-    
-    if action == "done":
-        msg = (
-            f"✅ WITHDRAWAL APPROVED!\n\n"
-            f"💰 Amount: ₹{amount}\n"
-            f"✅ Status: Completed\n\n"
-            f"Thank you for using our service!"
-        )
+    approve = parts[0] == "done"
+    
+    if len(parts) == 3:
+        # Buttons sent before request ids existed: done/rej:<uid>:<amount>
+        uid = parts[1]
+        amount = money.to_paise(float(parts[2]))
+        if not approve:
+            refunded = storage.adjust_balance(uid, amount, REFUND)
+            if refunded is not None:
+                after_write(context)
+    else:
+        resolved = storage.resolve_withdrawals([int(parts[1])], approve)
+        if not resolved:
+            await query.edit_message_text(f"⚠️ Request #{parts[1]} was already processed")
+            return
+        after_write(context)
+        uid = resolved[0]["uid"]
+        amount = resolved[0]["amount"]
+    
+    if approve:
         await query.edit_message_text(f"✅ Withdrawal approved for user {uid}")
     else:
-        # Refund balance
-        users = load(USERS, {})
-        if uid in users:
-            users[uid]["balance"] += amount
-            save(USERS, users)
-        msg = (
-            f"❌ WITHDRAWAL REJECTED\n\n"
-            f"💰 Amount: ₹{amount}\n"
-            f"❌ Status: Rejected\n"
-            f"💸 Refunded to your balance\n\n"
-            f"Contact support if you have questions."
-        )
         await query.edit_message_text(f"❌ Withdrawal rejected for user {uid}")
     
-    try:
-        await context.bot.send_message(int(uid), msg)
-    except:
-        pass
+    outbox.send(int(uid), withdrawal_notice(amount, approve))
 
 # ================= ADMIN COMMANDS =================
 async def admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -508,23 +832,23 @@ async def add_balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def add_bal_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.message.text.strip()
-    users = load(USERS, {})
+    user = storage.get_user(uid)
     
-    if uid not in users:
+    if user is None:
         await update.message.reply_text("❌ User not found")
         return ConversationHandler.END
     
     context.user_data["add_user"] = uid
     await update.message.reply_text(
-        f"👤 User: {users[uid].get('name', 'Unknown')}\n"
-        f"💰 Current Balance: ₹{users[uid]['balance']}\n\n"
+        f"👤 User: {user.get('name', 'Unknown')}\n"
+        f"💰 Current Balance: ₹{money.fmt(user['balance'])}\n\n"
         f"Enter amount to add:"
     )
     return ADD_BAL_AMOUNT
 
 async def add_bal_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
-        amount = float(update.message.text)
+        amount = money.parse(update.message.text)
         if amount <= 0:
             await update.message.reply_text("❌ Amount must be positive")
             return ADD_BAL_AMOUNT
@@ -532,29 +856,28 @@ async def add_bal_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Invalid amount. Enter a number")
         return ADD_BAL_AMOUNT
     
+    if await expired(update, context, "add_user"):
+        return ConversationHandler.END
+    
     uid = context.user_data["add_user"]
-    users = load(USERS, {})
+    new_bal = storage.adjust_balance(uid, amount, ADMIN_ADD)
     
-    if uid in users:
-        users[uid]["balance"] += amount
-        save(USERS, users)
+    if new_bal is not None:
+        after_write(context)
         
-        try:
-            await update.get_bot().send_message(
-                int(uid),
-                f"💰 BALANCE UPDATED!\n\n"
-                f"✅ ₹{amount} added to your account\n"
-                f"💵 New Balance: ₹{users[uid]['balance']}\n\n"
-                f"Thank you!"
-            )
-        except:
-            pass
+        outbox.send(
+            int(uid),
+            f"💰 BALANCE UPDATED!\n\n"
+            f"✅ ₹{money.fmt(amount)} added to your account\n"
+            f"💵 New Balance: ₹{money.fmt(new_bal)}\n\n"
+            f"Thank you!"
+        )
         
         await update.message.reply_text(
             f"✅ Balance added successfully!\n\n"
             f"👤 User: {uid}\n"
-            f"💰 Added: ₹{amount}\n"
-            f"💵 New Balance: ₹{users[uid]['balance']}",
+            f"💰 Added: ₹{money.fmt(amount)}\n"
+            f"💵 New Balance: ₹{money.fmt(new_bal)}",
             reply_markup=admin_menu()
         )
     else:
@@ -573,23 +896,23 @@ async def remove_balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def rem_bal_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.message.text.strip()
-    users = load(USERS, {})
+    user = storage.get_user(uid)
     
-    if uid not in users:
+    if user is None:
         await update.message.reply_text("❌ User not found")
         return ConversationHandler.END
     
     context.user_data["rem_user"] = uid
     await update.message.reply_text(
-        f"👤 User: {users[uid].get('name', 'Unknown')}\n"
-        f"💰 Current Balance: ₹{users[uid]['balance']}\n\n"
+        f"👤 User: {user.get('name', 'Unknown')}\n"
+        f"💰 Current Balance: ₹{money.fmt(user['balance'])}\n\n"
         f"Enter amount to remove:"
     )
     return REM_BAL_AMOUNT
 
 async def rem_bal_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
-        amount = float(update.message.text)
+        amount = money.parse(update.message.text)
         if amount <= 0:
             await update.message.reply_text("❌ Amount must be positive")
             return REM_BAL_AMOUNT
@@ -597,33 +920,29 @@ async def rem_bal_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Invalid amount. Enter a number")
         return REM_BAL_AMOUNT
     
+    if await expired(update, context, "rem_user"):
+        return ConversationHandler.END
+    
     uid = context.user_data["rem_user"]
-    users = load(USERS, {})
+    # Removing more than the balance empties it
+    new_bal = storage.adjust_balance(uid, -amount, ADMIN_REMOVE, clamp=True)
     
-    if uid in users:
-        if amount > users[uid]["balance"]:
-            users[uid]["balance"] = 0
-        else:
-            users[uid]["balance"] -= amount
+    if new_bal is not None:
+        after_write(context)
         
-        save(USERS, users)
-        
-        try:
-            await update.get_bot().send_message(
-                int(uid),
-                f"⚠️ BALANCE UPDATED!\n\n"
-                f"❌ ₹{amount} removed from your account\n"
-                f"💵 New Balance: ₹{users[uid]['balance']}\n\n"
-                f"Contact support if this is an error."
-            )
-        except:
-            pass
+        outbox.send(
+            int(uid),
+            f"⚠️ BALANCE UPDATED!\n\n"
+            f"❌ ₹{money.fmt(amount)} removed from your account\n"
+            f"💵 New Balance: ₹{money.fmt(new_bal)}\n\n"
+            f"Contact support if this is an error."
+        )
         
         await update.message.reply_text(
             f"✅ Balance removed successfully!\n\n"
             f"👤 User: {uid}\n"
-            f"💰 Removed: ₹{amount}\n"
-            f"💵 New Balance: ₹{users[uid]['balance']}",
+            f"💰 Removed: ₹{money.fmt(amount)}\n"
+            f"💵 New Balance: ₹{money.fmt(new_bal)}",
             reply_markup=admin_menu()
         )
     else:
@@ -633,9 +952,112 @@ async def rem_bal_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return ConversationHandler.END
 
 # ================= ADD VERIFIED IDs =================
+# IDs arrive as a text message or an uploaded .txt/.csv file. Either way they
+# are spooled to a file under data/uploads and streamed from there in
+# batches; user_data only ever holds the file path.
+UPLOAD_DIR = f"{DATA}/uploads"
+MAX_UPLOAD = 20 * 1024 * 1024  # Bot API download limit
+ID_RE = re.compile(r'\d{8,}')  # Assuming user IDs are at least 8 digits
+
+def iter_id_rows(path):
+    """Yield (vid, amount or None) from a spooled file, one row at a time.
+
+    Every run of 8+ digits is an ID. Only a .csv upload carries amounts:
+    a row with one ID takes its amount column, the second one unless a
+    header row names another "amount". Text and .txt are IDs only.
+    """
+    with open(path, encoding="utf-8", errors="ignore", newline="") as f:
+        if not path.endswith(".csv"):
+            for line in f:
+                for vid in ID_RE.findall(line):
+                    yield vid, None
+            return
+        amount_col = 1
+        for i, row in enumerate(csv.reader(f)):
+            cells = [c.strip() for c in row]
+            if i == 0 and not any(ID_RE.search(c) for c in cells):
+                names = [c.lower() for c in cells]
+                if "amount" in names:
+                    amount_col = names.index("amount")
+                continue
+            cell = cells[amount_col] if amount_col < len(cells) else ""
+            amount = None
+            if cell and not ID_RE.search(cell):
+                try:
+                    amount = money.parse(cell)
+                except ValueError:
+                    pass
+            ids = [vid for c in cells for vid in ID_RE.findall(c)]
+            for vid in ids:
+                yield vid, amount if len(ids) == 1 else None
+
+def scan_upload(path):
+    """
+    (id rows, rows without an amount, total of the amounts there are, first
+    10 IDs) without keeping the rest.
+    """
+    count = missing = total = 0
+    preview = []
+    for vid, amount in iter_id_rows(path):
+        count += 1
+        if amount is None:
+            missing += 1
+        else:
+            total += amount
+        if len(preview) < 10:
+            preview.append(vid)
+    return count, missing, total, preview
+
+def spool_path(uid, ext):
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    return f"{UPLOAD_DIR}/{uid}-{time.time_ns()}{ext}"
+
+def discard_upload(context):
+    path = context.user_data.pop("ver_file", None)
+    if path:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+async def import_ids(update, context, path, default, campaign=MAIN):
+    """Stream the file into storage VER_BATCH IDs at a time. Returns (rows, new)."""
+    progress = await update.effective_message.reply_text("⏳ Importing verified IDs...")
+    rows = added = 0
+    batch = {}
+    last_edit = time.monotonic()
+
+    def commit():
+        nonlocal added
+        added += storage.add_verified(batch.items(), campaign)
+        batch.clear()
+        after_write(context)
+
+    for vid, amount in iter_id_rows(path):
+        batch[vid] = default if amount is None else amount
+        rows += 1
+        if len(batch) >= VER_BATCH:
+            commit()
+            if time.monotonic() - last_edit >= 2:
+                last_edit = time.monotonic()
+                try:
+                    await progress.edit_text(f"⏳ Importing verified IDs... {rows} done")
+                except:
+                    pass
+            # Let other updates through between batches
+            await asyncio.sleep(0)
+    if batch:
+        commit()
+    try:
+        await progress.edit_text(f"✅ Imported {rows} ID row(s)")
+    except:
+        pass
+    return rows, added
+
 async def add_verified_ids(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update.effective_user.id):
         return
+    discard_upload(context)
     
     await update.message.reply_text(
         "📋 Send Verified User IDs (one per line):\n\n"
@@ -643,75 +1065,149 @@ async def add_verified_ids(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "6274638384\n"
         "1234567890\n"
         "9876543210\n\n"
+        "For large lists upload a .txt or .csv file instead. "
+        "In a .csv, rows like 6274638384,5 set a per-ID amount.\n\n"
         "I'll extract the user IDs and then ask for the amount."
     )
     return ADD_VER_IDS
 
 async def add_ver_ids(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    text = update.message.text.strip()
-    lines = text.split('\n')
-    
-    extracted_ids = []
-    
-    for line in lines:
-        line = line.strip()
-        # Extract numbers from the line (for IDs)
-        numbers = re.findall(r'\d+', line)
-        for num in numbers:
-            if len(num) >= 8:  # Assuming user IDs are at least 8 digits
-                extracted_ids.append(num)
+    path = spool_path(update.effective_user.id, ".txt")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(update.message.text)
+    return await ver_ids_ready(update, context, path)
+
+async def add_ver_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    doc = update.message.document
+    ext = os.path.splitext(doc.file_name or "")[1].lower()
+    if ext not in (".txt", ".csv"):
+        await update.message.reply_text("❌ Send a .txt or .csv file")
+        return ADD_VER_IDS
+    if doc.file_size and doc.file_size > MAX_UPLOAD:
+        await update.message.reply_text("❌ File too large (max 20 MB). Split it and send the parts.")
+        return ADD_VER_IDS
     
-    if not extracted_ids:
+    path = spool_path(update.effective_user.id, ext)
+    tg_file = await doc.get_file()
+    await tg_file.download_to_drive(path)
+    return await ver_ids_ready(update, context, path)
+
+async def ver_ids_ready(update, context, path):
+    count, missing, total, preview = await asyncio.to_thread(scan_upload, path)
+    if not count:
+        os.remove(path)
         await update.message.reply_text("❌ No valid user IDs found. Try again.")
         return ADD_VER_IDS
     
-    # Store extracted IDs in context
-    context.user_data["ver_ids"] = extracted_ids
-    
-    # Show extracted IDs
-    ids_preview = "\n".join(extracted_ids[:10])  # Show first 10
-    if len(extracted_ids) > 10:
-        ids_preview += f"\n... and {len(extracted_ids) - 10} more"
+    context.user_data["ver_file"] = path
+    context.user_data["ver_scan"] = [count, missing, total]
+    campaigns = [c["name"] for c in storage.campaigns()]
+    # Every row has its own amount and there is no campaign to pick
+    if not missing and len(campaigns) == 1:
+        return await ver_ask_confirm(update, context, MAIN, None)
+    
+    ids_preview = "\n".join(preview)
+    if count > 10:
+        ids_preview += f"\n... and {count - 10} more"
+    ask = "Now enter the amount to give for ALL these IDs:"
+    if not missing:
+        ask = "Every row has its own amount. Enter the campaign to add them to:"
+    elif missing < count:
+        ask = f"{count - missing} have their own amount. Enter the amount for the other {missing}:"
+    if len(campaigns) > 1:
+        ask += (
+            f"\n\n🎯 Campaigns: {', '.join(campaigns)}\n"
+            f"Send a campaign name to use its payout and expiry, or a name "
+            f"and an amount (e.g. {campaigns[1]} 5). An amount alone goes to {MAIN}."
+        )
     
     await update.message.reply_text(
-        f"✅ Found {len(extracted_ids)} user ID(s):\n\n"
+        f"✅ Found {count} user ID(s):\n\n"
         f"{ids_preview}\n\n"
-        f"Now enter the amount to give for ALL these IDs:"
+        f"{ask}"
     )
     return VER_AMOUNT
 
+def parse_ver_target(text, campaigns):
+    """
+    (campaign, amount) from `5`, `diwali` or `diwali 5`; a campaign alone
+    pays its own payout. ValueError for anything else.
+    """
+    words = text.lower().split()
+    payouts = {c["name"]: c["amount"] for c in campaigns}
+    name = MAIN
+    if words and words[0] in payouts:
+        name = words.pop(0)
+    if len(words) > 1:
+        raise ValueError(text)
+    return name, money.parse(words[0]) if words else payouts[name]
+
 async def ver_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
-        amount = float(update.message.text)
-        if amount < 0:
-            await update.message.reply_text("❌ Amount cannot be negative")
-            return VER_AMOUNT
-    except:
-        await update.message.reply_text("❌ Invalid amount. Enter a number")
+        campaign, amount = parse_ver_target(update.message.text, storage.campaigns())
+    except ValueError:
+        await update.message.reply_text("❌ Invalid amount. Enter a number or a campaign name")
         return VER_AMOUNT
     
-    if "ver_ids" not in context.user_data:
-        await update.message.reply_text("❌ No IDs found. Start over.")
+    if await expired(update, context, "ver_file", "ver_scan"):
         return ConversationHandler.END
+    return await ver_ask_confirm(update, context, campaign, amount)
+
+async def ver_ask_confirm(update, context, campaign, amount):
+    """Show what the import adds up to; nothing is written before ✅."""
+    count, missing, total = context.user_data["ver_scan"]
+    context.user_data["ver_target"] = [campaign, amount]
+    
+    text = (
+        f"📋 CONFIRM IMPORT\n"
+        f"━━━━━━━━━━━━━━\n"
+        f"🆔 IDs: {count}\n"
+        f"🎯 Campaign: {campaign}\n"
+    )
+    if missing < count:
+        text += f"📄 {count - missing} with their own amount: ₹{money.fmt(total)}\n"
+    if missing:
+        text += f"💰 {missing} at ₹{money.fmt(amount)} each: ₹{money.fmt(missing * amount)}\n"
+        total += missing * amount
+    text += f"💵 Total amount: ₹{money.fmt(total)}"
+    
+    kb = InlineKeyboardMarkup([
+        [InlineKeyboardButton("✅ Import", callback_data="ver:go"),
+         InlineKeyboardButton("❌ Cancel", callback_data="ver:no")]
+    ])
+    await update.message.reply_text(text, reply_markup=kb)
+    return VER_CONFIRM
+
+async def ver_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
     
-    extracted_ids = context.user_data["ver_ids"]
-    verified = load(VERIFIED, {})
+    if await expired(update, context, "ver_file", "ver_target"):
+        return ConversationHandler.END
     
-    added_count = 0
-    for uid in extracted_ids:
-        if uid not in verified:
-            verified[uid] = amount
-            added_count += 1
-        else:
-            # Update existing ID with new amount
-            verified[uid] = amount
+    path = context.user_data["ver_file"]
+    if query.data != "ver:go" or not os.path.exists(path):
+        discard_upload(context)
+        context.user_data.clear()
+        await query.edit_message_text("❌ Import cancelled")
+        return ConversationHandler.END
     
-    save(VERIFIED, verified)
+    campaign, amount = context.user_data["ver_target"]
+    await query.edit_message_reply_markup(None)
+    # Existing IDs are updated with the new amount and move to the campaign
+    rows, added = await import_ids(update, context, path, amount, campaign)
+    discard_upload(context)
     
-    await update.message.reply_text(
-        f"✅ Successfully added/updated {added_count} ID(s)!\n\n"
-        f"💰 Amount set: ₹{amount} for each ID\n"
-        f"📊 Total verified IDs now: {len(verified)}",
+    text = (
+        f"✅ Successfully added/updated {rows} ID(s), {added} new!\n\n"
+        f"🎯 Campaign: {campaign}\n"
+    )
+    if amount is None:
+        text += "💰 Amounts taken from the file\n"
+    else:
+        text += f"💰 Amount set: ₹{money.fmt(amount)} for each ID without its own\n"
+    await query.message.reply_text(
+        text + f"📊 Total verified IDs now: {storage.count_verified()}",
         reply_markup=admin_menu()
     )
     
@@ -719,43 +1215,112 @@ async def ver_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data.clear()
     return ConversationHandler.END
 
-# ================= TOTAL USERS =================
-async def total_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
+# ================= CAMPAIGNS =================
+# Verified IDs belong to a campaign with its own payout (for IDs uploaded
+# without an amount) and ttl: unclaimed IDs expire that long after they
+# were added. "main" always exists and takes IDs uploaded with an amount
+# only. A ttl change applies to IDs added from then on.
+#   /campaign                  payout, ttl and counts of every campaign
+#   /campaign diwali 5 7d      create or change a campaign
+CAMPAIGN_NAME = re.compile(r"^[a-z0-9_-]{1,32}$")
+CAMPAIGN_USAGE = (
+    "📝 Usage: /campaign <name> <payout> [expiry]\n\n"
+    "Expiry is how long IDs stay claimable after upload: 30m, 12h, 7d or 0 for never.\n"
+    "Examples:\n"
+    "/campaign diwali 5 7d\n"
+    "/campaign main 2"
+)
+DURATION_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+def parse_duration(text):
+    """Seconds from `90`, `30m`, `12h` or `7d`; `0` / `never` is 0. ValueError otherwise."""
+    text = text.lower()
+    if text in ("never", "none"):
+        return 0
+    unit = DURATION_UNITS.get(text[-1:], 1)
+    n = int(text[:-1] if text[-1:] in DURATION_UNITS else text)
+    if n < 0:
+        raise ValueError(text)
+    return n * unit
+
+def fmt_duration(seconds):
+    for unit, size in (("d", 86400), ("h", 3600), ("m", 60)):
+        if seconds % size == 0:
+            return f"{seconds // size}{unit}"
+    return f"{seconds}s"
+
+def fmt_expiry(ttl):
+    return f"expires {fmt_duration(ttl)} after upload" if ttl else "never expires"
+
+async def campaign(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update.effective_user.id):
         return
     
-    users = load(USERS, {})
-    verified = load(VERIFIED, {})
-    
-    total_balance = sum(user["balance"] for user in users.values())
-    total_proofs = sum(user["proofs"] for user in users.values())
+    args = context.args or []
+    camps = {c["name"]: c for c in storage.campaigns()}
+    if not args:
+        text = "🎯 CAMPAIGNS\n━━━━━━━━━━━━━━━━━━\n"
+        for c in camps.values():
+            text += (
+                f"\n• {c['name']}: ₹{money.fmt(c['amount'])} per ID, {fmt_expiry(c['ttl'])}\n"
+                f"  📋 In pool: {c['ids']} (₹{money.fmt(c['pool'])})\n"
+                f"  ✅ Claimed: {c['claimed']} (₹{money.fmt(c['paid'])})\n"
+                f"  ⌛ Expired: {c['expired']}\n"
+            )
+        await update.message.reply_text(f"{text}\n{CAMPAIGN_USAGE}")
+        return
     
-    # Calculate total amount in verified IDs
-    total_verified_amount = sum(verified.values())
+    name = args[0].lower()
+    try:
+        if len(args) not in (2, 3) or not CAMPAIGN_NAME.match(name):
+            raise ValueError(args)
+        amount = money.parse(args[1])
+        # Leaving out the expiry keeps the current one
+        ttl = parse_duration(args[2]) if len(args) == 3 else camps.get(name, {"ttl": 0})["ttl"]
+    except ValueError:
+        await update.message.reply_text(CAMPAIGN_USAGE)
+        return
     
+    storage.set_campaign(name, amount, ttl)
+    after_write(context)
     await update.message.reply_text(
+        f"✅ Campaign {name} {'updated' if name in camps else 'created'}\n\n"
+        f"💰 Payout: ₹{money.fmt(amount)} per ID\n"
+        f"⌛ IDs {fmt_expiry(ttl)}"
+    )
+
+# ================= TOTAL USERS =================
+def totals_panel():
+    (user_count, total_balance, total_proofs,
+     verified_count, total_verified_amount) = storage.totals()
+    
+    return (
         f"📊 BOT STATISTICS\n"
         f"━━━━━━━━━━━━━━━━\n"
-        f"👥 Total Users: {len(users)}\n"
-        f"💰 Total Balance: ₹{total_balance}\n"
+        f"👥 Total Users: {user_count}\n"
+        f"💰 Total Balance: ₹{money.fmt(total_balance)}\n"
         f"📥 Total Proofs: {total_proofs}\n"
-        f"✅ Verified IDs: {len(verified)}\n"
-        f"💵 Total Verified Amount: ₹{total_verified_amount}"
+        f"✅ Verified IDs: {verified_count}\n"
+        f"💵 Total Verified Amount: ₹{money.fmt(total_verified_amount)}"
     )
 
-# ================= USER DETAILS =================
-async def user_details(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def total_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update.effective_user.id):
         return
     
-    users = load(USERS, {})
-    if not users:
-        await update.message.reply_text("❌ No users found")
-        return
-    
-    # Show last 5 users
-    user_list = list(users.items())[-5:]
-    msg = "📋 RECENT USERS\n━━━━━━━━━━━━━━\n\n"
+    await update.message.reply_text(render_cache.get(("total_users",), "totals", totals_panel))
+
+# ================= USER DETAILS =================
+USERS_PAGE_SIZE = 5
+
+SORT_LABELS = {
+    "new": "🆕 Newest",
+    "balance": "💰 Balance",
+    "proofs": "📊 Proofs"
+}
+
+def render_users(title, user_list):
+    msg = f"{title}\n━━━━━━━━━━━━━━\n\n"
     
     for uid, data in user_list:
         username = f"@{data['username']}" if data.get('username') else "No username"
@@ -763,41 +1328,611 @@ async def user_details(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"👤 Name: {data.get('name', 'Unknown')}\n"
             f"📱 Username: {username}\n"
             f"🆔 ID: {uid}\n"
-            f"💰 Balance: ₹{data['balance']}\n"
+            f"💰 Balance: ₹{money.fmt(data['balance'])}\n"
             f"📊 Proofs: {data['proofs']}\n"
             f"━━━━━━━━━━━━━━\n"
         )
+    return msg
+
+def users_page(sort, page, after=None, before=None):
+    """
+    Text and inline keyboard for one page of the admin user browser, None
+    without users. after / before: the browse_cursor the page continues
+    from, which the Prev / Next buttons carry, so a deep page costs no
+    more than the first.
+    """
+    count = storage.totals()[0]
+    if not count:
+        return None
+    if before is not None:
+        rows = storage.browse_users(sort, USERS_PAGE_SIZE, before=before)
+        more = True
+        if len(rows) < USERS_PAGE_SIZE:
+            # Users moved up since the page was shown; start over
+            return users_page(sort, 0)
+    else:
+        # One extra row tells us whether there is a next page
+        rows = storage.browse_users(sort, USERS_PAGE_SIZE + 1, after=after)
+        if not rows and page > 0:
+            return users_page(sort, 0)
+        more = len(rows) > USERS_PAGE_SIZE
+        rows = rows[:USERS_PAGE_SIZE]
+    pages = max(-(-count // USERS_PAGE_SIZE), 1)
+    
+    msg = render_users(
+        f"📋 USERS ({SORT_LABELS[sort]}) • Page {min(page + 1, pages)}/{pages}",
+        rows
+    )
+    msg += "\n🔎 Search: /find <id | username | name>"
+    msg += "\n📜 History: /history <id> [count]"
+    
+    nav = []
+    if page > 1:
+        key, row = browse_cursor(sort, rows[0][1])
+        nav.append(InlineKeyboardButton("◀️ Prev", callback_data=f"ub:{sort}:{page - 1}:b:{key}:{row}"))
+    elif page == 1:
+        nav.append(InlineKeyboardButton("◀️ Prev", callback_data=f"ub:{sort}:0"))
+    if more:
+        key, row = browse_cursor(sort, rows[-1][1])
+        nav.append(InlineKeyboardButton("Next ▶️", callback_data=f"ub:{sort}:{page + 1}:a:{key}:{row}"))
+    sorts = [
+        InlineKeyboardButton(("• " if s == sort else "") + label, callback_data=f"ub:{s}:0")
+        for s, label in SORT_LABELS.items()
+    ]
+    return msg, InlineKeyboardMarkup([nav, sorts] if nav else [sorts])
+
+def browse_args(data):
+    """
+    users_page's (sort, page, after, before) from a button's callback data:
+    ub:<sort>:<page>[:a|b:<key>:<row>], a / b for after / before that cursor.
+    """
+    _, sort, page, *cursor = data.split(':')
+    after = before = None
+    if cursor:
+        side, key, row = cursor
+        if side == "a":
+            after = (int(key), int(row))
+        else:
+            before = (int(key), int(row))
+    return sort, int(page), after, before
+
+async def user_details(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update.effective_user.id):
+        return
+    
+    panel = render_cache.get(
+        ("user_details", "new", 0, None, None), "users", lambda: users_page("new", 0)
+    )
+    if panel is None:
+        await update.message.reply_text("❌ No users found")
+        return
+    
+    msg, kb = panel
+    await update.message.reply_text(msg, reply_markup=kb)
+
+async def browse_users_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    
+    if not is_admin(query.from_user.id):
+        return
+    
+    sort, page, after, before = browse_args(query.data)
+    # Waits (without blocking other updates) if the indexes are still being built
+    await storage.prepare_indexes()
+    panel = render_cache.get(
+        ("user_details", sort, page, after, before), "users",
+        lambda: users_page(sort, page, after, before)
+    )
+    if panel is None:
+        return
+    
+    msg, kb = panel
+    await query.edit_message_text(msg, reply_markup=kb)
+
+async def find_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update.effective_user.id):
+        return
+    
+    if not context.args:
+        await update.message.reply_text("📝 Usage: /find <id | username | name>")
+        return
+    
+    await storage.prepare_indexes()
+    results = storage.search_users(" ".join(context.args), 10)
+    if not results:
+        await update.message.reply_text("❌ No users found")
+        return
+    
+    await update.message.reply_text(render_users(f"🔎 SEARCH RESULTS ({len(results)})", results))
+
+# ================= PAYOUTS =================
+# /payouts summarises pending withdrawal requests; with an action it
+# approves, rejects or exports every request matching a filter:
+#   /payouts approve upi under 100
+#   /payouts reject fxl
+#   /payouts csv
+PAYOUT_METHODS = ("UPI", "VSV", "FXL")
+PAYOUT_USAGE = (
+    "📝 Usage: /payouts [approve | reject | csv] [upi | vsv | fxl] [under <amount>]\n\n"
+    "Examples:\n"
+    "/payouts approve upi under 100\n"
+    "/payouts reject fxl\n"
+    "/payouts csv"
+)
+
+def parse_payout_filter(words):
+    """(method, below) from words like `upi under 100`. ValueError if unknown."""
+    method = below = None
+    words = iter(w.lower() for w in words)
+    for w in words:
+        if w.upper() in PAYOUT_METHODS:
+            method = w.upper()
+        elif w in ("under", "below", "<"):
+            below = money.parse(next(words, ""))
+        elif w.startswith("<"):
+            below = money.parse(w[1:])
+        else:
+            raise ValueError(w)
+    return method, below
+
+def describe_filter(method, below):
+    text = method or "all methods"
+    if below is not None:
+        text += f" under ₹{money.fmt(below)}"
+    return text
+
+def payouts_csv(reqs):
+    buf = io.StringIO()
+    out = csv.writer(buf)
+    out.writerow(["request_id", "requested_utc", "user_id", "name", "amount", "method", "detail"])
+    for r in reqs:
+        user = storage.get_user(r["uid"]) or {}
+        out.writerow([
+            r["id"], time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(r["ts"])),
+            r["uid"], user.get("name", ""), money.fmt(r["amount"]), r["method"], r["detail"]
+        ])
+    return buf.getvalue().encode()
+
+async def payouts(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update.effective_user.id):
+        return
+    
+    args = context.args or []
+    action = args[0].lower() if args else "list"
+    if action in ("approve", "reject", "csv"):
+        args = args[1:]
+    else:
+        action = "list"
+    try:
+        method, below = parse_payout_filter(args)
+    except ValueError:
+        await update.message.reply_text(PAYOUT_USAGE)
+        return
+    
+    reqs = storage.pending_withdrawals(method, below)
+    what = describe_filter(method, below)
+    if not reqs:
+        await update.message.reply_text(f"✅ No pending withdrawals ({what})")
+        return
+    total = sum(r["amount"] for r in reqs)
+    
+    if action == "list":
+        by_method = {}
+        for r in reqs:
+            count, amount = by_method.get(r["method"], (0, 0))
+            by_method[r["method"]] = (count + 1, amount + r["amount"])
+        text = f"💸 PENDING WITHDRAWALS ({what})\n━━━━━━━━━━━━━━━━━━\n"
+        for m, (count, amount) in sorted(by_method.items()):
+            text += f"• {m}: {count} — ₹{money.fmt(amount)}\n"
+        text += f"\n📊 Total: {len(reqs)} — ₹{money.fmt(total)}\n\n{PAYOUT_USAGE}"
+        await update.message.reply_text(text)
+    elif action == "csv":
+        await update.message.reply_document(
+            document=payouts_csv(reqs),
+            filename=f"payouts-{time.strftime('%Y%m%d-%H%M')}.csv",
+            caption=f"📄 {len(reqs)} pending withdrawal(s), ₹{money.fmt(total)} ({what})"
+        )
+    else:
+        # Confirm first; only requests up to the newest one listed are touched
+        verb = "done" if action == "approve" else "rej"
+        data = f"pay:{verb}:{method or ''}:{'' if below is None else below}:{reqs[-1]['id']}"
+        kb = InlineKeyboardMarkup([
+            [InlineKeyboardButton(f"✅ {action.title()} {len(reqs)}", callback_data=data),
+             InlineKeyboardButton("❌ Cancel", callback_data="pay:cancel")]
+        ])
+        await update.message.reply_text(
+            f"⚠️ {action.title()} {len(reqs)} pending withdrawal(s) ({what}), ₹{money.fmt(total)} in total?",
+            reply_markup=kb
+        )
+
+async def payouts_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    
+    if not is_admin(query.from_user.id):
+        return
+    if query.data == "pay:cancel":
+        await query.edit_message_text("❌ Cancelled")
+        return
+    
+    _, verb, method, below, upto = query.data.split(":")
+    approve = verb == "done"
+    reqs = storage.pending_withdrawals(method or None, int(below) if below else None)
+    resolved = storage.resolve_withdrawals(
+        [r["id"] for r in reqs if r["id"] <= int(upto)], approve
+    )
+    if resolved:
+        after_write(context)
+    # One transaction; the outbox spreads the sends under its rate limits
+    outbox.send_many(
+        (int(r["uid"]), withdrawal_notice(r["amount"], approve)) for r in resolved
+    )
+    
+    total = sum(r["amount"] for r in resolved)
+    done = "Approved" if approve else "Rejected and refunded"
+    await query.edit_message_text(
+        f"✅ {done} {len(resolved)} withdrawal(s), ₹{money.fmt(total)}\n"
+        f"📬 Users are being notified"
+    )
+
+# ================= BROADCAST =================
+BROADCAST_STATUS = {
+    "running": "▶️ Running",
+    "paused": "⏸ Paused",
+    "done": "✅ Done",
+    "cancelled": "🛑 Cancelled"
+}
+
+def broadcast_panel(b):
+    """Text and inline keyboard for a broadcast's progress message."""
+    waiting = 0
+    if b["status"] in ("running", "paused"):
+        # Once finished, the rest were sent or dropped
+        waiting = b["queued"] - b["sent"] - b["blocked"] - b["failed"]
+    msg = (
+        f"📢 BROADCAST #{b['id']} • {BROADCAST_STATUS[b['status']]}\n"
+        "━━━━━━━━━━━━━━\n\n"
+        f"✅ Sent: {b['sent']}\n"
+        f"🚫 Blocked: {b['blocked']}\n"
+        f"❗ Failed: {b['failed']}\n"
+        f"📤 In queue: {max(waiting, 0)}\n"
+        f"👥 Recipients: ~{b['total']}\n\n"
+        f"📝 {b['text'][:200]}"
+    )
+    bid = b["id"]
+    if b["status"] == "running":
+        row = [InlineKeyboardButton("⏸ Pause", callback_data=f"bc:pause:{bid}")]
+    elif b["status"] == "paused":
+        row = [InlineKeyboardButton("▶️ Resume", callback_data=f"bc:resume:{bid}")]
+    else:
+        return msg, None
+    row.append(InlineKeyboardButton("🛑 Cancel", callback_data=f"bc:cancel:{bid}"))
+    return msg, InlineKeyboardMarkup([
+        row, [InlineKeyboardButton("🔄 Refresh", callback_data=f"bc:show:{bid}")]
+    ])
+
+async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update.effective_user.id):
+        return ConversationHandler.END
+    
+    # One broadcast at a time: show the current one instead
+    current = broadcaster.active()
+    if current is not None:
+        msg, kb = broadcast_panel(current)
+        await update.message.reply_text(msg, reply_markup=kb)
+        return ConversationHandler.END
+    
+    await update.message.reply_text(
+        "📢 Send the message to broadcast to all users.\n\n/cancel to stop"
+    )
+    return BC_TEXT
+
+async def bc_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    text = update.message.text
+    context.user_data["bc_text"] = text
+    
+    recipients = storage.totals()[0] - storage.count_blocked()
+    kb = InlineKeyboardMarkup([
+        [InlineKeyboardButton(f"✅ Send to {recipients} users", callback_data="bc:go"),
+         InlineKeyboardButton("❌ Cancel", callback_data="bc:no")]
+    ])
+    await update.message.reply_text(f"👀 Preview:\n\n{text}", reply_markup=kb)
+    return BC_CONFIRM
+
+async def bc_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    
+    text = context.user_data.pop("bc_text", None)
+    if query.data != "bc:go" or text is None:
+        await query.edit_message_text("❌ Broadcast cancelled")
+        return ConversationHandler.END
+    
+    bid = broadcaster.start(text)
+    if bid is None:
+        await query.edit_message_text("⚠️ Another broadcast is still in progress")
+        return ConversationHandler.END
+    
+    msg, kb = broadcast_panel(broadcaster.get(bid))
+    await query.edit_message_text(msg, reply_markup=kb)
+    return ConversationHandler.END
+
+async def broadcast_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    
+    if not is_admin(query.from_user.id):
+        return
+    
+    _, action, bid = query.data.split(":")
+    bid = int(bid)
+    status = {"pause": "paused", "resume": "running", "cancel": "cancelled"}.get(action)
+    if status is not None:
+        broadcaster.set_status(bid, status)
     
+    msg, kb = broadcast_panel(broadcaster.get(bid))
+    try:
+        await query.edit_message_text(msg, reply_markup=kb)
+    except BadRequest:
+        pass  # Refresh with nothing new: "message is not modified"
+
+def broadcast_done(b):
+    outbox.send(
+        ADMIN_ID,
+        f"📢 Broadcast #{b['id']} finished\n\n"
+        f"✅ Sent: {b['sent']}\n"
+        f"🚫 Blocked: {b['blocked']}\n"
+        f"❗ Failed: {b['failed']}"
+    )
+
+# ================= STATS =================
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update.effective_user.id):
+        return
+    
+    def section(title, name):
+        rows = metrics.summary(name)
+        if not rows:
+            return ""
+        text = f"{title}\n"
+        for label, count, p50, p99 in rows[:12]:
+            text += f"• {label}: {count}× p50 {p50 * 1000:.1f}ms p99 {p99 * 1000:.1f}ms\n"
+        return text + "\n"
+    
+    errors = metrics.counters.get("handler_errors_total", {})
+    joins = metrics.counters.get("join_cache_total", {})
+    renders = {}
+    for labels, n in metrics.counters.get("render_cache_total", {}).items():
+        labels = dict(labels)
+        renders.setdefault(labels["panel"], {})[labels["result"]] = n
+    msg = (
+        "📈 PERFORMANCE\n━━━━━━━━━━━━━━━━\n\n"
+        + section("⚙ Handlers", "handler_seconds")
+        + section("💾 Storage", "storage_seconds")
+        + section("📡 force_join API", "force_join_api_seconds")
+        + section("📤 Outgoing sends", "send_seconds")
+        + section("🧹 Maintenance", "job_seconds")
+        + f"❗ Handler errors: {sum(errors.values())}\n"
+        + f"🧊 Join cache hits/misses: {joins.get((('result', 'hit'),), 0)}/"
+        f"{joins.get((('result', 'miss'),), 0)}\n"
+        + "".join(
+            f"🗂 {panel} cache hits/misses: {n.get('hit', 0)}/{n.get('miss', 0)}\n"
+            for panel, n in sorted(renders.items())
+        )
+        + f"📬 Outbox pending: {outbox.pending()}"
+    )
     await update.message.reply_text(msg)
 
 # ================= CANCEL =================
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("❌ Operation cancelled", reply_markup=menu())
+    discard_upload(context)
     if context.user_data:
         context.user_data.clear()
     return ConversationHandler.END
 
+# ================= MAINTENANCE =================
+# Housekeeping on the JobQueue: backups, verified-ID expiry, purging of
+# abandoned conversations and WAL truncation. Each run is timed into
+# job_seconds{job=...}. Jobs on shared data run on worker 0 only.
+BACKUP_DIR = f"{DATA}/backups"
+
+def schedule_maintenance(job_queue, callback, interval, jitter):
+    """
+    Run callback every `interval` seconds plus a random delay of up to
+    `jitter`, drawn again for each run, so jobs with the same interval
+    drift apart instead of all landing on the same moment.
+    """
+    if interval <= 0:
+        return
+    name = callback.__name__
+
+    async def run(context: ContextTypes.DEFAULT_TYPE):
+        start = time.perf_counter()
+        result = "ok"
+        try:
+            await callback(context)
+        except Exception:
+            result = "error"
+            raise
+        finally:
+            metrics.observe("job_seconds", time.perf_counter() - start, job=name, result=result)
+            job_queue.run_once(run, interval + random.uniform(0, jitter), name=name)
+
+    job_queue.run_once(run, interval + random.uniform(0, jitter), name=name)
+
+async def backup_job(context: ContextTypes.DEFAULT_TYPE):
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    await storage.backup(f"{BACKUP_DIR}/backup-{time.strftime('%Y%m%d-%H%M%S')}.tar.gz")
+    if BACKUP_KEEP > 0:
+        names = sorted(
+            n for n in os.listdir(BACKUP_DIR) if n.startswith("backup-") and n.endswith(".tar.gz")
+        )
+        for name in names[:-BACKUP_KEEP]:
+            os.remove(f"{BACKUP_DIR}/{name}")
+
+async def expire_job(context: ContextTypes.DEFAULT_TYPE):
+    now = int(time.time())
+    sweeps = [lambda: storage.evict_expired(now, VER_BATCH)]
+    if VERIFIED_MAX_AGE > 0:
+        sweeps.append(lambda: storage.expire_verified(now - VERIFIED_MAX_AGE, VER_BATCH))
+    total = 0
+    for sweep in sweeps:
+        while True:
+            n = sweep()
+            if not n:
+                break
+            total += n
+            after_write(context)
+            if n < VER_BATCH:
+                break
+            # Let other updates through between batches
+            await asyncio.sleep(0)
+    if total:
+        metrics.inc("verified_expired_total", total)
+        print(f"Expired {total} verified IDs")
+
+async def purge_job(context: ContextTypes.DEFAULT_TYPE):
+    before = int(time.time()) - STATE_MAX_AGE
+    app = context.application
+    uids = app.persistence.purge(before)
+    for uid in uids:
+        app.drop_user_data(uid)
+    # Spooled uploads of purged conversations, and any a crash left behind
+    files = 0
+    if os.path.isdir(UPLOAD_DIR):
+        for entry in os.scandir(UPLOAD_DIR):
+            if entry.stat().st_mtime < before:
+                try:
+                    os.remove(entry.path)
+                    files += 1
+                except OSError:
+                    pass
+    if uids or files:
+        print(f"Purged user_data of {len(uids)} idle users and {files} uploads")
+
+async def compact_job(context: ContextTypes.DEFAULT_TYPE):
+    paths = [context.application.persistence.path]
+    if WORKER_ID == 0:
+        paths.append(outbox.path)
+        if STORAGE == "sqlite":
+            paths.append(storage.path)
+    for path in paths:
+        if not await asyncio.to_thread(checkpoint, path):
+            print(f"Compaction of {path} was held up by readers, retrying next run")
+
 # ================= MAIN =================
+async def on_startup(app):
+    global storage, outbox, broadcaster, metrics_server
+    start = time.perf_counter()
+    storage = open_storage(STORAGE, DATA, FLUSH_BATCH)
+    metrics.observe("storage_seconds", time.perf_counter() - start, op="open")
+    metrics.instrument(storage, TIMED_STORAGE_OPS, "storage_seconds")
+    outbox = Outbox(
+        f"{DATA}/outbox.db",
+        chat_rate=OUTBOX_CHAT_RATE,
+        global_rate=OUTBOX_GLOBAL_RATE,
+        concurrency=OUTBOX_CONCURRENCY
+    )
+    leader = WORKER_ID == 0
+    outbox.open(app.bot, deliver=leader)
+    broadcaster = Broadcaster(outbox, storage, BROADCAST_WINDOW, on_done=broadcast_done)
+    broadcaster.open(feed=leader)
+    # Sends that hit "bot was blocked" mark the user for future broadcasts
+    outbox.on_result = broadcaster.record
+    if PROOF_DIGEST_INTERVAL > 0 and leader:
+        app.job_queue.run_repeating(digest_job, PROOF_DIGEST_INTERVAL, first=PROOF_DIGEST_INTERVAL)
+    app.job_queue.run_repeating(flush_job, FLUSH_INTERVAL, first=FLUSH_INTERVAL)
+    app.job_queue.run_repeating(snapshot_job, SNAPSHOT_INTERVAL, first=SNAPSHOT_INTERVAL)
+    app.job_queue.run_once(index_job, 0)
+    if leader:
+        app.job_queue.run_repeating(reconcile_job, RECONCILE_INTERVAL, first=RECONCILE_INTERVAL)
+        schedule_maintenance(app.job_queue, backup_job, BACKUP_INTERVAL, BACKUP_JITTER)
+        schedule_maintenance(app.job_queue, expire_job, EXPIRE_INTERVAL, EXPIRE_JITTER)
+    schedule_maintenance(app.job_queue, purge_job, PURGE_INTERVAL, PURGE_JITTER)
+    schedule_maintenance(app.job_queue, compact_job, COMPACT_INTERVAL, COMPACT_JITTER)
+    if METRICS_PORT:
+        metrics_server = await metrics.serve(METRICS_HOST, METRICS_PORT + WORKER_ID)
+
+def instrument_handlers(app):
+    """Time every registered handler callback, including conversation steps."""
+    def wrap(handler):
+        if isinstance(handler, ConversationHandler):
+            for h in handler.entry_points + handler.fallbacks:
+                wrap(h)
+            for hs in handler.states.values():
+                for h in hs:
+                    wrap(h)
+        else:
+            handler.callback = metrics.timed(handler.callback)
+    for group in app.handlers.values():
+        for handler in group:
+            wrap(handler)
+
+async def on_shutdown(app):
+    if metrics_server is not None:
+        metrics_server.close()
+    # Sending stops first: delivery results still write to storage.
+    # Unsent messages stay in outbox.db for the next start
+    await broadcaster.close()
+    await outbox.close()
+    # Guaranteed final snapshot so the next start replays nothing
+    await storage.snapshot()
+    storage.close()
+
 def main():
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+    if WORKERS > 1:
+        # Only SQLite transactions are atomic across processes
+        if STORAGE != "sqlite":
+            raise SystemExit("❌ WORKERS > 1 needs STORAGE=sqlite")
+        if not WEBHOOK_URL:
+            raise SystemExit("❌ WORKERS > 1 needs WEBHOOK_URL, with router.py in front")
+        state_path = f"{DATA}/state-{WORKER_ID}.db"
+    else:
+        state_path = f"{DATA}/state.db"
+    
+    app = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(PerUserUpdateProcessor(CONCURRENT_UPDATES))
+        .persistence(SqlitePersistence(state_path, PERSIST_INTERVAL))
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
     
     # Basic commands
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("admin", admin))
     app.add_handler(CommandHandler("cancel", cancel))
+    app.add_handler(CommandHandler("find", find_user))
+    app.add_handler(CommandHandler("stats", stats))
+    app.add_handler(CommandHandler("payouts", payouts))
+    app.add_handler(CommandHandler("history", user_history))
+    app.add_handler(CommandHandler("campaign", campaign))
     
     # Callback queries
     app.add_handler(CallbackQueryHandler(check_join_callback, pattern="^check_join$"))
     app.add_handler(CallbackQueryHandler(cancel_proof_callback, pattern="^cancel_proof$"))
     app.add_handler(CallbackQueryHandler(wd_action, pattern="^(done|rej):"))
+    app.add_handler(CallbackQueryHandler(browse_users_callback, pattern="^ub:"))
+    app.add_handler(CallbackQueryHandler(payouts_callback, pattern="^pay:"))
+    app.add_handler(CallbackQueryHandler(broadcast_callback, pattern="^bc:(pause|resume|cancel|show):"))
+    
+    # Channel membership changes
+    app.add_handler(ChatMemberHandler(channel_member_update, ChatMemberHandler.CHAT_MEMBER))
     
     # User menu
     app.add_handler(MessageHandler(filters.Regex("^💰 Balance$"), balance))
+    app.add_handler(MessageHandler(filters.Regex("^📜 History$"), history))
     app.add_handler(MessageHandler(filters.Regex("^🆘 Support$"), support))
     
     # Admin menu
     app.add_handler(MessageHandler(filters.Regex("^👥 Total Users$"), total_users))
     app.add_handler(MessageHandler(filters.Regex("^📊 User Details$"), user_details))
+    app.add_handler(MessageHandler(filters.Regex("^💸 Pending Withdrawals$"), payouts))
+    app.add_handler(MessageHandler(filters.Regex("^🎯 Campaigns$"), campaign))
     app.add_handler(MessageHandler(filters.Regex("^🏠 Main Menu$"), start))
     
     # Submit Proof Conversation
@@ -809,7 +1944,9 @@ def main():
                 CallbackQueryHandler(cancel_proof_callback, pattern="^cancel_proof$")
             ]
         },
-        fallbacks=[CommandHandler("cancel", cancel)]
+        fallbacks=[CommandHandler("cancel", cancel)],
+        name="proof",
+        persistent=True
     )
     
     # Withdraw Conversation
@@ -820,7 +1957,9 @@ def main():
             WD_DETAIL: [MessageHandler(filters.TEXT & ~filters.COMMAND, wd_detail)],
             WD_AMOUNT: [MessageHandler(filters.TEXT & ~filters.COMMAND, wd_amount)]
         },
-        fallbacks=[CommandHandler("cancel", cancel)]
+        fallbacks=[CommandHandler("cancel", cancel)],
+        name="withdraw",
+        persistent=True
     )
     
     # Add Balance Conversation
@@ -830,7 +1969,9 @@ def main():
             ADD_BAL_USER: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_bal_user)],
             ADD_BAL_AMOUNT: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_bal_amount)]
         },
-        fallbacks=[CommandHandler("cancel", cancel)]
+        fallbacks=[CommandHandler("cancel", cancel)],
+        name="add_balance",
+        persistent=True
     )
     
     # Remove Balance Conversation
@@ -840,17 +1981,37 @@ def main():
             REM_BAL_USER: [MessageHandler(filters.TEXT & ~filters.COMMAND, rem_bal_user)],
             REM_BAL_AMOUNT: [MessageHandler(filters.TEXT & ~filters.COMMAND, rem_bal_amount)]
         },
-        fallbacks=[CommandHandler("cancel", cancel)]
+        fallbacks=[CommandHandler("cancel", cancel)],
+        name="remove_balance",
+        persistent=True
     )
     
     # Add Verified IDs Conversation
     ver_ids_conv = ConversationHandler(
         entry_points=[MessageHandler(filters.Regex("^📋 Add Verified IDs$"), add_verified_ids)],
         states={
-            ADD_VER_IDS: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_ver_ids)],
-            VER_AMOUNT: [MessageHandler(filters.TEXT & ~filters.COMMAND, ver_amount)]
+            ADD_VER_IDS: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, add_ver_ids),
+                MessageHandler(filters.Document.ALL, add_ver_file)
+            ],
+            VER_AMOUNT: [MessageHandler(filters.TEXT & ~filters.COMMAND, ver_amount)],
+            VER_CONFIRM: [CallbackQueryHandler(ver_confirm, pattern="^ver:(go|no)$")]
         },
-        fallbacks=[CommandHandler("cancel", cancel)]
+        fallbacks=[CommandHandler("cancel", cancel)],
+        name="verified_ids",
+        persistent=True
+    )
+    
+    # Broadcast Conversation
+    broadcast_conv = ConversationHandler(
+        entry_points=[MessageHandler(filters.Regex("^📢 Broadcast$"), broadcast)],
+        states={
+            BC_TEXT: [MessageHandler(filters.TEXT & ~filters.COMMAND, bc_text)],
+            BC_CONFIRM: [CallbackQueryHandler(bc_confirm, pattern="^bc:(go|no)$")]
+        },
+        fallbacks=[CommandHandler("cancel", cancel)],
+        name="broadcast",
+        persistent=True
     )
     
     # Add all conversation handlers
@@ -859,9 +2020,28 @@ def main():
     app.add_handler(add_bal_conv)
     app.add_handler(rem_bal_conv)
     app.add_handler(ver_ids_conv)
+    app.add_handler(broadcast_conv)
+    
+    instrument_handlers(app)
     
-    print("🤖 Bot is running...")
-    app.run_polling(allowed_updates=Update.ALL_TYPES)
+    if WORKERS > 1:
+        listen, port = "127.0.0.1", WORKER_PORT_BASE + WORKER_ID
+    else:
+        listen, port = WEBHOOK_LISTEN, WEBHOOK_PORT
+    
+    if WEBHOOK_URL:
+        print(f"🤖 Bot is running (webhook on {listen}:{port}/{WEBHOOK_PATH})...")
+        app.run_webhook(
+            listen=listen,
+            port=port,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=ALLOWED_UPDATES
+        )
+    else:
+        print("🤖 Bot is running...")
+        app.run_polling(allowed_updates=ALLOWED_UPDATES)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,174 @@
+import time
+import asyncio
+from storage import Transaction
+
+# ================= BROADCAST =================
+# A broadcast sends one text to every user who has not blocked the bot.
+# Recipients are streamed from storage a window at a time and queued in
+# the outbox, which does the rate limiting, flood-wait handling and
+# concurrency. Only `window` of a broadcast's messages are queued at once,
+# so admin notices and user notifications are never stuck behind it.
+#
+# The broadcasts table lives in outbox.db, and each window is queued in the
+# same transaction that advances the broadcast's cursor. A restart resumes
+# exactly after the last queued recipient, with nothing sent twice.
+# Any worker may start, pause or cancel a broadcast; the worker that
+# delivers the outbox also feeds the broadcasts.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS broadcasts (
+    id INTEGER PRIMARY KEY,
+    text TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'running',
+    cursor INTEGER NOT NULL DEFAULT 0,
+    total INTEGER NOT NULL DEFAULT 0,
+    queued INTEGER NOT NULL DEFAULT 0,
+    sent INTEGER NOT NULL DEFAULT 0,
+    blocked INTEGER NOT NULL DEFAULT 0,
+    failed INTEGER NOT NULL DEFAULT 0,
+    created INTEGER NOT NULL,
+    finished INTEGER
+);
+"""
+
+# Status: running <-> paused, then done or cancelled
+BROADCAST_COLS = "id, text, status, cursor, total, queued, sent, blocked, failed, created, finished"
+
+def broadcast_row(row):
+    if row is None:
+        return None
+    return dict(zip(BROADCAST_COLS.split(", "), row))
+
+class Broadcaster:
+    def __init__(self, outbox, storage, window=50, on_done=None):
+        self.outbox = outbox
+        self.storage = storage
+        self.window = window
+        # on_done(broadcast) once the last message of a broadcast is out
+        self.on_done = on_done
+        self.db = None
+        self.wake = asyncio.Event()
+        self.closing = False
+        self.worker = None
+
+    def open(self, feed=True):
+        """Use the outbox's database; feed=False only manages broadcasts."""
+        self.db = self.outbox.db
+        self.db.executescript(SCHEMA)
+        if feed:
+            self.worker = asyncio.create_task(self.run())
+
+    async def close(self):
+        if self.worker is not None:
+            self.closing = True
+            self.wake.set()
+            await asyncio.wait([self.worker], timeout=5)
+            self.worker.cancel()
+            self.worker = None
+
+    # ---- control ----
+    def active(self):
+        return broadcast_row(self.db.execute(
+            f"SELECT {BROADCAST_COLS} FROM broadcasts WHERE status IN ('running', 'paused') "
+            "ORDER BY id LIMIT 1"
+        ).fetchone())
+
+    def get(self, bid):
+        return broadcast_row(self.db.execute(
+            f"SELECT {BROADCAST_COLS} FROM broadcasts WHERE id = ?", (bid,)
+        ).fetchone())
+
+    def start(self, text):
+        """Start a broadcast. None if one is already running or paused."""
+        with Transaction(self.db) as t:
+            if self.active() is not None:
+                t.rollback()
+                return None
+            total = self.storage.totals()[0] - self.storage.count_blocked()
+            bid = self.db.execute(
+                "INSERT INTO broadcasts (text, total, created) VALUES (?, ?, ?)",
+                (text, total, int(time.time()))
+            ).lastrowid
+        self.wake.set()
+        return bid
+
+    def set_status(self, bid, status):
+        """Pause, resume or cancel. False if bid is already finished."""
+        with Transaction(self.db) as t:
+            cur = self.db.execute(
+                "UPDATE broadcasts SET status = ? WHERE id = ? AND status IN ('running', 'paused')",
+                (status, bid)
+            )
+            if cur.rowcount != 1:
+                t.rollback()
+                return False
+            if status == "cancelled":
+                self.outbox.drop(bid)
+                self.db.execute(
+                    "UPDATE broadcasts SET finished = ? WHERE id = ?", (int(time.time()), bid)
+                )
+        self.wake.set()
+        return True
+
+    def record(self, chat_id, tag, result):
+        """Outbox.on_result: count broadcast sends, remember blocked users."""
+        if result == "forbidden" and chat_id > 0:
+            self.storage.set_blocked(str(chat_id), True)
+        if tag:
+            col = {"ok": "sent", "forbidden": "blocked"}.get(result, "failed")
+            self.db.execute(f"UPDATE broadcasts SET {col} = {col} + 1 WHERE id = ?", (tag,))
+            self.wake.set()
+
+    # ---- feeding ----
+    def feed(self):
+        """Top up the running broadcast's window. Returns seconds to wait."""
+        b = self.active()
+        if b is None or b["status"] != "running":
+            return 1.0
+        bid = b["id"]
+        queued = self.outbox.pending(bid)
+        room = self.window - queued
+        # Refill in chunks rather than one message at a time
+        if room < self.window // 2:
+            return 0.5
+        batch = self.storage.recipients(b["cursor"], room)
+        if not batch:
+            if not queued:
+                self.finish(bid)
+            return 0.5
+        with Transaction(self.db) as t:
+            # Another worker may have paused or cancelled it meanwhile
+            cur = self.db.execute(
+                "UPDATE broadcasts SET cursor = ?, queued = queued + ? "
+                "WHERE id = ? AND status = 'running'",
+                (batch[-1][0], len(batch), bid)
+            )
+            if cur.rowcount != 1:
+                t.rollback()
+                return 0.5
+            self.outbox.queue(((int(uid), b["text"]) for _, uid in batch), tag=bid)
+        self.outbox.wake.set()
+        return 0.5
+
+    def finish(self, bid):
+        cur = self.db.execute(
+            "UPDATE broadcasts SET status = 'done', finished = ? WHERE id = ? AND status = 'running'",
+            (int(time.time()), bid)
+        )
+        if cur.rowcount == 1 and self.on_done is not None:
+            self.on_done(self.get(bid))
+
+    async def run(self):
+        while not self.closing:
+            self.wake.clear()
+            try:
+                delay = self.feed()
+            except Exception as e:
+                # e.g. the database is locked by another worker for too long
+                print(f"Broadcast: {e}")
+                delay = 5.0
+            try:
+                # Sends wake us early; other workers' pause/resume is polled
+                await asyncio.wait_for(self.wake.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
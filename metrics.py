@@ -0,0 +1,154 @@
+import time
+import asyncio
+import functools
+
+# ================= METRICS =================
+# In-process latency histograms and counters, exposed in Prometheus text
+# format on a local HTTP port and summarised by the admin /stats command.
+
+# Upper bounds in seconds, Prometheus-style cumulative buckets
+BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+    0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+
+class Histogram:
+    __slots__ = ("counts", "total", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)  # last one is +Inf
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        i = 0
+        while i < len(BUCKETS) and seconds > BUCKETS[i]:
+            i += 1
+        self.counts[i] += 1
+        self.total += seconds
+        self.count += 1
+
+    def quantile(self, q):
+        """Estimate from the buckets, interpolating inside the hit bucket."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        lower = 0.0
+        for i, n in enumerate(self.counts):
+            upper = BUCKETS[i] if i < len(BUCKETS) else BUCKETS[-1]
+            if n and seen + n >= rank:
+                return lower + (upper - lower) * (rank - seen) / n
+            seen += n
+            lower = upper
+        return BUCKETS[-1]
+
+# name -> {labels tuple -> Histogram / count}
+histograms = {}
+counters = {}
+
+def label_key(labels):
+    return tuple(sorted(labels.items()))
+
+def observe(name, seconds, **labels):
+    series = histograms.setdefault(name, {})
+    key = label_key(labels)
+    h = series.get(key)
+    if h is None:
+        h = series[key] = Histogram()
+    h.observe(seconds)
+
+def inc(name, amount=1, **labels):
+    series = counters.setdefault(name, {})
+    key = label_key(labels)
+    series[key] = series.get(key, 0) + amount
+
+def timed(fn, name=None):
+    """Wrap an async handler: latency into handler_seconds, exceptions into handler_errors_total."""
+    handler = name or fn.__name__
+
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await fn(*args, **kwargs)
+        except Exception:
+            inc("handler_errors_total", handler=handler)
+            raise
+        finally:
+            observe("handler_seconds", time.perf_counter() - start, handler=handler)
+    return wrapper
+
+def instrument(obj, methods, name):
+    """Time the given synchronous methods of obj into histogram `name`, label op=<method>."""
+    for method in methods:
+        fn = getattr(obj, method)
+
+        def wrapper(*args, _fn=fn, _op=method, **kwargs):
+            start = time.perf_counter()
+            try:
+                return _fn(*args, **kwargs)
+            finally:
+                observe(name, time.perf_counter() - start, op=_op)
+        setattr(obj, method, wrapper)
+
+# ---- exposition ----
+def fmt_labels(key, extra=()):
+    items = list(key) + list(extra)
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+def render():
+    lines = []
+    for name, series in sorted(histograms.items()):
+        lines.append(f"# TYPE {name} histogram")
+        for key, h in sorted(series.items()):
+            cumulative = 0
+            for i, n in enumerate(h.counts):
+                cumulative += n
+                le = str(BUCKETS[i]) if i < len(BUCKETS) else "+Inf"
+                lines.append(f"{name}_bucket{fmt_labels(key, [('le', le)])} {cumulative}")
+            lines.append(f"{name}_sum{fmt_labels(key)} {h.total}")
+            lines.append(f"{name}_count{fmt_labels(key)} {h.count}")
+    for name, series in sorted(counters.items()):
+        lines.append(f"# TYPE {name} counter")
+        for key, value in sorted(series.items()):
+            lines.append(f"{name}{fmt_labels(key)} {value}")
+    return "\n".join(lines) + "\n"
+
+def summary(name):
+    """[(label values, count, p50, p99)] for one histogram, busiest first."""
+    rows = []
+    for key, h in histograms.get(name, {}).items():
+        rows.append((",".join(str(v) for _, v in key), h.count, h.quantile(0.5), h.quantile(0.99)))
+    rows.sort(key=lambda r: -r[1])
+    return rows
+
+async def handle_http(reader, writer):
+    try:
+        request = await reader.readline()
+        # Drain the headers
+        while (await reader.readline()).strip():
+            pass
+        if request.split(b" ")[1:2] == [b"/metrics"]:
+            body = render().encode()
+            status = b"200 OK"
+        else:
+            body = b"not found\n"
+            status = b"404 Not Found"
+        writer.write(
+            b"HTTP/1.1 " + status + b"\r\n"
+            b"Content-Type: text/plain; version=0.0.4\r\n"
+            b"Content-Length: " + str(len(body)).encode() + b"\r\n"
+            b"Connection: close\r\n\r\n" + body
+        )
+        await writer.drain()
+    except Exception:
+        pass
+    finally:
+        writer.close()
+
+async def serve(host, port):
+    """Start the /metrics endpoint. Returns the asyncio server."""
+    return await asyncio.start_server(handle_http, host, port)
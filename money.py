@@ -0,0 +1,37 @@
+import re
+
+# ================= MONEY =================
+# Amounts are integers in paise (₹1 = 100) everywhere: storage, handlers,
+# callback data and the outbox. Sums are exact, and the data files hold
+# short integers instead of float reprs. Rupees only appear at the edges:
+# parse() for typed input and fmt() for display.
+
+AMOUNT_RE = re.compile(r'^(\d+)(?:\.(\d{1,2}))?$')
+# Largest amount parse() accepts (₹1 crore). Keeps typos like an extra
+# few zeros out of balances, which the JSON backend's indexes hold in
+# 35 bits (see storage.ROW_BITS)
+MAX_AMOUNT = 10 ** 9
+
+def parse(text):
+    """Paise from input like "12", "12.5" or "₹12.50".
+
+    ValueError for anything else, including negatives, more than two
+    decimal places and amounts over MAX_AMOUNT.
+    """
+    m = AMOUNT_RE.match(text.strip().lstrip("₹").strip())
+    if not m:
+        raise ValueError(text)
+    paise = int(m.group(1)) * 100 + int((m.group(2) or "0").ljust(2, "0"))
+    if paise > MAX_AMOUNT:
+        raise ValueError(text)
+    return paise
+
+def to_paise(rupees):
+    """Convert a legacy float rupee amount."""
+    return int(round(rupees * 100))
+
+def fmt(paise):
+    """1200 -> "12", 1250 -> "12.50", 5 -> "0.05"."""
+    sign = "-" if paise < 0 else ""
+    r, p = divmod(abs(paise), 100)
+    return f"{sign}{r}.{p:02d}" if p else f"{sign}{r}"
@@ -0,0 +1,298 @@
+import json
+import time
+import sqlite3
+import asyncio
+from telegram import InlineKeyboardMarkup
+from telegram.error import RetryAfter, Forbidden, NetworkError, TelegramError
+import metrics
+
+# ================= OUTBOX =================
+# Bot-initiated messages (admin notices, user notifications) are queued in
+# data/outbox.db and delivered by a background worker, so a handler never
+# waits on them and a restart does not lose them. Delivery respects a
+# token bucket per chat plus a global one, and backs off on RetryAfter.
+# With several bot workers they all queue into the same file and only one
+# of them delivers, so the rate limits hold for the bot as a whole.
+# Messages can carry a tag (a broadcast id) so a batch can be counted or
+# dropped as a whole; on_result hears how each message ended.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY,
+    chat_id INTEGER NOT NULL,
+    payload TEXT NOT NULL,
+    digest INTEGER NOT NULL DEFAULT 0,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    not_before REAL NOT NULL DEFAULT 0,
+    tag INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS outbox_due ON outbox(digest, not_before);
+CREATE INDEX IF NOT EXISTS outbox_chat ON outbox(digest, chat_id);
+"""
+TAG_INDEX = "CREATE INDEX IF NOT EXISTS outbox_tag ON outbox(tag) WHERE tag != 0"
+
+# Each chat's oldest message; the rest of a chat's queue waits behind it
+HEADS = "SELECT MIN(id) FROM outbox WHERE digest = 0 GROUP BY chat_id"
+
+MAX_ATTEMPTS = 8
+MAX_TEXT = 4000
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def wait_time(self):
+        """Seconds until a token is available (0 if one is now)."""
+        self._refill()
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self._refill()
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def pause(self, seconds):
+        """Empty the bucket for `seconds` (used after a RetryAfter)."""
+        self.tokens = -seconds * self.rate
+
+class Outbox:
+    def __init__(self, path, chat_rate=1.0, chat_burst=3, global_rate=25.0, concurrency=8):
+        self.path = path
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.buckets = {}
+        self.slots = asyncio.Semaphore(concurrency)
+        self.inflight = set()   # chats with a send in progress
+        self.tasks = set()
+        self.wake = asyncio.Event()
+        self.closing = False
+        self.bot = None
+        self.db = None
+        self.worker = None
+        # on_result(chat_id, tag, result) once a message is sent ("ok") or
+        # dropped ("forbidden": the user blocked the bot, or "error")
+        self.on_result = None
+
+    def open(self, bot, deliver=True):
+        """deliver=False only queues; another process sends."""
+        self.bot = bot
+        self.db = sqlite3.connect(self.path, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+        if "tag" not in {r[1] for r in self.db.execute("PRAGMA table_info(outbox)")}:
+            self.db.execute("ALTER TABLE outbox ADD COLUMN tag INTEGER NOT NULL DEFAULT 0")
+        self.db.execute(TAG_INDEX)
+        if deliver:
+            self.worker = asyncio.create_task(self.run())
+
+    async def close(self):
+        if self.worker is not None:
+            self.closing = True
+            self.wake.set()
+            await asyncio.wait([self.worker], timeout=5)
+            self.worker.cancel()
+            self.worker = None
+        if self.tasks:
+            await asyncio.wait(self.tasks, timeout=5)
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    def send(self, chat_id, text, reply_markup=None, digest=False):
+        """Queue a message. digest=True holds it for the next digest_flush()."""
+        payload = {"text": text}
+        if reply_markup is not None:
+            payload["markup"] = reply_markup.to_dict()
+        self.db.execute(
+            "INSERT INTO outbox (chat_id, payload, digest) VALUES (?, ?, ?)",
+            (chat_id, json.dumps(payload), int(digest))
+        )
+        if not digest:
+            self.wake.set()
+
+    def send_many(self, messages):
+        """Queue (chat_id, text) pairs in one transaction."""
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            self.queue(messages)
+            self.db.execute("COMMIT")
+        except:
+            self.db.execute("ROLLBACK")
+            raise
+        self.wake.set()
+
+    def queue(self, messages, tag=0):
+        """
+        Insert (chat_id, text) pairs without a transaction of its own, for
+        callers that commit them together with their own writes to this
+        database. Call wake.set() after committing.
+        """
+        self.db.executemany(
+            "INSERT INTO outbox (chat_id, payload, tag) VALUES (?, ?, ?)",
+            ((chat_id, json.dumps({"text": text}), tag) for chat_id, text in messages)
+        )
+
+    def pending(self, tag=None):
+        if tag is None:
+            return self.db.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+        return self.db.execute("SELECT COUNT(*) FROM outbox WHERE tag = ?", (tag,)).fetchone()[0]
+
+    def drop(self, tag):
+        """Remove the unsent messages of a tag. Returns how many."""
+        return self.db.execute("DELETE FROM outbox WHERE tag = ?", (tag,)).rowcount
+
+    def digest_flush(self, title):
+        """Fold held digest messages into one summary message per chat."""
+        rows = self.db.execute(
+            "SELECT id, chat_id, payload FROM outbox WHERE digest = 1 ORDER BY id"
+        ).fetchall()
+        if not rows:
+            return
+        by_chat = {}
+        for _, chat_id, payload in rows:
+            by_chat.setdefault(chat_id, []).append(json.loads(payload)["text"])
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            for chat_id, texts in by_chat.items():
+                for chunk in digest_chunks(title, texts):
+                    self.db.execute(
+                        "INSERT INTO outbox (chat_id, payload) VALUES (?, ?)",
+                        (chat_id, json.dumps({"text": chunk}))
+                    )
+            self.db.execute(
+                "DELETE FROM outbox WHERE digest = 1 AND id <= ?", (rows[-1][0],)
+            )
+            self.db.execute("COMMIT")
+        except:
+            self.db.execute("ROLLBACK")
+            raise
+        self.wake.set()
+
+    def bucket(self, chat_id):
+        b = self.buckets.get(chat_id)
+        if b is None:
+            b = self.buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return b
+
+    async def run(self):
+        while not self.closing:
+            self.wake.clear()
+            now = time.time()
+            # Only each chat's oldest message is a candidate, so a chat with
+            # a backlog takes one of the 200 places rather than all of them
+            rows = self.db.execute(
+                "SELECT id, chat_id, payload, attempts, tag FROM outbox "
+                f"WHERE id IN ({HEADS}) AND not_before <= ? ORDER BY id LIMIT 200",
+                (now,)
+            ).fetchall()
+            waits = [1.0]
+            skipped = set()
+            for row in rows:
+                if self.closing:
+                    break
+                chat_id = row[1]
+                # Keep per-chat order: nothing overtakes an earlier message
+                if chat_id in self.inflight or chat_id in skipped:
+                    skipped.add(chat_id)
+                    continue
+                bucket = self.bucket(chat_id)
+                if bucket.wait_time() > 0:
+                    waits.append(bucket.wait_time())
+                    skipped.add(chat_id)
+                    continue
+                await asyncio.sleep(self.global_bucket.wait_time())
+                self.global_bucket.take()
+                bucket.take()
+                await self.slots.acquire()
+                self.inflight.add(chat_id)
+                task = asyncio.create_task(self.deliver(*row))
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+            if not rows:
+                nxt = self.db.execute(
+                    f"SELECT MIN(not_before) FROM outbox WHERE id IN ({HEADS})"
+                ).fetchone()[0]
+                if nxt is not None:
+                    waits.append(max(nxt - now, 0.05))
+            try:
+                await asyncio.wait_for(self.wake.wait(), min(waits))
+            except asyncio.TimeoutError:
+                pass
+
+    async def deliver(self, row_id, chat_id, payload, attempts, tag):
+        start = time.perf_counter()
+        result = "error"
+        final = True
+        try:
+            if tag and self.db.execute("SELECT 1 FROM outbox WHERE id = ?", (row_id,)).fetchone() is None:
+                # Dropped (a cancelled broadcast) after it was picked up
+                result = "dropped"
+                return
+            data = json.loads(payload)
+            markup = data.get("markup")
+            await self.bot.send_message(
+                chat_id,
+                data["text"],
+                reply_markup=InlineKeyboardMarkup.de_json(markup, self.bot) if markup else None
+            )
+            result = "ok"
+            self.db.execute("DELETE FROM outbox WHERE id = ?", (row_id,))
+        except RetryAfter as e:
+            result = "retry_after"
+            # Flood control: hold this chat (and the message) back
+            self.bucket(chat_id).pause(e.retry_after)
+            final = self.retry_later(row_id, attempts, e.retry_after, count=False)
+        except Forbidden:
+            # Blocked by the user (or removed from the chat)
+            result = "forbidden"
+            self.db.execute("DELETE FROM outbox WHERE id = ?", (row_id,))
+        except NetworkError as e:
+            print(f"Outbox: network error sending to {chat_id} (attempt {attempts + 1}): {e}")
+            final = self.retry_later(row_id, attempts, min(2 ** attempts, 300))
+        except TelegramError as e:
+            print(f"Outbox: dropping message to {chat_id}: {e}")
+            self.db.execute("DELETE FROM outbox WHERE id = ?", (row_id,))
+        finally:
+            metrics.observe("send_seconds", time.perf_counter() - start, result=result)
+            self.inflight.discard(chat_id)
+            self.slots.release()
+            self.wake.set()
+        if final and self.on_result is not None:
+            self.on_result(chat_id, tag, result)
+
+    def retry_later(self, row_id, attempts, delay, count=True):
+        """Reschedule a message. False if it is kept, True if given up on."""
+        if count and attempts + 1 >= MAX_ATTEMPTS:
+            print(f"Outbox: giving up on message {row_id} after {attempts + 1} attempts")
+            self.db.execute("DELETE FROM outbox WHERE id = ?", (row_id,))
+            return True
+        self.db.execute(
+            "UPDATE outbox SET attempts = ?, not_before = ? WHERE id = ?",
+            (attempts + int(count), time.time() + delay, row_id)
+        )
+        return False
+
+def digest_chunks(title, texts):
+    """Join texts under title, split so each message stays under MAX_TEXT."""
+    head = f"{title} ({len(texts)})\n━━━━━━━━━━━━━━\n\n"
+    chunk = head
+    for text in texts:
+        part = text[:MAX_TEXT - len(head) - 2] + "\n\n"
+        if len(chunk) + len(part) > MAX_TEXT:
+            yield chunk.rstrip()
+            chunk = head
+        chunk += part
+    if chunk != head:
+        yield chunk.rstrip()
@@ -0,0 +1,204 @@
+import os, json
+import time
+import sqlite3
+import asyncio
+from telegram.ext import BasePersistence, PersistenceInput
+
+# ================= PERSISTENCE =================
+# Conversation states and user_data survive restarts in data/state.db.
+# The Application hands over what changed every update_interval seconds
+# (and everything on shutdown); only rows whose content actually changed
+# are written, all of one round in a single transaction. Users with empty
+# user_data have no row at all. Rows carry the time they last changed, so
+# purge() can drop what was abandoned halfway.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS user_data (
+    uid INTEGER PRIMARY KEY,
+    data TEXT NOT NULL,
+    updated INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS conversations (
+    name TEXT NOT NULL,
+    key TEXT NOT NULL,
+    state TEXT NOT NULL,
+    updated INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (name, key)
+) WITHOUT ROWID;
+"""
+
+def encode(value):
+    return json.dumps(value, separators=(",", ":"), sort_keys=True)
+
+class SqlitePersistence(BasePersistence):
+    """user_data and conversations only; values must be JSON-serialisable."""
+
+    def __init__(self, path, update_interval=30):
+        super().__init__(
+            store_data=PersistenceInput(
+                bot_data=False, chat_data=False, user_data=True, callback_data=False
+            ),
+            update_interval=update_interval
+        )
+        self.path = path
+        self.db = None
+        # What is on disk, encoded, so unchanged data is never rewritten
+        self.user_rows = {}
+        self.conv_rows = {}
+        self.pending = []
+        self.commit_scheduled = False
+
+    def connect(self):
+        if self.db is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self.db = sqlite3.connect(self.path, isolation_level=None)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.executescript(SCHEMA)
+            for table in ("user_data", "conversations"):
+                if "updated" not in {r[1] for r in self.db.execute(f"PRAGMA table_info({table})")}:
+                    # Rows from before purging existed count as changed now
+                    self.db.execute(f"ALTER TABLE {table} ADD COLUMN updated INTEGER NOT NULL DEFAULT 0")
+                    self.db.execute(f"UPDATE {table} SET updated = ?", (int(time.time()),))
+        return self.db
+
+    def stage(self, sql, args):
+        # Writes of one update_persistence round arrive as concurrent
+        # coroutines; commit them together on the next loop iteration
+        self.pending.append((sql, args))
+        if not self.commit_scheduled:
+            self.commit_scheduled = True
+            asyncio.get_running_loop().call_soon(self.commit)
+
+    def commit(self):
+        self.commit_scheduled = False
+        if not self.pending:
+            return
+        writes, self.pending = self.pending, []
+        db = self.connect()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            for sql, args in writes:
+                db.execute(sql, args)
+            db.execute("COMMIT")
+        except:
+            db.execute("ROLLBACK")
+            raise
+
+    # ---- user_data ----
+    async def get_user_data(self):
+        data = {}
+        for uid, blob in self.connect().execute("SELECT uid, data FROM user_data"):
+            self.user_rows[uid] = blob
+            data[uid] = json.loads(blob)
+        return data
+
+    async def update_user_data(self, user_id, data):
+        if not data:
+            await self.drop_user_data(user_id)
+            return
+        blob = encode(data)
+        if self.user_rows.get(user_id) == blob:
+            return
+        self.user_rows[user_id] = blob
+        self.stage(
+            "INSERT INTO user_data (uid, data, updated) VALUES (?, ?, ?) "
+            "ON CONFLICT(uid) DO UPDATE SET data = excluded.data, updated = excluded.updated",
+            (user_id, blob, int(time.time()))
+        )
+
+    async def drop_user_data(self, user_id):
+        if self.user_rows.pop(user_id, None) is not None:
+            self.stage("DELETE FROM user_data WHERE uid = ?", (user_id,))
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    # ---- conversations ----
+    async def get_conversations(self, name):
+        convs = {}
+        rows = self.connect().execute(
+            "SELECT key, state FROM conversations WHERE name = ?", (name,)
+        )
+        for key, state in rows:
+            self.conv_rows[(name, key)] = state
+            convs[tuple(json.loads(key))] = json.loads(state)
+        return convs
+
+    async def update_conversation(self, name, key, new_state):
+        row = (name, encode(list(key)))
+        if new_state is None:
+            if self.conv_rows.pop(row, None) is not None:
+                self.stage("DELETE FROM conversations WHERE name = ? AND key = ?", row)
+            return
+        state = encode(new_state)
+        if self.conv_rows.get(row) == state:
+            return
+        self.conv_rows[row] = state
+        self.stage(
+            "INSERT INTO conversations (name, key, state, updated) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(name, key) DO UPDATE SET state = excluded.state, updated = excluded.updated",
+            row + (state, int(time.time()))
+        )
+
+    def purge(self, before):
+        """
+        Delete user_data and conversation states that last changed before
+        unix time `before`. Returns the uids whose user_data went, for the
+        caller to drop from the Application too; a purged conversation
+        lives on in memory until it ends or the bot restarts.
+        """
+        self.commit()
+        db = self.connect()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            uids = [r[0] for r in db.execute(
+                "DELETE FROM user_data WHERE updated < ? RETURNING uid", (before,)
+            )]
+            convs = db.execute(
+                "DELETE FROM conversations WHERE updated < ? RETURNING name, key", (before,)
+            ).fetchall()
+            db.execute("COMMIT")
+        except:
+            db.execute("ROLLBACK")
+            raise
+        for uid in uids:
+            self.user_rows.pop(uid, None)
+        for row in convs:
+            self.conv_rows.pop(row, None)
+        return uids
+
+    async def flush(self):
+        # Called once on shutdown, after the final update round
+        self.commit()
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    # ---- not stored ----
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
@@ -0,0 +1,124 @@
+import time
+from collections import OrderedDict
+from outbox import TokenBucket
+
+# ================= PRECHECK =================
+# Cheap in-memory gate in front of proof_link: floods and re-submissions
+# of a link are turned away before storage is touched or the admin is told.
+# Links are compared in a normalised form so trivial variations (tracking
+# parameters, telegram.me vs t.me, letter case of the bot username, a
+# trailing slash) count as the same link.
+#
+# The state lives in this process only. With several workers (users are
+# routed to one by hash) a link sent by two users on different workers
+# passes both gates; what keeps it from paying twice is storage, where
+# consume_verified_id removes the ID and credits the balance in one
+# transaction, so the second claim finds no ID and is rejected. "taken"
+# is a shortcut for the common single-process case, not that guarantee.
+
+# Query parameters that never identify a referral
+TRACKING_PARAMS = {"fbclid", "gclid", "yclid", "igshid", "si", "feature", "ref_src", "mc_cid", "mc_eid"}
+TG_HOSTS = {"t.me", "telegram.me", "telegram.dog"}
+
+def is_tracking(name):
+    name = name.lower()
+    return name in TRACKING_PARAMS or name.startswith("utm_")
+
+def normalise(link):
+    """Canonical form of a link, used as its identity for duplicate checks."""
+    s = link.strip()
+    # str.partition instead of urlsplit: several times faster on unique links
+    scheme, sep, rest = s.partition("://")
+    if not sep:
+        if "." not in s.split("/", 1)[0]:
+            return s  # bare referral code
+        scheme, rest = "https", s
+    scheme = scheme.lower()
+    rest, _, query = rest.split("#", 1)[0].partition("?")
+    host, _, path = rest.partition("/")
+    host = host.rpartition("@")[2].split(":", 1)[0].lower()
+    if host.startswith("www."):
+        host = host[4:]
+    path = ("/" + path).rstrip("/")
+    # Raw "k=v" pairs are enough for an identity; no need to decode them
+    query = [p for p in query.split("&") if p and not is_tracking(p.split("=", 1)[0])]
+    if scheme == "tg" and host == "resolve":
+        # tg://resolve?domain=SomeBot&start=123 is t.me/SomeBot?start=123
+        domain = [p for p in query if p.startswith("domain=")]
+        host = "t.me"
+        path = "/" + (domain[0][7:] if domain else "")
+        query = [p for p in query if not p.startswith("domain=")]
+    if host in TG_HOSTS:
+        host = "t.me"
+        # Usernames are case-insensitive; start parameters are not
+        path = path.lower()
+    query.sort()
+    return host + path + ("?" + "&".join(query) if query else "")
+
+class Precheck:
+    """
+    Per user: a token bucket (`rate` submissions per second, up to `burst`
+    at once) and the last `per_user` links they sent. Globally: the last
+    `size` links anyone sent. A link stays known for `ttl` seconds once it
+    earned a credit and `retry_ttl` once it was rejected, so a link that is
+    rejected because its ID is not verified yet can be tried again later.
+    Everything is LRU-bounded: at most `users` users are tracked. Only
+    links sent to this process are known (see above).
+    """
+    def __init__(self, rate, burst, ttl, retry_ttl, per_user=16, size=200000, users=50000):
+        self.rate = rate
+        self.burst = burst
+        self.ttl = ttl
+        self.retry_ttl = retry_ttl
+        self.per_user = per_user
+        self.size = size
+        self.users = users
+        self.recent = OrderedDict()    # link hash -> (uid, expires_at)
+        self.by_user = OrderedDict()   # uid -> (TokenBucket, {hash: expires_at}, oldest first)
+
+    def user_state(self, uid):
+        state = self.by_user.get(uid)
+        if state is None:
+            state = self.by_user[uid] = (TokenBucket(self.rate, self.burst), {})
+            if len(self.by_user) > self.users:
+                self.by_user.popitem(last=False)
+        else:
+            self.by_user.move_to_end(uid)
+        return state
+
+    def check(self, uid, link):
+        """
+        (key, reason). reason is None when the link may go on to storage,
+        else "rate" (flooding, key is None), "repeat" (this user sent it
+        recently) or "taken" (another user sent it recently). Pass key to
+        record().
+        """
+        bucket, links = self.user_state(uid)
+        if not bucket.take():
+            return None, "rate"
+        key = hash(normalise(link))
+        now = time.monotonic()
+        expires = links.get(key)
+        if expires is not None and expires > now:
+            return key, "repeat"
+        seen = self.recent.get(key)
+        if seen is not None and seen[1] > now:
+            return key, "repeat" if seen[0] == uid else "taken"
+        return key, None
+
+    def retry_in(self, uid):
+        """Seconds until uid may submit again."""
+        return self.user_state(uid)[0].wait_time()
+
+    def record(self, uid, key, credited):
+        """Remember a link that went through storage, and whether it paid."""
+        expires = time.monotonic() + (self.ttl if credited else self.retry_ttl)
+        links = self.user_state(uid)[1]
+        links.pop(key, None)
+        links[key] = expires
+        if len(links) > self.per_user:
+            del links[next(iter(links))]
+        self.recent[key] = (uid, expires)
+        self.recent.move_to_end(key)
+        if len(self.recent) > self.size:
+            self.recent.popitem(last=False)
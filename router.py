@@ -0,0 +1,121 @@
+import os, json
+import asyncio
+
+# ================= ROUTER =================
+# Sits where the single bot's webhook server used to be and forwards every
+# Telegram update to one of WORKERS bot processes, picked by user id, so a
+# user's updates (and their conversation state) always reach the same
+# worker. Worker i listens on 127.0.0.1:WORKER_PORT_BASE+i.
+#
+#   WORKERS=4 python router.py
+#   WORKERS=4 WORKER_ID=<0..3> STORAGE=sqlite WEBHOOK_URL=... python bot.py
+
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WORKERS = int(os.getenv("WORKERS", "1"))
+WORKER_PORT_BASE = int(os.getenv("WORKER_PORT_BASE", "8450"))
+
+SECRET_HEADER = "x-telegram-bot-api-secret-token"
+MAX_BODY = 1 << 20
+
+def update_user_id(update):
+    """The user an update belongs to (0 if none), as PTB's effective_user sees it."""
+    member = update.get("chat_member") or update.get("my_chat_member")
+    if member:
+        # Joins and leaves concern the member, whoever made the change
+        return member["new_chat_member"]["user"]["id"]
+    for key in ("message", "edited_message", "callback_query", "inline_query"):
+        part = update.get(key)
+        if part and "from" in part:
+            return part["from"]["id"]
+    return 0
+
+def worker_port(update):
+    return WORKER_PORT_BASE + update_user_id(update) % WORKERS
+
+async def read_request(reader):
+    """(method, path, headers, body) or None at end of connection."""
+    line = await reader.readline()
+    if not line:
+        return None
+    method, path = line.decode("latin-1").split(" ")[:2]
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if not line.strip():
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get("content-length", "0"))
+    if length > MAX_BODY:
+        raise ValueError("body too large")
+    body = await reader.readexactly(length) if length else b""
+    return method, path, headers, body
+
+async def forward(port, body):
+    """POST body to the worker's webhook. Returns its status line."""
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    try:
+        head = (
+            f"POST /{WEBHOOK_PATH} HTTP/1.1\r\n"
+            f"Host: 127.0.0.1:{port}\r\n"
+            "Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n"
+        )
+        if WEBHOOK_SECRET:
+            head += f"X-Telegram-Bot-Api-Secret-Token: {WEBHOOK_SECRET}\r\n"
+        writer.write(head.encode() + b"\r\n" + body)
+        await writer.drain()
+        status = (await reader.readline()).decode("latin-1").split(" ", 1)[1].strip()
+        await reader.read()
+        return status
+    finally:
+        writer.close()
+
+def respond(writer, status):
+    writer.write(
+        f"HTTP/1.1 {status}\r\nContent-Length: 0\r\n\r\n".encode()
+    )
+
+async def handle(reader, writer):
+    # Telegram keeps connections open and sends one update per request
+    try:
+        while True:
+            request = await read_request(reader)
+            if request is None:
+                break
+            method, path, headers, body = request
+            if method != "POST" or path.rstrip("/") != f"/{WEBHOOK_PATH}":
+                respond(writer, "404 Not Found")
+            elif WEBHOOK_SECRET and headers.get(SECRET_HEADER) != WEBHOOK_SECRET:
+                respond(writer, "403 Forbidden")
+            else:
+                try:
+                    port = worker_port(json.loads(body))
+                except (ValueError, KeyError, TypeError):
+                    respond(writer, "400 Bad Request")
+                else:
+                    try:
+                        respond(writer, await forward(port, body))
+                    except OSError as e:
+                        # Telegram retries the update later
+                        print(f"Router: worker on port {port} unavailable: {e}")
+                        respond(writer, "502 Bad Gateway")
+            await writer.drain()
+    except (ValueError, asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+async def serve():
+    server = await asyncio.start_server(handle, WEBHOOK_LISTEN, WEBHOOK_PORT)
+    print(f"🔀 Routing {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{WEBHOOK_PATH} to {WORKERS} worker(s) "
+          f"on ports {WORKER_PORT_BASE}-{WORKER_PORT_BASE + WORKERS - 1}")
+    async with server:
+        await server.serve_forever()
+
+if __name__ == "__main__":
+    asyncio.run(serve())
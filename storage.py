@@ -0,0 +1,2124 @@
+import os, json
+import sys
+import time
+import zlib
+import sqlite3
+import asyncio
+import heapq
+import tarfile
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from itertools import accumulate, groupby, islice
+from collections import Counter, namedtuple
+from operator import itemgetter
+from money import to_paise
+from usertable import User, UserTable, build as build_table
+
+# ================= STORAGE =================
+# Handlers talk to a Storage object instead of the data files. Users are
+# User records (usertable.py) read like dicts: user["balance"], "proofs",
+# "name", "username". Verified IDs map an ID string to the amount paid for
+# it, and belong to a campaign (MAIN unless the admin picked another). All
+# amounts are integer paise (see money.py).
+#
+# Every balance change is recorded in a ledger with one of these kinds:
+PROOF = "proof"                # verified proof credit (ref = verified ID)
+WITHDRAW = "withdraw"          # withdrawal request debit
+REFUND = "refund"              # rejected / failed withdrawal
+ADMIN_ADD = "admin_add"
+ADMIN_REMOVE = "admin_remove"
+PAID = "paid"                  # approved withdrawal, no balance change
+# What Storage.history reports; ref is the verified ID for proofs and the
+# withdrawal request id for withdrawals, refunds and payouts
+HISTORY_KINDS = {PROOF, WITHDRAW, REFUND, ADMIN_ADD, ADMIN_REMOVE, PAID}
+
+# A campaign has a payout for IDs uploaded without their own amount and a
+# ttl: its IDs expire that many seconds after they were added (0: never).
+# Campaign dicts also carry counters: ids / pool (IDs and paise waiting to
+# be claimed), claimed / paid, expired.
+MAIN = "main"
+CAMPAIGN_FIELDS = ("name", "amount", "ttl", "ids", "pool", "claimed", "paid", "expired")
+
+class Storage:
+    """Interface shared by the JSON and SQLite backends."""
+
+    def open(self):
+        pass
+
+    async def flush(self):
+        pass
+
+    def flush_due(self):
+        return False
+
+    async def snapshot(self):
+        pass
+
+    async def backup(self, path):
+        """
+        Write the users and verified IDs as they are now to path: a .tar.gz
+        of the files a data directory starts from.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    # ---- users ----
+    def get_user(self, uid):
+        raise NotImplementedError
+
+    def ensure_user(self, uid, name, username):
+        """Create the user if missing. Returns (user, created)."""
+        raise NotImplementedError
+
+    def adjust_balance(self, uid, delta, kind, clamp=False):
+        """
+        Add delta to a balance in one step and record it in the ledger
+        under `kind`. Returns the new balance, or None if the user does not
+        exist or a debit would go below zero. With clamp=True an oversized
+        debit empties the balance instead.
+        """
+        raise NotImplementedError
+
+    def browse_users(self, sort, limit, after=None, before=None):
+        """
+        One page of (uid, user) pairs, largest first, by "balance",
+        "proofs" or "new" (join order); ties newest first. after / before
+        are the browse_cursor of a user on the page next to it: the page
+        starts right after that user or ends right before them. Neither
+        gives the first page. Each page costs the same however deep it is.
+        """
+        raise NotImplementedError
+
+    def search_users(self, query, limit):
+        """Users whose id equals query or whose username or name starts with it."""
+        raise NotImplementedError
+
+    async def prepare_indexes(self):
+        """
+        Have what browse_users / search_users need ready without blocking
+        the event loop. Call it after startup and before either of them.
+        """
+
+    def totals(self):
+        """
+        (users, balance, proofs, verified ids, verified amount), kept as
+        running counters by every mutation so this is O(1).
+        """
+        raise NotImplementedError
+
+    def version(self, data):
+        """
+        A value that changes whenever `data` does, including changes made
+        by other workers, for caches of rendered data: "totals" (what
+        totals() returns) or "users" (the users browse_users pages
+        through). Cheap: it scans no table, though a backend may need a
+        small query to learn of other workers' writes.
+        """
+        raise NotImplementedError
+
+    def reconcile(self):
+        """
+        Recount the totals from the data, reset the counters to the true
+        values and return {field: (counter, actual)} for any that drifted.
+        """
+        raise NotImplementedError
+
+    # ---- verified ids ----
+    def find_verified(self, runs):
+        """
+        Return (verified ID, campaign) for an unexpired ID contained in a
+        link, or None. runs are the link's digit runs
+        (validator.check(link).ids).
+        """
+        raise NotImplementedError
+
+    def consume_verified_id(self, vid, uid):
+        """
+        Remove vid from the pool and credit its amount to uid as a proof.
+        Returns the amount, or None if vid was already gone.
+        """
+        raise NotImplementedError
+
+    def add_verified_ids(self, ids, amount, campaign=MAIN):
+        """Insert or re-price ids. Returns how many were new."""
+        return self.add_verified(((vid, amount) for vid in ids), campaign)
+
+    def add_verified(self, pairs, campaign=MAIN):
+        """
+        Insert or re-price (vid, amount) pairs in a campaign, moving IDs
+        that were in another one. An ID expires its campaign's ttl after it
+        was first added. Returns how many were new.
+        """
+        raise NotImplementedError
+
+    def expire_verified(self, before, limit):
+        """
+        Remove up to `limit` verified IDs added before unix time `before`,
+        oldest first. Returns how many. Re-pricing an ID keeps its age.
+        """
+        raise NotImplementedError
+
+    def evict_expired(self, now, limit):
+        """
+        Remove up to `limit` verified IDs whose campaign ttl ran out by
+        unix time `now`, soonest first, without scanning the rest of the
+        pool. Returns how many.
+        """
+        raise NotImplementedError
+
+    def count_verified(self):
+        raise NotImplementedError
+
+    # ---- campaigns ----
+    def set_campaign(self, name, amount, ttl):
+        """Create a campaign or change its payout and ttl (for IDs added from now on)."""
+        raise NotImplementedError
+
+    def campaigns(self):
+        """Every campaign as a dict of CAMPAIGN_FIELDS, MAIN first."""
+        raise NotImplementedError
+
+    # ---- withdrawals ----
+    def request_withdrawal(self, uid, amount, method, detail):
+        """
+        Debit amount from uid and queue a pending withdrawal request in
+        one step. Returns (request id, new balance), or None if the user
+        does not exist or cannot cover it.
+        """
+        raise NotImplementedError
+
+    def resolve_withdrawals(self, rids, approve):
+        """
+        Mark pending requests paid, or rejected with the amount refunded.
+        Returns the requests that were still pending; the rest are skipped,
+        so a request is never paid or refunded twice.
+        """
+        raise NotImplementedError
+
+    def pending_withdrawals(self, method=None, below=None):
+        """
+        Pending requests oldest first, optionally only one method and/or
+        amounts under `below`. Each is a dict: id, uid, amount, method,
+        detail, ts.
+        """
+        raise NotImplementedError
+
+    # ---- history ----
+    def history(self, uid, limit):
+        """
+        The last `limit` ledger events of uid, newest first. Each is a
+        dict: kind (one of HISTORY_KINDS), amount (signed), ts, ref.
+        """
+        raise NotImplementedError
+
+    # ---- broadcasts ----
+    def recipients(self, after, limit):
+        """
+        Up to `limit` (cursor, uid) pairs of users who have not blocked
+        the bot, in signup order, starting after cursor `after` (0 for the
+        beginning). Cursors stay valid across restarts.
+        """
+        raise NotImplementedError
+
+    def set_blocked(self, uid, blocked):
+        """Mark uid as having blocked the bot, or not. True if it changed."""
+        raise NotImplementedError
+
+    def is_blocked(self, uid):
+        raise NotImplementedError
+
+    def count_blocked(self):
+        raise NotImplementedError
+
+STAT_FIELDS = ("users", "balance", "proofs", "verified", "verified_amount")
+
+def browse_cursor(sort, user):
+    """(sort key, row) of a user from browse_users, to page on from them."""
+    return (user.row if sort == "new" else user[sort]), user.row
+
+def drift(counted, actual):
+    return {
+        f: (c, a) for f, c, a in zip(STAT_FIELDS, counted, actual)
+        if abs(c - a) > 1e-6
+    }
+
+SORTS = ("new", "balance", "proofs")
+
+def candidate_ids(runs, lengths):
+    """
+    Every substring of the digit runs whose length is one of `lengths`, in
+    the order they appear. Verified IDs are digit strings, so `vid in link`
+    holds exactly when vid is one of these; checking them against an index
+    costs O(len(link) * len(lengths)) however large the pool is.
+    """
+    for run in runs:
+        for n in lengths:
+            for i in range(len(run) - n + 1):
+                yield run[i:i + n]
+
+# ================= JSON BACKEND =================
+class SortedIndex:
+    """
+    Sorted multiset of ints kept in array("q") buckets of ~LOAD items, so
+    inserts and removals move a small array instead of the whole index,
+    and an entry costs 8 bytes rather than a tuple and its objects. With
+    key, entries are ordered by key(entry) (rows by their name, say);
+    without, by value.
+    """
+    LOAD = 512
+
+    def __init__(self, items=(), key=None):
+        """items: entries already in order."""
+        self.key = key
+        items = array("q", items)
+        self.lists = [items[i:i + self.LOAD] for i in range(0, len(items), self.LOAD)]
+        self.maxes = [self._key(lst[-1]) for lst in self.lists]
+        self.size = len(items)
+
+    def _key(self, item):
+        return item if self.key is None else self.key(item)
+
+    def __len__(self):
+        return self.size
+
+    def add(self, item):
+        self.size += 1
+        k = self._key(item)
+        if not self.lists:
+            self.lists.append(array("q", [item]))
+            self.maxes.append(k)
+            return
+        i = min(bisect_left(self.maxes, k), len(self.maxes) - 1)
+        lst = self.lists[i]
+        insort(lst, item, key=self.key)
+        self.maxes[i] = self._key(lst[-1])
+        if len(lst) > 2 * self.LOAD:
+            self.lists[i:i + 1] = [lst[:self.LOAD], lst[self.LOAD:]]
+            self.maxes[i:i + 1] = [self._key(lst[self.LOAD - 1]), self.maxes[i]]
+
+    def remove(self, item):
+        k = self._key(item)
+        i = bisect_left(self.maxes, k)
+        if i == len(self.maxes):
+            return
+        lst = self.lists[i]
+        j = bisect_left(lst, k, key=self.key)
+        if j == len(lst) or lst[j] != item:
+            return
+        del lst[j]
+        self.size -= 1
+        if lst:
+            self.maxes[i] = self._key(lst[-1])
+        else:
+            del self.lists[i]
+            del self.maxes[i]
+
+    def replace(self, old, new):
+        self.remove(old)
+        self.add(new)
+
+    def from_key(self, k):
+        """Iterate ascending from the first entry whose key is >= k."""
+        i = bisect_left(self.maxes, k)
+        if i == len(self.maxes):
+            return
+        lst = self.lists[i]
+        yield from lst[bisect_left(lst, k, key=self.key):]
+        for lst in self.lists[i + 1:]:
+            yield from lst
+
+    def below(self, item, limit):
+        """Up to limit entries smaller than item (all if None), largest first."""
+        out = []
+        i = len(self.lists)
+        if item is not None:
+            k = self._key(item)
+            i = bisect_left(self.maxes, k)
+            if i < len(self.lists):
+                lst = self.lists[i]
+                j = bisect_left(lst, k, key=self.key)
+                out.extend(reversed(lst[max(j - limit, 0):j]))
+        for m in range(i - 1, -1, -1):
+            if len(out) >= limit:
+                break
+            lst = self.lists[m]
+            out.extend(reversed(lst[max(len(lst) - (limit - len(out)), 0):]))
+        return out
+
+    def above(self, item, limit):
+        """Up to limit entries larger than item, smallest first."""
+        out = []
+        k = self._key(item)
+        i = bisect_right(self.maxes, k)
+        for m in range(i, len(self.lists)):
+            lst = self.lists[m]
+            j = bisect_right(lst, k, key=self.key) if m == i else 0
+            out.extend(lst[j:j + limit - len(out)])
+            if len(out) >= limit:
+                break
+        return out
+
+# browse_users' indexes hold value << ROW_BITS | row, so sorting them
+# sorts by value, then row; balances stay below 2**35 paise
+ROW_BITS = 28
+ROW_MASK = (1 << ROW_BITS) - 1
+
+def by_value(value, row):
+    return value << ROW_BITS | row
+
+# Index builds sort this many rows at a time and merge the runs: the GIL
+# is let go between chunks and no object per user outlives its chunk
+INDEX_CHUNK = 16384
+
+def value_order(column):
+    """by_value(value, row) of every row of a column, sorted, as an array."""
+    runs = [
+        array("q", sorted(by_value(v, a + i) for i, v in enumerate(column[a:a + INDEX_CHUNK])))
+        for a in range(0, len(column), INDEX_CHUNK)
+    ]
+    return array("q", heapq.merge(*runs))
+
+def text_orders(records, fields):
+    """
+    For each of fields, the rows of the records (given in row order)
+    whose text there is non-empty, sorted by (folded text, row), as an
+    array. A chunk's texts are kept as one UTF-8 blob, which sorts the
+    same as the strings, rather than a string per row.
+    """
+    runs = [[] for _ in fields]
+    row = 0
+    while True:
+        part = list(islice(records, INDEX_CHUNK))
+        if not part:
+            break
+        for out, f in zip(runs, fields):
+            keyed = sorted(
+                (t.encode("utf-8", "surrogatepass"), row + i)
+                for i, t in enumerate(fold(r[f]) for r in part) if t
+            )
+            blob = b"".join(map(itemgetter(0), keyed))
+            offsets = array("q", accumulate(map(len, map(itemgetter(0), keyed)), initial=0))
+            slices = map(slice, offsets, islice(offsets, 1, None))
+            out.append(zip(map(blob.__getitem__, slices), array("q", map(itemgetter(1), keyed))))
+        row += len(part)
+    return [array("q", map(itemgetter(1), heapq.merge(*out))) for out in runs]
+
+def fold(text):
+    return (text or "").casefold()
+
+def atomic_write(p, blob):
+    """
+    Write via temp file + fsync + rename so p is never half-written.
+    blob is text, bytes or a list of byte chunks.
+    """
+    tmp = f"{p}.tmp"
+    with open(tmp, "w" if isinstance(blob, str) else "wb") as f:
+        if isinstance(blob, list):
+            f.writelines(blob)
+        else:
+            f.write(blob)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, p)
+    fd = os.open(os.path.dirname(p) or ".", os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def write_backup(p, files):
+    """
+    A .tar.gz of (name, open file) pairs at p, written like atomic_write.
+    Closes the files; open handles keep reading a file another thread
+    replaces or removes meanwhile.
+    """
+    tmp = f"{p}.tmp"
+    try:
+        with open(tmp, "wb") as f:
+            with tarfile.open(fileobj=f, mode="w:gz") as tar:
+                for name, src in files:
+                    info = tar.gettarinfo(arcname=name, fileobj=src)
+                    tar.addfile(info, src)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, p)
+    finally:
+        for _, src in files:
+            src.close()
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+def read_json(p, d):
+    if not os.path.exists(p):
+        return d
+    with open(p) as f:
+        return json.load(f)
+
+def compact(rec):
+    return json.dumps(rec, separators=(",", ":"))
+
+def new_campaign(name, amount, ttl):
+    camp = dict.fromkeys(CAMPAIGN_FIELDS, 0)
+    camp.update(name=name, amount=amount, ttl=ttl)
+    return camp
+
+def campaign_lists(campaign_of):
+    """{vid: campaign} as {campaign: [vid, ...]}, for snapshot.json."""
+    lists = {}
+    for vid, name in campaign_of.items():
+        lists.setdefault(name, []).append(vid)
+    return lists
+
+def stamp_runs(stamps):
+    """Consecutive equal timestamps as [[ts, count], ...]."""
+    return [[ts, sum(1 for _ in run)] for ts, run in groupby(stamps)]
+
+def unstamp_runs(runs):
+    # One int object per run, shared by its IDs
+    stamps = []
+    for ts, count in runs:
+        stamps += [ts] * count
+    return stamps
+
+# Preset dictionary for .hist blocks: most blocks are a few short records,
+# too small for deflate to find repeats in on its own. Existing files can
+# only be read with exactly these bytes, so never change them.
+HIST_ZDICT = (
+    b'{"p":null}{"p":[0000000,"t":"user","n":"un":null,"t":"vset","p":[["'
+    b'"t":"paid","w":"t":"refund","t":"admin_remove","t":"admin_add",'
+    b'"t":"withdraw","m":"UPI","m":"VSV","m":"FXL","d":"@upi"'
+    b'"t":"proof","v":"u":"1","a":-,"s":1,"ts":17'
+)
+
+# What snapshot_state takes on the event loop for write_snapshot and
+# install_table: the table file name, the snapshot.json blob, the new
+# users, {row: (balance, proofs)}, the heads taken and them by row
+SnapshotState = namedtuple("SnapshotState", "table blob added values heads rows")
+
+def pack_block(data):
+    z = zlib.compressobj(6, zlib.DEFLATED, -15, zdict=HIST_ZDICT)
+    return z.compress(data) + z.flush()
+
+def unpack_block(blob):
+    z = zlib.decompressobj(-15, zdict=HIST_ZDICT)
+    return z.decompress(blob) + z.flush()
+
+class JsonStorage(Storage):
+    """
+    Verified IDs and withdrawals live in memory; users live in a memory-
+    mapped user table (usertable.py) and are cached in `users` once read.
+    Each mutation is appended as one line to the ledger (data/ledger/
+    <first seq>.jsonl) and applied by the same code that replays it on
+    startup. snapshot() writes data/users-<seq>.dat from the previous
+    table plus the users that changed, then the rest to data/snapshot.json
+    atomically, and starts a new ledger segment; old segments are kept as
+    the audit trail. Opening costs the same whatever the number of users;
+    the indexes behind browse_users / search_users are built in a thread
+    by prepare_indexes, 8 bytes per entry.
+
+    Once the snapshot covers a segment it is compacted into <first>.hist:
+    one deflate block per user with all their records from that segment,
+    headed by {"p": [segment, offset, size]} of the user's previous block
+    (<first>.idx lists the blocks until a snapshot has them in the table).
+    heads holds the newest blocks the table does not have yet and offsets
+    the byte offsets of records in uncompacted segments, so history()
+    reads a user's last N events without touching anyone else's.
+
+    Amounts are paise; a snapshot without "money": "paise" (or the old
+    users.json / verified.json) holds rupee floats, as does the ledger
+    after it. load_state converts those once and open() writes a paise
+    snapshot straight away, so rupee records are never replayed again.
+    Snapshots from before the user table (users inline) are loaded whole
+    and rewritten the same way.
+
+    Ledger records: {"s": seq, "ts": time, "t": kind, ...}
+      user:      u, n (name), un (username)
+      vset:      p ([vid, amount] pairs; older ledgers have vadd: ids, a),
+                 c (campaign, if not MAIN)
+      vexp:      ids (verified IDs that expired)
+      camp:      c (campaign), a (payout), ttl
+      <money>:   u, a (signed delta), v (verified ID, proofs only),
+                 m, d (method, detail: a withdrawal request, id = its s),
+                 w (request id, refund of a rejected request)
+      paid:      w (request id), u (older ledgers lack it)
+      block, unblock: u
+    """
+    def __init__(self, data_dir, flush_batch=200):
+        self.data_dir = data_dir
+        self.snapshot_path = f"{data_dir}/snapshot.json"
+        self.ledger_dir = f"{data_dir}/ledger"
+        self.flush_batch = flush_batch
+        # Users read from the table or created since, by uid; added lists
+        # the created ones, whose rows follow the table's
+        self.table = None
+        self.users = {}
+        self.added = []
+        # Users whose balance changed since the last snapshot
+        self.dirty = set()
+        self.verified = {}
+        # When each verified ID was added, in the same order as verified,
+        # which is oldest first: new IDs go to the end and re-pricing one
+        # keeps its place (snapshot.json holds them as stamp_runs)
+        self.verified_at = {}
+        # Campaigns by name; campaign_of has the IDs outside MAIN. IDs of a
+        # campaign with a ttl have their deadline in expires and a
+        # (deadline, vid) entry in expiry_heap; entries whose ID has gone
+        # or moved are skipped when they come up
+        self.camps = {MAIN: new_campaign(MAIN, 0, 0)}
+        self.campaign_of = {}
+        self.expires = {}
+        self.expiry_heap = []
+        # Pending withdrawal requests by id
+        self.withdrawals = {}
+        # Users who blocked the bot; broadcasts skip them
+        self.blocked = set()
+        # How many verified IDs exist of each length, for find_verified
+        self.id_lengths = Counter()
+        # Running totals, see Storage.totals
+        self.stats = dict.fromkeys(STAT_FIELDS, 0)
+        # Secondary indexes for browse_users / search_users over rows (see
+        # SortedIndex, by_value), built by prepare_indexes in a thread
+        # (or build_indexes on first use) and then kept up to date by _apply
+        self.indexed = False
+        self.indexing = None
+        self.by_balance = SortedIndex()
+        self.by_proofs = SortedIndex()
+        self.by_username = SortedIndex(key=self.username_key)
+        self.by_name = SortedIndex(key=self.name_key)
+        self.seq = 0
+        # Set by load_state when it converted rupee data to paise
+        self.converted = False
+        # First seq in paise when load_state converted (older are rupees)
+        self.paise_from = 0
+        # History index: uid -> newest compacted block [segment, offset,
+        # size] not in the table yet / [(segment, offset), ...] of records
+        # not compacted yet
+        self.heads = {}
+        self.offsets = {}
+        # Newest compacted segment that heads account for
+        self.history_seg = 0
+        # Segments the snapshot covers that are still to be compacted
+        self.sealed = []
+        self.ledger = None
+        self.ledger_first = 0
+        self.ledger_pos = 0
+        self.changes = 0
+        # Bumped by every change, see snapshot
+        self.writes = 0
+        # Bumped by every change to a user, see version
+        self.user_writes = 0
+        # (seq, writes) the last snapshot was taken at; snapshot skips
+        # writing another while they are the same
+        self.snapshot_at = None
+        # Timer, batch, snapshot and shutdown work must not overlap
+        self.flush_lock = asyncio.Lock()
+        self.compact_lock = asyncio.Lock()
+
+    # ---- persistence ----
+    def segments(self, ext=".jsonl"):
+        names = sorted(n for n in os.listdir(self.ledger_dir) if n.endswith(ext))
+        return [(int(n.split(".")[0]), f"{self.ledger_dir}/{n}") for n in names]
+
+    def segment_path(self, first, ext=".jsonl"):
+        return f"{self.ledger_dir}/{first:012d}{ext}"
+
+    def load_state(self):
+        """Materialise users/verified from the snapshot plus ledger replay."""
+        os.makedirs(self.ledger_dir, exist_ok=True)
+        snap = {}
+        if os.path.exists(self.snapshot_path):
+            snap = read_json(self.snapshot_path, {})
+            if "table" in snap:
+                self.table = UserTable(f"{self.data_dir}/{snap['table']}")
+            else:
+                self.load_users(snap["users"])
+            self.verified = snap["verified"]
+            if "verified_at" in snap:
+                self.verified_at = dict(zip(self.verified, unstamp_runs(snap["verified_at"])))
+            if "campaigns" in snap:
+                self.camps = snap["campaigns"]
+                self.campaign_of = {
+                    vid: name for name, vids in snap["campaign_of"].items() for vid in vids
+                }
+                self.expires = snap["expires"]
+                self.expiry_heap = [(t, vid) for vid, t in self.expires.items()]
+                heapq.heapify(self.expiry_heap)
+            self.seq = snap["seq"]
+            self.withdrawals = {
+                int(rid): req for rid, req in sorted(
+                    snap.get("withdrawals", {}).items(), key=lambda kv: int(kv[0])
+                )
+            }
+            self.blocked = set(snap.get("blocked", ()))
+            self.heads = snap.get("heads", {})
+            self.history_seg = snap.get("hist", 0)
+            self.paise_from = snap.get("paise_from", 0)
+        else:
+            # First start after the flat-file layout
+            self.load_users(read_json(f"{self.data_dir}/users.json", {}))
+            self.verified = read_json(f"{self.data_dir}/verified.json", {})
+            self.seq = 0
+        self.snapshot_at = (self.seq, 0)
+        if len(self.verified_at) != len(self.verified):
+            # IDs from before expiry existed count as added now
+            self.verified_at = dict.fromkeys(self.verified, int(time.time()))
+        self.id_lengths = Counter(len(vid) for vid in self.verified)
+        rupees = snap.get("money") != "paise"
+        if "stats" in snap and not rupees:
+            self.stats = snap["stats"]
+        else:
+            self.stats = dict(zip(STAT_FIELDS, self.count_totals()))
+
+        segs = self.segments()
+        self.load_heads({first for first, _ in segs})
+        self.sealed = []
+        for i, (first, path) in enumerate(segs):
+            # Skip segments that end before the snapshot
+            if i + 1 < len(segs) and segs[i + 1][0] <= self.seq + 1:
+                self.sealed.append((first, path))
+                continue
+            pos = 0
+            tail = None
+            with open(path, "rb") as f:
+                for line in f:
+                    try:
+                        rec = json.loads(line)
+                    except ValueError:
+                        rec = None  # torn last line from a crash
+                    if rec is not None:
+                        self._index(rec, first, pos)
+                        if rec["s"] > self.seq:
+                            self._apply(rec)
+                            self.seq = rec["s"]
+                    if not line.endswith(b"\n"):
+                        tail = pos, rec
+                    pos += len(line)
+            if tail is not None:
+                # Finish or cut off the last line, or the next record
+                # appended to this segment would run into it
+                with open(path, "r+b") as f:
+                    if tail[1] is None:
+                        f.truncate(tail[0])
+                    else:
+                        f.seek(0, os.SEEK_END)
+                        f.write(b"\n")
+
+        if rupees and (self.users or self.verified or self.withdrawals):
+            for user in self.users.values():
+                user.balance = to_paise(user.balance)
+            for vid, amount in self.verified.items():
+                self.verified[vid] = to_paise(amount)
+            for req in self.withdrawals.values():
+                req["amount"] = to_paise(req["amount"])
+            self.stats = dict(zip(STAT_FIELDS, self.count_totals()))
+            self.converted = True
+            self.paise_from = self.seq + 1
+        if "campaigns" not in snap:
+            # Everything so far is in MAIN
+            self.recount_campaigns()
+
+    def load_users(self, users):
+        """Users of an older snapshot, {uid: dict}, all held in memory."""
+        for uid, u in users.items():
+            self.users[uid] = User(u["name"], u["username"], u["balance"], u["proofs"], len(self.added))
+            self.added.append(uid)
+
+    def load_heads(self, uncompacted):
+        """Bring heads up to date with segments compacted after the snapshot."""
+        for first, path in self.segments(".hist"):
+            idx = self.segment_path(first, ".idx")
+            if first in uncompacted:
+                # Compaction was cut short; it is redone from the segment
+                for p in (path, idx):
+                    if os.path.exists(p):
+                        os.remove(p)
+            elif first > self.history_seg:
+                for uid, block in read_json(idx, {}).items():
+                    if uid:
+                        self.heads[uid] = [first] + block
+                self.history_seg = first
+
+    def table_orders(self, table):
+        """
+        The entries of by_balance, by_proofs, by_username and by_name over
+        the rows of table as it was written, each as one sorted array.
+        Reads nothing else, so it can run in a thread while the event loop
+        carries on.
+        """
+        if table is None:
+            return [array("q")] * 4
+        return [
+            value_order(table.balance),
+            value_order(table.proofs),
+            *text_orders(table.records(), (2, 1)),
+        ]
+
+    def install_indexes(self, orders, table):
+        """Index table_orders(table) and add what changed since table was written."""
+        # The buckets live as long as the indexes, so they are cut here
+        # rather than in the thread, whose heap is then free to shrink
+        self.by_balance = SortedIndex(orders[0])
+        self.by_proofs = SortedIndex(orders[1])
+        self.by_username = SortedIndex(orders[2], key=self.username_key)
+        self.by_name = SortedIndex(orders[3], key=self.name_key)
+        n = len(table) if table is not None else 0
+        for u in self.users.values():
+            if u.row < n:
+                b, p = table.balance[u.row], table.proofs[u.row]
+                if b != u.balance:
+                    self.by_balance.replace(by_value(b, u.row), by_value(u.balance, u.row))
+                if p != u.proofs:
+                    self.by_proofs.replace(by_value(p, u.row), by_value(u.proofs, u.row))
+            else:
+                self.by_balance.add(by_value(u.balance, u.row))
+                self.by_proofs.add(by_value(u.proofs, u.row))
+                if u.username:
+                    self.by_username.add(u.row)
+                if u.name:
+                    self.by_name.add(u.row)
+        if table is not None:
+            # Building read every page of the table; RSS need not keep them
+            table.release()
+        self.indexed = True
+
+    def build_indexes(self):
+        """Index every user on the spot, for a browse_users / search_users before prepare_indexes."""
+        self.install_indexes(self.table_orders(self.table), self.table)
+
+    async def prepare_indexes(self):
+        # Compaction and snapshots swap the table under compact_lock; the
+        # loop applies changes meanwhile, which install_indexes adds
+        if self.indexed:
+            return
+        if self.indexing is None:
+            async def build():
+                async with self.compact_lock:
+                    if not self.indexed:
+                        table = self.table
+                        orders = await asyncio.to_thread(self.table_orders, table)
+                        self.install_indexes(orders, table)
+            self.indexing = asyncio.ensure_future(build())
+        await asyncio.shield(self.indexing)
+
+    def row_names(self, row):
+        """[uid, name, username] of a row."""
+        n = len(self.table) if self.table is not None else 0
+        if row < n:
+            return self.table.names(row)
+        uid = self.added[row - n]
+        user = self.users[uid]
+        return [uid, user.name, user.username]
+
+    def name_key(self, row):
+        return fold(self.row_names(row)[1]), row
+
+    def username_key(self, row):
+        return fold(self.row_names(row)[2]), row
+
+    def open(self):
+        self.load_state()
+        if self.converted or self.table is None:
+            # Pin the unit before any paise record is appended, and move
+            # users held in memory into a table
+            state = self.snapshot_state()
+            self.install_table(self.write_snapshot(state), state)
+            self.snapshot_at = (self.seq, self.writes)
+        self._new_segment()
+        # Covered by the snapshot but not compacted yet: left over from a
+        # stop in between, or from before compaction existed
+        for first, path in self.sealed:
+            self.install_history(first, path, self.compact_segment(first, path))
+        self.sealed = []
+
+    def _new_segment(self):
+        if self.ledger is not None:
+            self.ledger.close()
+        self.ledger_first = self.seq + 1
+        path = self.segment_path(self.ledger_first)
+        self.ledger = open(path, "a")
+        self.ledger_pos = os.path.getsize(path)
+
+    def _log(self, rec):
+        rec["s"] = self.seq + 1
+        rec["ts"] = int(time.time())
+        # compact() escapes non-ASCII, so characters are bytes
+        line = compact(rec) + "\n"
+        # Written before it is applied, so a failed write leaves memory
+        # as it was
+        try:
+            self.ledger.write(line)
+            self.ledger.flush()
+        except OSError:
+            self._rewind()
+            raise
+        self.seq += 1
+        self._index(rec, self.ledger_first, self.ledger_pos)
+        self._apply(rec)
+        self.ledger_pos += len(line)
+        self.changes += 1
+        self.writes += 1
+
+    def _rewind(self):
+        """Cut off whatever part of a failed write reached the open segment."""
+        try:
+            # Drops the unwritten rest of the line along with the file
+            self.ledger.close()
+        except OSError:
+            pass
+        path = self.segment_path(self.ledger_first)
+        os.truncate(path, self.ledger_pos)
+        self.ledger = open(path, "a")
+
+    def _index(self, rec, first, pos):
+        if rec["t"] in HISTORY_KINDS and "u" in rec:
+            offs = self.offsets.get(rec["u"])
+            if offs is None:
+                offs = self.offsets[rec["u"]] = []
+            offs.append((first, pos))
+
+    def _apply(self, rec):
+        t = rec["t"]
+        stats = self.stats
+        if t == "user":
+            uid = rec["u"]
+            self.users[uid] = User(rec["n"], rec["un"], row=self.count_users())
+            self.added.append(uid)
+            self.user_writes += 1
+            stats["users"] += 1
+            if self.indexed:
+                row = self.users[uid].row
+                self.by_balance.add(by_value(0, row))
+                self.by_proofs.add(by_value(0, row))
+                if rec["un"]:
+                    self.by_username.add(row)
+                if rec["n"]:
+                    self.by_name.add(row)
+        elif t == "vadd" or t == "vset":
+            pairs = rec["p"] if t == "vset" else ((vid, rec["a"]) for vid in rec["ids"])
+            name = rec.get("c", MAIN)
+            camp = self.camps[name]
+            for vid, amount in pairs:
+                old = self.verified.get(vid)
+                if old is None:
+                    self.id_lengths[len(vid)] += 1
+                    self.verified_at[vid] = rec["ts"]
+                    stats["verified"] += 1
+                    old = 0
+                else:
+                    prev = self.camps[self.campaign_of.get(vid, MAIN)]
+                    prev["ids"] -= 1
+                    prev["pool"] -= old
+                stats["verified_amount"] += amount - old
+                self.verified[vid] = amount
+                camp["ids"] += 1
+                camp["pool"] += amount
+                if name == MAIN:
+                    self.campaign_of.pop(vid, None)
+                else:
+                    self.campaign_of[vid] = name
+                self._set_deadline(vid, self.verified_at[vid] + camp["ttl"] if camp["ttl"] else 0)
+        elif t == "vexp":
+            for vid in rec["ids"]:
+                if vid in self.verified:
+                    self._drop_verified(vid)["expired"] += 1
+        elif t == "camp":
+            camp = self.camps.get(rec["c"])
+            if camp is None:
+                camp = self.camps[rec["c"]] = new_campaign(rec["c"], 0, 0)
+            camp["amount"] = rec["a"]
+            camp["ttl"] = rec["ttl"]
+        elif t == PAID:
+            del self.withdrawals[rec["w"]]
+        elif t == "block":
+            self.blocked.add(rec["u"])
+        elif t == "unblock":
+            self.blocked.discard(rec["u"])
+        else:
+            uid = rec["u"]
+            user = self.user(uid)
+            self.dirty.add(uid)
+            self.user_writes += 1
+            if self.indexed:
+                self.by_balance.replace(
+                    by_value(user.balance, user.row), by_value(user.balance + rec["a"], user.row)
+                )
+            user.balance += rec["a"]
+            stats["balance"] += rec["a"]
+            if t == PROOF:
+                if self.indexed:
+                    self.by_proofs.replace(
+                        by_value(user.proofs, user.row), by_value(user.proofs + 1, user.row)
+                    )
+                user.proofs += 1
+                stats["proofs"] += 1
+                camp = self._drop_verified(rec["v"])
+                camp["claimed"] += 1
+                camp["paid"] += rec["a"]
+            elif t == WITHDRAW and "m" in rec:
+                self.withdrawals[rec["s"]] = {
+                    "id": rec["s"], "uid": uid, "amount": -rec["a"],
+                    "method": rec["m"], "detail": rec["d"], "ts": rec["ts"]
+                }
+            elif t == REFUND and "w" in rec:
+                del self.withdrawals[rec["w"]]
+
+    def _drop_verified(self, vid):
+        """Take vid out of the pool. Returns its campaign."""
+        amount = self.verified.pop(vid)
+        del self.verified_at[vid]
+        self.expires.pop(vid, None)
+        camp = self.camps[self.campaign_of.pop(vid, MAIN)]
+        camp["ids"] -= 1
+        camp["pool"] -= amount
+        self.stats["verified"] -= 1
+        self.stats["verified_amount"] -= amount
+        self.id_lengths[len(vid)] -= 1
+        if not self.id_lengths[len(vid)]:
+            del self.id_lengths[len(vid)]
+        return camp
+
+    def _set_deadline(self, vid, deadline):
+        if not deadline:
+            self.expires.pop(vid, None)
+        elif self.expires.get(vid) != deadline:
+            self.expires[vid] = deadline
+            heapq.heappush(self.expiry_heap, (deadline, vid))
+
+    def recount_campaigns(self):
+        for camp in self.camps.values():
+            camp["ids"] = camp["pool"] = 0
+        for vid, amount in self.verified.items():
+            camp = self.camps[self.campaign_of.get(vid, MAIN)]
+            camp["ids"] += 1
+            camp["pool"] += amount
+
+    def flush_due(self):
+        return self.changes >= self.flush_batch
+
+    async def flush(self):
+        """Group-commit: fsync everything appended since the last flush."""
+        async with self.flush_lock:
+            if not self.changes:
+                return
+            self.changes = 0
+            await asyncio.to_thread(os.fsync, self.ledger.fileno())
+
+    def snapshot_state(self):
+        """
+        Everything a snapshot writes, taken on the event loop so no handler
+        changes it midway: the snapshot.json blob and the user table rows
+        that differ from the current table.
+        """
+        table = f"users-{self.seq:012d}.dat"
+        n = len(self.table) if self.table is not None else 0
+        users = self.users
+        added = []
+        for uid in self.added:
+            u = users[uid]
+            added.append((uid, u.name, u.username, u.balance, u.proofs))
+        values = {
+            u.row: (u.balance, u.proofs)
+            for u in (users[uid] for uid in self.dirty) if u.row < n
+        }
+        heads = dict(self.heads)
+        rows = {self.user(uid).row: block for uid, block in heads.items()}
+        self.dirty = set()
+        blob = compact({
+            "seq": self.seq,
+            "money": "paise",
+            "stats": self.stats,
+            "table": table,
+            "verified": self.verified,
+            "verified_at": stamp_runs(self.verified_at.values()),
+            "campaigns": self.camps,
+            "campaign_of": campaign_lists(self.campaign_of),
+            "expires": self.expires,
+            "withdrawals": self.withdrawals,
+            "blocked": sorted(self.blocked),
+            "hist": self.history_seg,
+            "paise_from": self.paise_from,
+        })
+        return SnapshotState(table, blob, added, values, heads, rows)
+
+    def write_snapshot(self, state):
+        """Write the user table, then snapshot.json. Returns the new table."""
+        path = f"{self.data_dir}/{state.table}"
+        atomic_write(path, build_table(self.table, state.added, state.values, state.rows))
+        atomic_write(self.snapshot_path, state.blob)
+        return UserTable(path)
+
+    def install_table(self, table, state):
+        """Read users from the new table; forget what it made redundant."""
+        old = self.table
+        self.table = table
+        self.added = self.added[len(state.added):]
+        # Keep only users changed (or created) since snapshot_state
+        n = len(table)
+        self.users = {
+            uid: u for uid, u in self.users.items() if uid in self.dirty or u.row >= n
+        }
+        for uid, block in state.heads.items():
+            if self.heads.get(uid) is block:
+                del self.heads[uid]
+        if old is not None:
+            old.close()
+        for name in os.listdir(self.data_dir):
+            if name.startswith("users-") and name.endswith(".dat") and name != state.table:
+                os.remove(f"{self.data_dir}/{name}")
+
+    async def snapshot(self):
+        async with self.flush_lock:
+            if (self.seq, self.writes) == self.snapshot_at:
+                # Nothing logged or recounted since: the files on disk are current
+                return
+            # Later records go to a fresh segment
+            at = (self.seq, self.writes)
+            state = self.snapshot_state()
+            covered = self.history_seg
+            old = self.ledger
+            old.flush()
+            self.ledger = None
+            self._new_segment()
+            self.changes = 0
+            await asyncio.to_thread(os.fsync, old.fileno())
+            old.close()
+            table = await asyncio.to_thread(self.write_snapshot, state)
+            # Compaction may be reading the old table in a thread
+            async with self.compact_lock:
+                self.install_table(table, state)
+            self.snapshot_at = at
+            # The table has the heads these lists were kept for
+            for first, path in self.segments(".idx"):
+                if first <= covered:
+                    os.remove(path)
+        # Everything but the open segment is now covered by the snapshot
+        async with self.compact_lock:
+            for first, path in self.segments()[:-1]:
+                entries = await asyncio.to_thread(self.compact_segment, first, path)
+                self.install_history(first, path, entries)
+
+    async def backup(self, path):
+        await self.snapshot()
+        # A snapshot writes the table before snapshot.json, both under
+        # flush_lock; open them as a pair and compress outside it
+        async with self.flush_lock:
+            files = [
+                ("snapshot.json", open(self.snapshot_path, "rb")),
+                (os.path.basename(self.table.path), open(self.table.path, "rb")),
+            ]
+        await asyncio.to_thread(write_backup, path, files)
+
+    def compact_segment(self, first, path):
+        """
+        Write <first>.hist and <first>.idx for a sealed segment (see the
+        class docstring). Returns the block list: {uid: [offset, size]},
+        with records that belong to no user under "".
+        """
+        groups = {}
+        with open(path, "rb") as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    continue
+                groups.setdefault(rec.get("u", ""), []).append(line.rstrip(b"\n"))
+        blob = bytearray()
+        entries = {}
+        for uid, lines in groups.items():
+            head = compact({"p": self.head(uid) if uid else None}).encode()
+            block = pack_block(b"\n".join([head] + lines))
+            entries[uid] = [len(blob), len(block)]
+            blob += block
+        atomic_write(self.segment_path(first, ".hist"), bytes(blob))
+        atomic_write(self.segment_path(first, ".idx"), compact(entries))
+        return entries
+
+    def install_history(self, first, path, entries):
+        """Point heads at a freshly compacted segment and drop the original."""
+        for uid, block in entries.items():
+            if not uid:
+                continue
+            self.heads[uid] = [first] + block
+            offs = self.offsets.get(uid)
+            if offs:
+                n = 0
+                while n < len(offs) and offs[n][0] == first:
+                    n += 1
+                del offs[:n]
+                if not offs:
+                    del self.offsets[uid]
+        self.history_seg = first
+        os.remove(path)
+
+    def close(self):
+        if self.ledger is not None:
+            self.ledger.flush()
+            os.fsync(self.ledger.fileno())
+            self.ledger.close()
+            self.ledger = None
+        if self.table is not None:
+            self.table.close()
+            self.table = None
+
+    # ---- users ----
+    def user(self, uid):
+        """uid's record, read from the table the first time."""
+        user = self.users.get(uid)
+        if user is None and self.table is not None:
+            user = self.table.get(uid)
+            if user is not None:
+                self.users[uid] = user
+        return user
+
+    def count_users(self):
+        return (len(self.table) if self.table is not None else 0) + len(self.added)
+
+    def uid_at(self, row):
+        n = len(self.table) if self.table is not None else 0
+        return self.table.names(row)[0] if row < n else self.added[row - n]
+
+    def user_columns(self):
+        """Lists of every user's uid, name, username, balance and proofs."""
+        if self.table is not None:
+            uids, names, usernames, balance, proofs = self.table.columns()
+        else:
+            uids, names, usernames, balance, proofs = [], [], [], [], []
+        # Cached users of the table replace their row's values
+        n = len(uids)
+        for u in self.users.values():
+            if u.row < n:
+                balance[u.row] = u.balance
+                proofs[u.row] = u.proofs
+        for uid in self.added:
+            u = self.users[uid]
+            uids.append(uid)
+            names.append(u.name)
+            usernames.append(u.username)
+            balance.append(u.balance)
+            proofs.append(u.proofs)
+        return uids, names, usernames, balance, proofs
+
+    def head(self, uid):
+        """uid's newest compacted history block, or None."""
+        block = self.heads.get(uid)
+        if block is None and self.table is not None:
+            user = self.users.get(uid)
+            row = user.row if user is not None else self.table.find(uid)
+            if row is not None and row < len(self.table):
+                block = self.table.head(row)
+        return block
+
+    def get_user(self, uid):
+        return self.user(uid)
+
+    def ensure_user(self, uid, name, username):
+        user = self.user(uid)
+        if user is not None:
+            return user, False
+        self._log({"t": "user", "u": uid, "n": name, "un": username})
+        return self.users[uid], True
+
+    def adjust_balance(self, uid, delta, kind, clamp=False):
+        user = self.user(uid)
+        if user is None:
+            return None
+        if user.balance + delta < 0:
+            if not clamp:
+                return None
+            delta = -user.balance
+        self._log({"t": kind, "u": uid, "a": delta})
+        return user.balance
+
+    def browse_users(self, sort, limit, after=None, before=None):
+        if sort == "new":
+            # Rows are join order already
+            if before is not None:
+                top = min(before[1] + limit, self.count_users() - 1)
+                rows = range(top, before[1], -1)
+            else:
+                end = after[1] if after is not None else self.count_users()
+                rows = range(end - 1, max(end - limit, 0) - 1, -1)
+        else:
+            if not self.indexed:
+                self.build_indexes()
+            index = self.by_balance if sort == "balance" else self.by_proofs
+            if before is not None:
+                items = index.above(by_value(*before), limit)[::-1]
+            else:
+                items = index.below(by_value(*after) if after is not None else None, limit)
+            rows = [item & ROW_MASK for item in items]
+        uids = [self.uid_at(row) for row in rows]
+        return [(uid, self.user(uid)) for uid in uids]
+
+    def search_users(self, query, limit):
+        query = query.strip().lstrip("@")
+        found = {}
+        user = self.user(query)
+        if user is not None:
+            found[query] = user
+        if not self.indexed:
+            self.build_indexes()
+        key = fold(query)
+        for index in (self.by_username, self.by_name):
+            for row in index.from_key((key,)):
+                if len(found) >= limit or not index.key(row)[0].startswith(key):
+                    break
+                uid = self.uid_at(row)
+                if uid not in found:
+                    found[uid] = self.user(uid)
+        return list(found.items())[:limit]
+
+    def totals(self):
+        return tuple(self.stats[f] for f in STAT_FIELDS)
+
+    def version(self, data):
+        # Single process: every change goes through _log or reconcile
+        if data == "totals":
+            return self.totals()
+        return self.user_writes
+
+    def count_totals(self):
+        table = self.table
+        n = len(table) if table is not None else 0
+        balance = sum(table.balance) if n else 0
+        proofs = sum(table.proofs) if n else 0
+        for u in self.users.values():
+            # Cached users of the table replace their row's values
+            if u.row < n:
+                balance -= table.balance[u.row]
+                proofs -= table.proofs[u.row]
+            balance += u.balance
+            proofs += u.proofs
+        return (
+            self.count_users(),
+            balance,
+            proofs,
+            len(self.verified),
+            sum(self.verified.values()),
+        )
+
+    def reconcile(self):
+        actual = self.count_totals()
+        found = drift(self.totals(), actual)
+        self.stats = dict(zip(STAT_FIELDS, actual))
+        self.recount_campaigns()
+        self.writes += 1
+        return found
+
+    # ---- verified ids ----
+    def find_verified(self, runs):
+        now = time.time()
+        for vid in candidate_ids(runs, sorted(self.id_lengths)):
+            if vid in self.verified and self.expires.get(vid, now + 1) > now:
+                return vid, self.campaign_of.get(vid, MAIN)
+        return None
+
+    def consume_verified_id(self, vid, uid):
+        if vid not in self.verified or self.user(uid) is None:
+            return None
+        amount = self.verified[vid]
+        self._log({"t": PROOF, "u": uid, "a": amount, "v": vid})
+        return amount
+
+    def add_verified(self, pairs, campaign=MAIN):
+        # Last amount wins for an id repeated within the batch
+        pairs = dict(pairs)
+        added = sum(1 for vid in pairs if vid not in self.verified)
+        rec = {"t": "vset", "p": list(pairs.items())}
+        if campaign != MAIN:
+            rec["c"] = campaign
+        self._log(rec)
+        return added
+
+    def expire_verified(self, before, limit):
+        ids = []
+        for vid, ts in self.verified_at.items():
+            if ts >= before or len(ids) >= limit:
+                break
+            ids.append(vid)
+        if ids:
+            self._log({"t": "vexp", "ids": ids})
+        return len(ids)
+
+    def evict_expired(self, now, limit):
+        heap = self.expiry_heap
+        ids = {}
+        while heap and heap[0][0] <= now and len(ids) < limit:
+            deadline, vid = heapq.heappop(heap)
+            if self.expires.get(vid) == deadline:
+                ids[vid] = None
+        if ids:
+            self._log({"t": "vexp", "ids": list(ids)})
+        return len(ids)
+
+    def count_verified(self):
+        return len(self.verified)
+
+    # ---- campaigns ----
+    def set_campaign(self, name, amount, ttl):
+        self._log({"t": "camp", "c": name, "a": amount, "ttl": ttl})
+
+    def campaigns(self):
+        return sorted(
+            (dict(camp) for camp in self.camps.values()),
+            key=lambda c: (c["name"] != MAIN, c["name"])
+        )
+
+    # ---- withdrawals ----
+    def request_withdrawal(self, uid, amount, method, detail):
+        user = self.user(uid)
+        if user is None or user.balance < amount:
+            return None
+        self._log({"t": WITHDRAW, "u": uid, "a": -amount, "m": method, "d": detail})
+        return self.seq, user.balance
+
+    def resolve_withdrawals(self, rids, approve):
+        done = []
+        for rid in rids:
+            req = self.withdrawals.get(rid)
+            if req is None:
+                continue
+            if approve:
+                self._log({"t": PAID, "u": req["uid"], "w": rid})
+            else:
+                self._log({"t": REFUND, "u": req["uid"], "a": req["amount"], "w": rid})
+            done.append(req)
+        return done
+
+    def pending_withdrawals(self, method=None, below=None):
+        return [
+            req for req in self.withdrawals.values()
+            if (method is None or req["method"] == method)
+            and (below is None or req["amount"] < below)
+        ]
+
+    # ---- history ----
+    def history(self, uid, limit):
+        events = []
+        files = {}
+        try:
+            for first, pos in reversed(self.offsets.get(uid, ())):
+                if len(events) >= limit:
+                    break
+                f = files.get(first)
+                if f is None:
+                    f = files[first] = open(self.segment_path(first), "rb")
+                f.seek(pos)
+                events.append(self.ledger_event(json.loads(f.readline())))
+        finally:
+            for f in files.values():
+                f.close()
+        block = self.head(uid)
+        while block is not None and len(events) < limit:
+            first, offset, size = block
+            try:
+                f = open(self.segment_path(first, ".hist"), "rb")
+            except FileNotFoundError:
+                break  # restored from a backup, which has no history
+            with f:
+                f.seek(offset)
+                lines = unpack_block(f.read(size)).split(b"\n")
+            block = json.loads(lines[0])["p"]
+            for line in reversed(lines[1:]):
+                rec = json.loads(line)
+                if rec["t"] in HISTORY_KINDS:
+                    events.append(self.ledger_event(rec))
+                    if len(events) >= limit:
+                        break
+        return events
+
+    def ledger_rows(self):
+        """
+        (seq, ts, uid, kind, amount, ref) of every history record on disk,
+        oldest first, reading one segment at a time.
+        """
+        jsonl = dict(self.segments())
+        hist = dict(self.segments(".hist"))
+        for first in sorted(jsonl.keys() | hist.keys()):
+            recs = []
+            if first in jsonl:
+                # Not compacted yet, or its compaction was interrupted
+                with open(jsonl[first], "rb") as f:
+                    for line in f:
+                        try:
+                            recs.append(json.loads(line))
+                        except ValueError:
+                            continue
+            else:
+                with open(hist[first], "rb") as f:
+                    data = f.read()
+                # Blocks are back to back; each ends its deflate stream
+                while data:
+                    z = zlib.decompressobj(-15, zdict=HIST_ZDICT)
+                    lines = (z.decompress(data) + z.flush()).split(b"\n")
+                    data = z.unused_data
+                    recs.extend(json.loads(line) for line in lines[1:])
+                recs.sort(key=lambda rec: rec["s"])
+            for rec in recs:
+                if rec["t"] in HISTORY_KINDS and "u" in rec:
+                    e = self.ledger_event(rec)
+                    yield rec["s"], e["ts"], rec["u"], e["kind"], e["amount"], e["ref"]
+
+    # ---- broadcasts ----
+    def recipients(self, after, limit):
+        # Cursor = row, which only ever grows at the end
+        out = []
+        row = after
+        total = self.count_users()
+        while row < total and len(out) < limit:
+            uid = self.uid_at(row)
+            row += 1
+            if uid not in self.blocked:
+                out.append((row, uid))
+        return out
+
+    def set_blocked(self, uid, blocked):
+        if self.user(uid) is None or (uid in self.blocked) == blocked:
+            return False
+        self._log({"t": "block" if blocked else "unblock", "u": uid})
+        return True
+
+    def is_blocked(self, uid):
+        return uid in self.blocked
+
+    def count_blocked(self):
+        return len(self.blocked)
+
+    def ledger_event(self, rec):
+        t = rec["t"]
+        amount = rec.get("a", 0)
+        if rec["s"] < self.paise_from:
+            amount = to_paise(amount)
+        if t == PROOF:
+            ref = rec["v"]
+        elif "w" in rec:
+            ref = str(rec["w"])
+        elif "m" in rec:
+            ref = str(rec["s"])
+        else:
+            ref = None
+        return {"kind": t, "amount": amount, "ts": rec["ts"], "ref": ref}
+
+# ================= SQLITE BACKEND =================
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    uid TEXT PRIMARY KEY,
+    name TEXT,
+    username TEXT,
+    balance INTEGER NOT NULL DEFAULT 0,
+    proofs INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS users_balance ON users(balance);
+CREATE INDEX IF NOT EXISTS users_proofs ON users(proofs);
+CREATE INDEX IF NOT EXISTS users_username ON users(username COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS users_name ON users(name COLLATE NOCASE);
+CREATE TABLE IF NOT EXISTS verified (
+    vid TEXT PRIMARY KEY,
+    amount INTEGER NOT NULL,
+    added INTEGER NOT NULL DEFAULT 0,
+    campaign TEXT NOT NULL DEFAULT 'main',
+    expires INTEGER NOT NULL DEFAULT 0
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS verified_len ON verified(length(vid));
+CREATE TABLE IF NOT EXISTS stats (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    users INTEGER NOT NULL DEFAULT 0,
+    balance INTEGER NOT NULL DEFAULT 0,
+    proofs INTEGER NOT NULL DEFAULT 0,
+    verified INTEGER NOT NULL DEFAULT 0,
+    verified_amount INTEGER NOT NULL DEFAULT 0
+);
+INSERT OR IGNORE INTO stats (id) VALUES (1);
+CREATE TRIGGER IF NOT EXISTS users_ins AFTER INSERT ON users BEGIN
+    UPDATE stats SET users = users + 1, balance = balance + NEW.balance,
+                     proofs = proofs + NEW.proofs;
+END;
+CREATE TRIGGER IF NOT EXISTS users_upd AFTER UPDATE OF balance, proofs ON users BEGIN
+    UPDATE stats SET balance = balance + NEW.balance - OLD.balance,
+                     proofs = proofs + NEW.proofs - OLD.proofs;
+END;
+CREATE TRIGGER IF NOT EXISTS users_del AFTER DELETE ON users BEGIN
+    UPDATE stats SET users = users - 1, balance = balance - OLD.balance,
+                     proofs = proofs - OLD.proofs;
+END;
+CREATE TRIGGER IF NOT EXISTS verified_ins AFTER INSERT ON verified BEGIN
+    UPDATE stats SET verified = verified + 1,
+                     verified_amount = verified_amount + NEW.amount;
+END;
+CREATE TRIGGER IF NOT EXISTS verified_upd AFTER UPDATE OF amount ON verified BEGIN
+    UPDATE stats SET verified_amount = verified_amount + NEW.amount - OLD.amount;
+END;
+CREATE TRIGGER IF NOT EXISTS verified_del AFTER DELETE ON verified BEGIN
+    UPDATE stats SET verified = verified - 1,
+                     verified_amount = verified_amount - OLD.amount;
+END;
+CREATE TABLE IF NOT EXISTS ledger (
+    id INTEGER PRIMARY KEY,
+    ts INTEGER NOT NULL,
+    uid TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    amount INTEGER NOT NULL,
+    ref TEXT
+);
+CREATE INDEX IF NOT EXISTS ledger_uid ON ledger(uid, id);
+CREATE TABLE IF NOT EXISTS withdrawals (
+    id INTEGER PRIMARY KEY,
+    ts INTEGER NOT NULL,
+    uid TEXT NOT NULL,
+    amount INTEGER NOT NULL,
+    method TEXT NOT NULL,
+    detail TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending'
+);
+CREATE INDEX IF NOT EXISTS withdrawals_pending ON withdrawals(method, amount)
+    WHERE status = 'pending';
+CREATE TABLE IF NOT EXISTS blocked (
+    uid TEXT PRIMARY KEY
+) WITHOUT ROWID;
+"""
+
+# After SCHEMA, once an older verified table has its added, campaign and
+# expires columns. The partial index on expires is the expiry queue: the
+# IDs due first are at its start. Triggers keep each campaign's ids / pool
+# current; claimed, paid and expired are counted by the methods.
+VERIFIED_EXTRAS = """
+CREATE INDEX IF NOT EXISTS verified_added ON verified(added);
+CREATE INDEX IF NOT EXISTS verified_expires ON verified(expires) WHERE expires > 0;
+CREATE TABLE IF NOT EXISTS campaigns (
+    name TEXT PRIMARY KEY,
+    amount INTEGER NOT NULL DEFAULT 0,
+    ttl INTEGER NOT NULL DEFAULT 0,
+    ids INTEGER NOT NULL DEFAULT 0,
+    pool INTEGER NOT NULL DEFAULT 0,
+    claimed INTEGER NOT NULL DEFAULT 0,
+    paid INTEGER NOT NULL DEFAULT 0,
+    expired INTEGER NOT NULL DEFAULT 0
+) WITHOUT ROWID;
+INSERT OR IGNORE INTO campaigns (name) VALUES ('main');
+CREATE TRIGGER IF NOT EXISTS verified_camp_ins AFTER INSERT ON verified BEGIN
+    UPDATE campaigns SET ids = ids + 1, pool = pool + NEW.amount WHERE name = NEW.campaign;
+END;
+CREATE TRIGGER IF NOT EXISTS verified_camp_upd AFTER UPDATE OF amount, campaign ON verified BEGIN
+    UPDATE campaigns SET ids = ids - 1, pool = pool - OLD.amount WHERE name = OLD.campaign;
+    UPDATE campaigns SET ids = ids + 1, pool = pool + NEW.amount WHERE name = NEW.campaign;
+END;
+CREATE TRIGGER IF NOT EXISTS verified_camp_del AFTER DELETE ON verified BEGIN
+    UPDATE campaigns SET ids = ids - 1, pool = pool - OLD.amount WHERE name = OLD.campaign;
+END;
+"""
+
+WITHDRAWAL_COLS = "id, uid, amount, method, detail, ts"
+
+# Databases from before user_version 1 store rupees in REAL columns. The
+# tables are rebuilt with INTEGER paise columns in one transaction; the
+# triggers recount stats as the rows are copied back.
+SCHEMA_VERSION = 1
+TABLES = ("users", "verified", "stats", "ledger", "withdrawals")
+PAISE_MIGRATION = (
+    "BEGIN IMMEDIATE;\n"
+    + "".join(f"DROP TRIGGER IF EXISTS {t}_{op};\n"
+              for t in ("users", "verified") for op in ("ins", "upd", "del"))
+    + "".join(f"DROP INDEX IF EXISTS {i};\n" for i in (
+        "users_balance", "users_proofs", "users_username", "users_name",
+        "verified_len", "withdrawals_pending", "ledger_uid"))
+    + "".join(f"ALTER TABLE {t} RENAME TO {t}_rupees;\n" for t in TABLES)
+    + SCHEMA
+    + """
+INSERT INTO users (rowid, uid, name, username, balance, proofs)
+    SELECT rowid, uid, name, username, CAST(ROUND(balance * 100) AS INTEGER), proofs
+    FROM users_rupees ORDER BY rowid;
+INSERT INTO verified (vid, amount, added)
+    SELECT vid, CAST(ROUND(amount * 100) AS INTEGER), CAST(strftime('%s', 'now') AS INTEGER)
+    FROM verified_rupees;
+INSERT INTO ledger (id, ts, uid, kind, amount, ref)
+    SELECT id, ts, uid, kind, CAST(ROUND(amount * 100) AS INTEGER), ref FROM ledger_rupees;
+INSERT INTO withdrawals (id, ts, uid, amount, method, detail, status)
+    SELECT id, ts, uid, CAST(ROUND(amount * 100) AS INTEGER), method, detail, status
+    FROM withdrawals_rupees;
+"""
+    + "".join(f"DROP TABLE {t}_rupees;\n" for t in TABLES)
+    + f"PRAGMA user_version = {SCHEMA_VERSION};\n"
+    + "COMMIT;\n"
+)
+
+def user_row(row):
+    if row is None:
+        return None
+    return User(row[2], row[3], row[0], row[1])
+
+def withdrawal_row(row):
+    return dict(zip(("id", "uid", "amount", "method", "detail", "ts"), row))
+
+class SqliteStorage(Storage):
+    """
+    Users and verified IDs in one SQLite database (WAL mode). Every call
+    is a single indexed statement or a short IMMEDIATE transaction, so
+    writes are durable as soon as the method returns. Balance changes and
+    their ledger rows are written in the same transaction.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.db = None
+
+    def open(self):
+        # Autocommit mode; multi-statement changes use explicit BEGIN.
+        # Other workers may hold the write lock briefly, so wait for it
+        self.db = sqlite3.connect(self.path, isolation_level=None, timeout=10)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        tables = {r[0] for r in self.db.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        version = self.db.execute("PRAGMA user_version").fetchone()[0]
+        self.db.executescript(SCHEMA)
+        if "users" in tables and version < SCHEMA_VERSION:
+            # Rupee floats from an older release
+            self.db.executescript(PAISE_MIGRATION)
+        columns = {r[1] for r in self.db.execute("PRAGMA table_info(verified)")}
+        if "added" not in columns:
+            # IDs from before expiry existed count as added now
+            self.db.execute("ALTER TABLE verified ADD COLUMN added INTEGER NOT NULL DEFAULT 0")
+            self.db.execute("UPDATE verified SET added = ?", (int(time.time()),))
+        if "campaign" not in columns:
+            # and belong to MAIN, which has no ttl
+            self.db.execute("ALTER TABLE verified ADD COLUMN campaign TEXT NOT NULL DEFAULT 'main'")
+            self.db.execute("ALTER TABLE verified ADD COLUMN expires INTEGER NOT NULL DEFAULT 0")
+        self.db.executescript(VERIFIED_EXTRAS)
+        if "users" in tables and not {"stats", "campaigns"} <= tables:
+            # Counters were added to an existing database; seed them
+            self.reconcile()
+        self.db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    async def backup(self, path):
+        await asyncio.to_thread(self._backup, path)
+
+    def _backup(self, path):
+        # SQLite's online backup copies a consistent state while other
+        # connections keep writing; compress the copy in the same thread
+        copy = f"{path}.db"
+        src = sqlite3.connect(self.path, timeout=10)
+        dst = sqlite3.connect(copy)
+        try:
+            src.backup(dst)
+        finally:
+            dst.close()
+            src.close()
+        try:
+            write_backup(path, [(os.path.basename(self.path), open(copy, "rb"))])
+        finally:
+            os.remove(copy)
+
+    def tx(self):
+        return Transaction(self.db)
+
+    def get_user(self, uid):
+        return user_row(self.db.execute(
+            "SELECT balance, proofs, name, username FROM users WHERE uid = ?",
+            (uid,)
+        ).fetchone())
+
+    def ensure_user(self, uid, name, username):
+        cur = self.db.execute(
+            "INSERT OR IGNORE INTO users (uid, name, username) VALUES (?, ?, ?)",
+            (uid, name, username)
+        )
+        return self.get_user(uid), cur.rowcount == 1
+
+    def _adjust(self, uid, delta, kind, clamp=False, ref=None):
+        # Callers hold an IMMEDIATE transaction, so read-then-write is safe
+        row = self.db.execute("SELECT balance FROM users WHERE uid = ?", (uid,)).fetchone()
+        if row is None:
+            return None
+        if row[0] + delta < 0:
+            if not clamp:
+                return None
+            delta = -row[0]
+        self.db.execute(
+            "UPDATE users SET balance = balance + ?, proofs = proofs + ? WHERE uid = ?",
+            (delta, 1 if kind == PROOF else 0, uid)
+        )
+        self.db.execute(
+            "INSERT INTO ledger (ts, uid, kind, amount, ref) VALUES (?, ?, ?, ?, ?)",
+            (int(time.time()), uid, kind, delta, ref)
+        )
+        return row[0] + delta
+
+    def adjust_balance(self, uid, delta, kind, clamp=False):
+        with self.tx():
+            return self._adjust(uid, delta, kind, clamp)
+
+    def browse_users(self, sort, limit, after=None, before=None):
+        col = {"new": "rowid", "balance": "balance", "proofs": "proofs"}[sort]
+        select = "SELECT uid, balance, proofs, name, username, rowid FROM users "
+        if after is None and before is None:
+            rows = self.db.execute(
+                select + f"ORDER BY {col} DESC, rowid DESC LIMIT ?", (limit,)
+            ).fetchall()
+        else:
+            # The cursor's ties, then the keys past it: two index seeks. A
+            # row value (col, rowid) < (?, ?) seeks on col only and filters
+            # the ties, which is O(ties) when most balances are 0
+            key, row = after if after is not None else before
+            op, desc = ("<", "DESC") if after is not None else (">", "")
+            rows = self.db.execute(
+                select + f"WHERE {col} = ? AND rowid {op} ? ORDER BY rowid {desc} LIMIT ?",
+                (key, row, limit)
+            ).fetchall()
+            if len(rows) < limit:
+                rows += self.db.execute(
+                    select + f"WHERE {col} {op} ? ORDER BY {col} {desc}, rowid {desc} LIMIT ?",
+                    (key, limit - len(rows))
+                ).fetchall()
+            if before is not None:
+                rows.reverse()
+        return [(r[0], User(r[3], r[4], r[1], r[2], r[5])) for r in rows]
+
+    def search_users(self, query, limit):
+        query = query.strip().lstrip("@")
+        found = {}
+        user = self.get_user(query)
+        if user is not None:
+            found[query] = user
+        # Range scans on the NOCASE indexes
+        for col in ("username", "name"):
+            rows = self.db.execute(
+                "SELECT uid, balance, proofs, name, username FROM users "
+                f"WHERE {col} COLLATE NOCASE >= ? AND {col} COLLATE NOCASE < ? "
+                f"ORDER BY {col} COLLATE NOCASE LIMIT ?",
+                (query, query + "\uffff", limit)
+            ).fetchall()
+            for r in rows:
+                found.setdefault(r[0], user_row(r[1:]))
+        return list(found.items())[:limit]
+
+    def totals(self):
+        # Maintained by the triggers in SCHEMA
+        return self.db.execute(
+            f"SELECT {', '.join(STAT_FIELDS)} FROM stats WHERE id = 1"
+        ).fetchone()
+
+    def version(self, data):
+        if data == "totals":
+            return self.totals()
+        # Users are only changed by _adjust, which adds a ledger row in the
+        # same transaction, so the user count and the last ledger id move
+        # with them, whichever connection wrote
+        return self.db.execute(
+            "SELECT users, (SELECT MAX(id) FROM ledger) FROM stats WHERE id = 1"
+        ).fetchone()
+
+    def reconcile(self):
+        with self.tx():
+            users, bal, proofs = self.db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(balance), 0), COALESCE(SUM(proofs), 0) FROM users"
+            ).fetchone()
+            vcount, vamount = self.db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(amount), 0) FROM verified"
+            ).fetchone()
+            actual = (users, bal, proofs, vcount, vamount)
+            found = drift(self.totals(), actual)
+            if found:
+                self.db.execute(
+                    f"UPDATE stats SET {', '.join(f + ' = ?' for f in STAT_FIELDS)} WHERE id = 1",
+                    actual
+                )
+            self.db.execute(
+                "UPDATE campaigns SET "
+                "ids = (SELECT COUNT(*) FROM verified WHERE campaign = campaigns.name), "
+                "pool = (SELECT COALESCE(SUM(amount), 0) FROM verified WHERE campaign = campaigns.name)"
+            )
+            return found
+
+    def find_verified(self, runs):
+        # Both ends come straight off the length index (a single
+        # MIN(), MAX() query would scan it instead)
+        lo, hi = self.db.execute(
+            "SELECT (SELECT MIN(length(vid)) FROM verified), "
+            "(SELECT MAX(length(vid)) FROM verified)"
+        ).fetchone()
+        if lo is None:
+            return None
+        cands = list(dict.fromkeys(candidate_ids(runs, range(lo, hi + 1))))
+        if not cands:
+            return None
+        found = {}
+        now = int(time.time())
+        for i in range(0, len(cands), 500):
+            chunk = cands[i:i + 500]
+            found.update(self.db.execute(
+                f"SELECT vid, campaign FROM verified WHERE vid IN ({','.join('?' * len(chunk))}) "
+                "AND (expires = 0 OR expires > ?)",
+                chunk + [now]
+            ))
+        # First match by position in the link
+        for vid in cands:
+            if vid in found:
+                return vid, found[vid]
+        return None
+
+    def consume_verified_id(self, vid, uid):
+        with self.tx() as t:
+            row = self.db.execute(
+                "DELETE FROM verified WHERE vid = ? RETURNING amount, campaign", (vid,)
+            ).fetchone()
+            if row is None or self._adjust(uid, row[0], PROOF, ref=vid) is None:
+                t.rollback()
+                return None
+            self.db.execute(
+                "UPDATE campaigns SET claimed = claimed + 1, paid = paid + ? WHERE name = ?", row
+            )
+            return row[0]
+
+    def add_verified(self, pairs, campaign=MAIN):
+        with self.tx():
+            before = self.count_verified()
+            now = int(time.time())
+            ttl = self.db.execute(
+                "SELECT ttl FROM campaigns WHERE name = ?", (campaign,)
+            ).fetchone()[0]
+            # An existing ID keeps its added time, so its deadline is
+            # recomputed from that
+            self.db.executemany(
+                "INSERT INTO verified (vid, amount, added, campaign, expires) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(vid) DO UPDATE SET amount = excluded.amount, "
+                "campaign = excluded.campaign, "
+                "expires = CASE WHEN ? > 0 THEN verified.added + ? ELSE 0 END",
+                (
+                    (vid, amount, now, campaign, now + ttl if ttl else 0, ttl, ttl)
+                    for vid, amount in pairs
+                )
+            )
+            return self.count_verified() - before
+
+    def _expire(self, select, args):
+        """Delete the IDs `select` picks, counting them as expired."""
+        with self.tx():
+            rows = self.db.execute(
+                f"DELETE FROM verified WHERE vid IN ({select}) RETURNING campaign", args
+            ).fetchall()
+            for name, n in Counter(r[0] for r in rows).items():
+                self.db.execute(
+                    "UPDATE campaigns SET expired = expired + ? WHERE name = ?", (n, name)
+                )
+            return len(rows)
+
+    def expire_verified(self, before, limit):
+        return self._expire(
+            "SELECT vid FROM verified WHERE added < ? ORDER BY added LIMIT ?", (before, limit)
+        )
+
+    def evict_expired(self, now, limit):
+        return self._expire(
+            "SELECT vid FROM verified WHERE expires > 0 AND expires <= ? ORDER BY expires LIMIT ?",
+            (now, limit)
+        )
+
+    def count_verified(self):
+        return self.db.execute("SELECT verified FROM stats WHERE id = 1").fetchone()[0]
+
+    # ---- campaigns ----
+    def set_campaign(self, name, amount, ttl):
+        self.db.execute(
+            "INSERT INTO campaigns (name, amount, ttl) VALUES (?, ?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET amount = excluded.amount, ttl = excluded.ttl",
+            (name, amount, ttl)
+        )
+
+    def campaigns(self):
+        return [
+            dict(zip(CAMPAIGN_FIELDS, row)) for row in self.db.execute(
+                f"SELECT {', '.join(CAMPAIGN_FIELDS)} FROM campaigns ORDER BY name != ?, name",
+                (MAIN,)
+            )
+        ]
+
+    # ---- withdrawals ----
+    def request_withdrawal(self, uid, amount, method, detail):
+        with self.tx() as tx:
+            rid = self.db.execute(
+                "INSERT INTO withdrawals (ts, uid, amount, method, detail) VALUES (?, ?, ?, ?, ?)",
+                (int(time.time()), uid, amount, method, detail)
+            ).lastrowid
+            new_bal = self._adjust(uid, -amount, WITHDRAW, ref=str(rid))
+            if new_bal is None:
+                tx.rollback()
+                return None
+            return rid, new_bal
+
+    def resolve_withdrawals(self, rids, approve):
+        done = []
+        with self.tx():
+            for rid in rids:
+                row = self.db.execute(
+                    "UPDATE withdrawals SET status = ? WHERE id = ? AND status = 'pending' "
+                    f"RETURNING {WITHDRAWAL_COLS}",
+                    ("paid" if approve else "rejected", rid)
+                ).fetchone()
+                if row is None:
+                    continue
+                req = withdrawal_row(row)
+                if approve:
+                    self.db.execute(
+                        "INSERT INTO ledger (ts, uid, kind, amount, ref) VALUES (?, ?, ?, 0, ?)",
+                        (int(time.time()), req["uid"], PAID, str(rid))
+                    )
+                else:
+                    self._adjust(req["uid"], req["amount"], REFUND, ref=str(rid))
+                done.append(req)
+        return done
+
+    def pending_withdrawals(self, method=None, below=None):
+        sql = f"SELECT {WITHDRAWAL_COLS} FROM withdrawals WHERE status = 'pending'"
+        args = []
+        if method is not None:
+            sql += " AND method = ?"
+            args.append(method)
+        if below is not None:
+            sql += " AND amount < ?"
+            args.append(below)
+        return [withdrawal_row(r) for r in self.db.execute(sql + " ORDER BY id", args)]
+
+    # ---- history ----
+    def history(self, uid, limit):
+        # Newest first straight off the (uid, id) index
+        rows = self.db.execute(
+            "SELECT kind, amount, ts, ref FROM ledger WHERE uid = ? ORDER BY id DESC LIMIT ?",
+            (uid, limit)
+        )
+        return [dict(zip(("kind", "amount", "ts", "ref"), r)) for r in rows]
+
+    # ---- broadcasts ----
+    def recipients(self, after, limit):
+        # Keyset pagination on rowid (signup order)
+        return self.db.execute(
+            "SELECT rowid, uid FROM users WHERE rowid > ? "
+            "AND NOT EXISTS (SELECT 1 FROM blocked b WHERE b.uid = users.uid) "
+            "ORDER BY rowid LIMIT ?", (after, limit)
+        ).fetchall()
+
+    def set_blocked(self, uid, blocked):
+        if blocked:
+            cur = self.db.execute(
+                "INSERT OR IGNORE INTO blocked (uid) SELECT uid FROM users WHERE uid = ?", (uid,)
+            )
+        else:
+            cur = self.db.execute("DELETE FROM blocked WHERE uid = ?", (uid,))
+        return cur.rowcount == 1
+
+    def is_blocked(self, uid):
+        return self.db.execute("SELECT 1 FROM blocked WHERE uid = ?", (uid,)).fetchone() is not None
+
+    def count_blocked(self):
+        return self.db.execute("SELECT COUNT(*) FROM blocked").fetchone()[0]
+
+class Transaction:
+    """BEGIN IMMEDIATE ... COMMIT, rolled back on error or rollback()."""
+    def __init__(self, db):
+        self.db = db
+        self.done = False
+
+    def __enter__(self):
+        self.db.execute("BEGIN IMMEDIATE")
+        return self
+
+    def rollback(self):
+        if not self.done:
+            self.db.execute("ROLLBACK")
+            self.done = True
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.rollback()
+        elif not self.done:
+            self.db.execute("COMMIT")
+            self.done = True
+        return False
+
+def checkpoint(path):
+    """
+    Copy a WAL database's log into it and truncate data.db-wal, which
+    SQLite otherwise leaves at the largest size it ever reached. Waits for
+    other connections' readers, so run it in a thread. False if they kept
+    it from finishing.
+    """
+    db = sqlite3.connect(path, timeout=10)
+    try:
+        busy = db.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()[0]
+    finally:
+        db.close()
+    return not busy
+
+# ================= FACTORY / MIGRATION =================
+def open_storage(kind, data_dir, flush_batch=200):
+    os.makedirs(data_dir, exist_ok=True)
+    if kind == "sqlite":
+        st = SqliteStorage(f"{data_dir}/bot.db")
+    elif kind == "json":
+        st = JsonStorage(data_dir, flush_batch)
+    else:
+        raise ValueError(f"Unknown STORAGE backend: {kind}")
+    st.open()
+    return st
+
+def migrate(data_dir):
+    """Import the JSON backend's data (snapshot + ledger, or the old
+    users.json / verified.json) and its history into data/bot.db."""
+    src = JsonStorage(data_dir)
+    src.load_state()
+    dst = SqliteStorage(f"{data_dir}/bot.db")
+    dst.open()
+    with dst.tx():
+        dst.db.executemany(
+            "INSERT OR REPLACE INTO users (uid, name, username, balance, proofs) "
+            "VALUES (?, ?, ?, ?, ?)",
+            zip(*src.user_columns())
+        )
+        dst.db.executemany(
+            f"INSERT OR REPLACE INTO campaigns ({', '.join(CAMPAIGN_FIELDS)}) "
+            f"VALUES ({', '.join('?' * len(CAMPAIGN_FIELDS))})",
+            ([camp[f] for f in CAMPAIGN_FIELDS] for camp in src.campaigns())
+        )
+        dst.db.executemany(
+            "INSERT OR REPLACE INTO verified (vid, amount, added, campaign, expires) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (
+                (vid, amount, src.verified_at[vid], src.campaign_of.get(vid, MAIN),
+                 src.expires.get(vid, 0))
+                for vid, amount in src.verified.items()
+            )
+        )
+        dst.db.executemany(
+            "INSERT OR REPLACE INTO withdrawals (id, ts, uid, amount, method, detail) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                (r["id"], r["ts"], r["uid"], r["amount"], r["method"], r["detail"])
+                for r in src.withdrawals.values()
+            )
+        )
+        dst.db.executemany(
+            "INSERT OR IGNORE INTO blocked (uid) VALUES (?)", ((uid,) for uid in src.blocked)
+        )
+        # History keeps the ledger's seq as its id, so a second run
+        # replaces rather than duplicates it
+        events = dst.db.executemany(
+            "INSERT OR REPLACE INTO ledger (id, ts, uid, kind, amount, ref) VALUES (?, ?, ?, ?, ?, ?)",
+            src.ledger_rows()
+        ).rowcount
+    # REPLACE does not fire the delete triggers, so recount
+    dst.reconcile()
+    print(
+        f"✅ Migrated {src.count_users()} users, {len(src.verified)} verified IDs "
+        f"and {events} history events"
+    )
+    dst.close()
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] != "migrate":
+        print("Usage: python storage.py migrate [data_dir]")
+        sys.exit(1)
+    migrate(sys.argv[2] if len(sys.argv) > 2 else "data")
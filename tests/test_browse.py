@@ -0,0 +1,108 @@
+import asyncio
+import random
+
+import pytest
+
+import bot
+import storage
+from storage import open_storage, browse_cursor, ADMIN_ADD
+
+SORTS = ("new", "balance", "proofs")
+
+@pytest.fixture(params=["json", "sqlite"])
+def st(request, tmp_path, monkeypatch):
+    # Small buckets, so pages cross them
+    monkeypatch.setattr(storage.SortedIndex, "LOAD", 4)
+    st = open_storage(request.param, str(tmp_path))
+    rng = random.Random(1)
+    for i in range(60):
+        st.ensure_user(str(i), f"U{i}", None)
+        # Mostly ties, as most balances are 0 or a round amount
+        amount = rng.choice([0, 0, 0, 500, 500, 2000])
+        if amount:
+            st.adjust_balance(str(i), amount, ADMIN_ADD)
+        if i == 40 and request.param == "json":
+            # Users both in the table and created after it
+            asyncio.run(st.snapshot())
+    yield st
+    st.close()
+
+def uids(page):
+    return [uid for uid, _ in page]
+
+@pytest.mark.parametrize("sort", SORTS)
+def test_cursors_walk_every_user_both_ways(st, sort):
+    everyone = uids(st.browse_users(sort, 1000))
+    assert len(everyone) == 60
+    if sort == "balance":
+        # Largest first, ties newest first
+        keys = [(st.get_user(uid)["balance"], int(uid)) for uid in everyone]
+        assert keys == sorted(keys, reverse=True)
+
+    pages = [st.browse_users(sort, 7)]
+    while True:
+        page = st.browse_users(sort, 7, after=browse_cursor(sort, pages[-1][-1][1]))
+        if not page:
+            break
+        pages.append(page)
+    assert [uid for page in pages for uid in uids(page)] == everyone
+
+    for prev, page in zip(pages, pages[1:]):
+        assert uids(st.browse_users(sort, 7, before=browse_cursor(sort, page[0][1]))) == uids(prev)
+
+def test_bot_pages_follow_their_buttons(st, monkeypatch):
+    monkeypatch.setattr(bot, "storage", st)
+    everyone = uids(st.browse_users("balance", 1000))
+
+    def buttons(panel):
+        return {b.text: b.callback_data for row in panel[1].inline_keyboard for b in row}
+
+    def follow(data):
+        return bot.users_page(*bot.browse_args(data))
+
+    panels = [bot.users_page("balance", 0)]
+    while "Next ▶️" in buttons(panels[-1]):
+        data = buttons(panels[-1])["Next ▶️"]
+        assert len(data.encode()) <= 64
+        panels.append(follow(data))
+    assert len(panels) == 12
+    shown = [
+        line.split(": ")[1] for panel in panels for line in panel[0].split("\n")
+        if line.startswith("🆔 ID: ")
+    ]
+    assert shown == everyone
+    assert "Page 12/12" in panels[-1][0]
+
+    # Prev from the last page gets back to each earlier one
+    panel = panels[-1]
+    for expected in reversed(panels[:-1]):
+        panel = follow(buttons(panel)["◀️ Prev"])
+        assert panel[0] == expected[0]
+    assert "◀️ Prev" not in buttons(panel)
+
+def test_deep_sqlite_page_costs_the_same(tmp_path):
+    st = open_storage("sqlite", str(tmp_path))
+    try:
+        st.db.execute("BEGIN")
+        st.db.executemany(
+            "INSERT INTO users (uid, name, username) VALUES (?, ?, NULL)",
+            ((str(i), f"U{i}") for i in range(20000))
+        )
+        st.db.execute("COMMIT")
+        steps = [0]
+
+        def count():
+            steps[0] += 1
+        st.db.set_progress_handler(count, 10)
+
+        def cost(**cursor):
+            steps[0] = 0
+            st.browse_users("balance", 6, **cursor)
+            return steps[0]
+
+        first = cost()
+        # Deep inside 20000 equal balances, from either side
+        deep = max(cost(after=(0, 30)), cost(before=(0, 19970)))
+        assert deep <= 3 * first + 10
+    finally:
+        st.close()
@@ -0,0 +1,203 @@
+import asyncio
+import errno
+import os
+
+import pytest
+
+from storage import open_storage, ADMIN_ADD, ADMIN_REMOVE
+
+UIDS = ("1", "2", "3")
+
+def state(st):
+    """Everything a restart has to bring back."""
+    return (
+        st.totals(),
+        st.seq,
+        [(uid, st.get_user(uid)["balance"], st.get_user(uid)["proofs"]) for uid in UIDS],
+        [(w["id"], w["uid"], w["amount"]) for w in st.pending_withdrawals()],
+        {uid: [(e["kind"], e["amount"], e["ref"]) for e in st.history(uid, 100)] for uid in UIDS},
+    )
+
+def crash(st):
+    """Stop without a snapshot or a last fsync, as a killed process would."""
+    st.ledger.close()
+    st.table.close()
+
+def work(st, rnd):
+    for uid in UIDS:
+        st.ensure_user(uid, f"U{uid}", None)
+    st.add_verified([(f"{rnd}1111111", 500), (f"{rnd}2222222", 700)])
+    st.adjust_balance("1", 1000, ADMIN_ADD)
+    rid, _ = st.request_withdrawal("1", 300, "UPI", "x@upi")
+    st.request_withdrawal("1", 200, "VSV", "y")
+    st.resolve_withdrawals([rid], rnd % 2 == 0)
+    st.consume_verified_id(f"{rnd}1111111", "2")
+    st.adjust_balance("3", -5, ADMIN_REMOVE, clamp=True)
+
+def segments(data):
+    return sorted(os.listdir(f"{data}/ledger"))
+
+def last_segment(data):
+    return f"{data}/ledger/{[n for n in segments(data) if n.endswith('.jsonl')][-1]}"
+
+def test_restart_from_snapshot_and_ledger(tmp_path):
+    data = str(tmp_path)
+    st = open_storage("json", data)
+    work(st, 1)
+    asyncio.run(st.snapshot())
+    work(st, 2)
+    expected = state(st)
+    crash(st)
+
+    st = open_storage("json", data)
+    try:
+        assert state(st) == expected
+    finally:
+        st.close()
+
+def test_compacted_segments_survive_restart(tmp_path):
+    data = str(tmp_path)
+    st = open_storage("json", data)
+    for rnd in range(1, 4):
+        work(st, rnd)
+        asyncio.run(st.snapshot())
+    expected = state(st)
+    crash(st)
+    # Only the open segment is left as JSON lines
+    assert [n for n in segments(data) if n.endswith(".jsonl")] == [os.path.basename(last_segment(data))]
+    assert sum(n.endswith(".hist") for n in segments(data)) == 3
+
+    st = open_storage("json", data)
+    try:
+        assert state(st) == expected
+    finally:
+        st.close()
+
+def test_compaction_cut_short_is_redone(tmp_path):
+    data = str(tmp_path)
+    st = open_storage("json", data)
+    work(st, 1)
+    asyncio.run(st.snapshot())
+    work(st, 2)
+
+    def killed(first, path, entries):
+        # .hist and .idx are written but the segment is not dropped yet
+        raise OSError(errno.EIO, "killed")
+    st.install_history = killed
+    with pytest.raises(OSError):
+        asyncio.run(st.snapshot())
+    expected = state(st)
+    crash(st)
+    assert sum(n.endswith(".jsonl") for n in segments(data)) == 2
+
+    st = open_storage("json", data)
+    try:
+        assert state(st) == expected
+        assert sum(n.endswith(".jsonl") for n in segments(data)) == 1
+    finally:
+        st.close()
+
+@pytest.mark.parametrize("after_snapshot", [False, True])
+def test_torn_last_line(tmp_path, after_snapshot):
+    data = str(tmp_path)
+    st = open_storage("json", data)
+    work(st, 1)
+    if after_snapshot:
+        # The torn record is the first of a fresh segment, which the
+        # restarted storage appends to again
+        asyncio.run(st.snapshot())
+    expected = state(st)
+    crash(st)
+    with open(last_segment(data), "ab") as f:
+        f.write(b'{"t":"admin_add","u":"1","a":99')
+
+    st = open_storage("json", data)
+    assert state(st) == expected
+    st.adjust_balance("2", 50, ADMIN_ADD)
+    expected = state(st)
+    crash(st)
+
+    st = open_storage("json", data)
+    try:
+        assert state(st) == expected
+    finally:
+        st.close()
+
+class FullDisk:
+    """A ledger file whose next write stops partway with ENOSPC."""
+    def __init__(self, f):
+        self.f = f
+
+    def write(self, line):
+        self.f.write(line[:len(line) // 2])
+        self.f.flush()
+        raise OSError(errno.ENOSPC, "No space left on device")
+
+    def __getattr__(self, name):
+        return getattr(self.f, name)
+
+def test_failed_write_changes_nothing(tmp_path):
+    data = str(tmp_path)
+    st = open_storage("json", data)
+    work(st, 1)
+    expected = state(st)
+    st.ledger = FullDisk(st.ledger)
+    with pytest.raises(OSError):
+        st.adjust_balance("1", 1000, ADMIN_ADD)
+    st.ledger = FullDisk(st.ledger)
+    with pytest.raises(OSError):
+        st.ensure_user("4", "U4", None)
+    assert state(st) == expected
+    assert st.get_user("4") is None
+
+    # The part that reached the file is gone, so later records replay
+    st.adjust_balance("2", 50, ADMIN_ADD)
+    expected = state(st)
+    crash(st)
+    st = open_storage("json", data)
+    try:
+        assert state(st) == expected
+        assert st.get_user("4") is None
+    finally:
+        st.close()
+
+def files(data):
+    return sorted(os.listdir(data)), segments(data), os.path.getmtime(f"{data}/snapshot.json")
+
+def test_idle_snapshot_writes_nothing(tmp_path):
+    data = str(tmp_path)
+    st = open_storage("json", data)
+    work(st, 1)
+    asyncio.run(st.snapshot())
+    # Any rewrite of snapshot.json would move its mtime on from here
+    os.utime(f"{data}/snapshot.json", (0, 0))
+    before = files(data)
+    asyncio.run(st.snapshot())
+    assert files(data) == before
+
+    # Reads do not count as changes; a write or a recount does
+    state(st)
+    asyncio.run(st.snapshot())
+    assert files(data) == before
+    st.reconcile()
+    asyncio.run(st.snapshot())
+    assert files(data) != before
+    os.utime(f"{data}/snapshot.json", (0, 0))
+    before = files(data)
+    st.adjust_balance("2", 50, ADMIN_ADD)
+    asyncio.run(st.snapshot())
+    assert files(data) != before
+    expected = state(st)
+    asyncio.run(st.snapshot())
+    crash(st)
+
+    st = open_storage("json", data)
+    try:
+        assert state(st) == expected
+        # Nothing replayed after the snapshot, so none is due
+        os.utime(f"{data}/snapshot.json", (0, 0))
+        before = files(data)
+        asyncio.run(st.snapshot())
+        assert files(data) == before
+    finally:
+        st.close()
@@ -0,0 +1,48 @@
+import asyncio
+
+from storage import (
+    open_storage, migrate, ADMIN_ADD, ADMIN_REMOVE,
+)
+
+def history(st, uid):
+    return [(e["kind"], e["amount"], e["ts"], e["ref"]) for e in st.history(uid, 100)]
+
+def test_history_survives_migration(tmp_path):
+    data = str(tmp_path)
+
+    async def fill():
+        st = open_storage("json", data)
+        for uid in ("1", "2"):
+            st.ensure_user(uid, f"U{uid}", None)
+        st.add_verified([("11111111", 500), ("22222222", 700)])
+        for rnd in range(3):
+            st.adjust_balance("1", 1000, ADMIN_ADD)
+            rid, _ = st.request_withdrawal("1", 300, "UPI", "x@upi")
+            st.resolve_withdrawals([rid], rnd % 2 == 0)
+            st.consume_verified_id(["11111111", "22222222", "33333333"][rnd], "2")
+            st.adjust_balance("2", -5, ADMIN_REMOVE, clamp=True)
+            # Earlier rounds end up in compacted .hist segments, the last
+            # stays in the open .jsonl one
+            if rnd < 2:
+                await st.snapshot()
+        expected = {uid: history(st, uid) for uid in ("1", "2")}
+        st.close()
+        return expected
+
+    expected = asyncio.run(fill())
+    assert len(expected["1"]) == 9 and len(expected["2"]) == 5
+    migrate(data)
+    dst = open_storage("sqlite", data)
+    try:
+        for uid, events in expected.items():
+            assert history(dst, uid) == events
+    finally:
+        dst.close()
+
+    # Running it again does not duplicate anything
+    migrate(data)
+    dst = open_storage("sqlite", data)
+    try:
+        assert history(dst, "1") == expected["1"]
+    finally:
+        dst.close()
@@ -0,0 +1,58 @@
+import pytest
+
+import money
+
+@pytest.mark.parametrize("text, paise", [
+    ("12", 1200),
+    ("12.5", 1250),
+    ("12.50", 1250),
+    ("₹12.50", 1250),
+    (" ₹ 7 ", 700),
+    ("0.05", 5),
+    ("0", 0),
+    ("007.1", 710),
+    ("10000000", money.MAX_AMOUNT),
+])
+def test_parse(text, paise):
+    assert money.parse(text) == paise
+
+@pytest.mark.parametrize("text", [
+    "", "₹", "abc", "12abc", "1e3", "12,50", "1 000", ".5", "5.",
+    # more than two decimal places is not rounded away
+    "1.005", "0.001",
+    # negatives
+    "-5", "₹-5", "-0.01",
+    # over the limit
+    "10000000.01", "99999999999999999999",
+])
+def test_parse_rejects(text):
+    with pytest.raises(ValueError):
+        money.parse(text)
+
+@pytest.mark.parametrize("paise, text", [
+    (1200, "12"),
+    (1250, "12.50"),
+    (1205, "12.05"),
+    (5, "0.05"),
+    (0, "0"),
+    (-1250, "-12.50"),
+    (-5, "-0.05"),
+])
+def test_fmt(paise, text):
+    assert money.fmt(paise) == text
+
+@pytest.mark.parametrize("paise", [0, 1, 99, 100, 1250, 123456789, money.MAX_AMOUNT])
+def test_fmt_parses_back(paise):
+    assert money.parse(money.fmt(paise)) == paise
+
+@pytest.mark.parametrize("rupees, paise", [
+    (12.35, 1235),
+    # binary floats just below the paisa still round to it
+    (0.1 + 0.2, 30),
+    (1.15, 115),
+    (12.35 - 3.3, 905),
+    (-2.2, -220),
+    (0, 0),
+])
+def test_to_paise(rupees, paise):
+    assert money.to_paise(rupees) == paise
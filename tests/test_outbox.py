@@ -0,0 +1,51 @@
+import asyncio
+import time
+
+from outbox import Outbox
+
+class RecordingBot:
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text, reply_markup=None):
+        self.sent.append((chat_id, text, time.monotonic()))
+
+def test_flooded_chat_does_not_hold_up_others(tmp_path):
+    async def run():
+        bot = RecordingBot()
+        box = Outbox(str(tmp_path / "outbox.db"), chat_rate=1.0, chat_burst=3, global_rate=100.0)
+        box.open(bot)
+        try:
+            start = time.monotonic()
+            box.send_many([(1, f"notice {i}") for i in range(300)])
+            box.send(2, "your withdrawal was approved")
+            while not any(chat_id == 2 for chat_id, _, _ in bot.sent):
+                assert time.monotonic() - start < 2, "chat 2 waited behind chat 1"
+                await asyncio.sleep(0.01)
+        finally:
+            await box.close()
+        return bot.sent
+
+    sent = asyncio.run(run())
+    # Chat 1 only got its burst, in order
+    assert [text for chat_id, text, _ in sent if chat_id == 1] == ["notice 0", "notice 1", "notice 2"]
+
+def test_retried_message_keeps_its_place(tmp_path):
+    async def run():
+        bot = RecordingBot()
+        box = Outbox(str(tmp_path / "outbox.db"), global_rate=100.0)
+        box.open(bot, deliver=False)
+        box.send(1, "first")
+        box.send(1, "second")
+        # The first message failed and waits for a retry
+        box.db.execute("UPDATE outbox SET not_before = ? WHERE id = 1", (time.time() + 0.5,))
+        box.bot = bot
+        box.worker = asyncio.create_task(box.run())
+        try:
+            while len(bot.sent) < 2:
+                await asyncio.sleep(0.01)
+        finally:
+            await box.close()
+        return bot.sent
+
+    assert [text for _, text, _ in asyncio.run(run())] == ["first", "second"]
@@ -0,0 +1,161 @@
+import asyncio
+import json
+import os
+import sqlite3
+
+from storage import open_storage, ADMIN_ADD
+
+def history(st, uid):
+    return [(e["kind"], e["amount"], e["ref"]) for e in st.history(uid, 100)]
+
+# The sqlite tables as releases before user_version 1 created them, with
+# rupees in REAL columns
+RUPEE_SCHEMA = """
+CREATE TABLE users (
+    uid TEXT PRIMARY KEY,
+    name TEXT,
+    username TEXT,
+    balance REAL NOT NULL DEFAULT 0,
+    proofs INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX users_balance ON users(balance);
+CREATE TABLE verified (
+    vid TEXT PRIMARY KEY,
+    amount REAL NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE stats (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    users INTEGER NOT NULL DEFAULT 0,
+    balance REAL NOT NULL DEFAULT 0,
+    proofs INTEGER NOT NULL DEFAULT 0,
+    verified INTEGER NOT NULL DEFAULT 0,
+    verified_amount REAL NOT NULL DEFAULT 0
+);
+CREATE TABLE ledger (
+    id INTEGER PRIMARY KEY,
+    ts INTEGER NOT NULL,
+    uid TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    amount REAL NOT NULL,
+    ref TEXT
+);
+CREATE TABLE withdrawals (
+    id INTEGER PRIMARY KEY,
+    ts INTEGER NOT NULL,
+    uid TEXT NOT NULL,
+    amount REAL NOT NULL,
+    method TEXT NOT NULL,
+    detail TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending'
+);
+"""
+
+def test_sqlite_rupees_become_paise(tmp_path):
+    db = sqlite3.connect(tmp_path / "bot.db")
+    db.executescript(RUPEE_SCHEMA)
+    db.executemany("INSERT INTO users VALUES (?, ?, ?, ?, ?)", [
+        ("1", "One", "one", 12.35 - 3.3, 2),
+        ("2", "Two", None, 0.1 + 0.2, 0),
+    ])
+    db.execute("INSERT INTO verified VALUES ('11111111', 1.1)")
+    # Counters that drifted: the upgrade recounts them
+    db.execute("INSERT INTO stats VALUES (1, 7, 99.99, 7, 7, 7.7)")
+    db.executemany("INSERT INTO ledger (ts, uid, kind, amount, ref) VALUES (?, ?, ?, ?, ?)", [
+        (100, "1", "admin_add", 12.35, None),
+        (101, "1", "withdraw", -3.3, "1"),
+        (102, "2", "admin_add", 0.1 + 0.2, None),
+    ])
+    db.execute("INSERT INTO withdrawals (ts, uid, amount, method, detail) VALUES (101, '1', 3.3, 'UPI', 'x@upi')")
+    db.commit()
+    db.close()
+
+    st = open_storage("sqlite", str(tmp_path))
+    try:
+        assert st.db.execute("PRAGMA user_version").fetchone()[0] == 1
+        assert st.get_user("1")["balance"] == 905
+        assert st.get_user("2")["balance"] == 30
+        assert st.totals() == (2, 935, 2, 1, 110)
+        assert [(w["uid"], w["amount"]) for w in st.pending_withdrawals()] == [("1", 330)]
+        assert history(st, "1") == [("withdraw", -330, "1"), ("admin_add", 1235, None)]
+        assert st.db.execute("SELECT typeof(balance) FROM users").fetchall() == [("integer",)] * 2
+        # Amounts from now on are paise too
+        st.consume_verified_id("11111111", "2")
+        assert st.get_user("2")["balance"] == 140
+    finally:
+        st.close()
+
+    # A second open leaves paise alone
+    st = open_storage("sqlite", str(tmp_path))
+    try:
+        assert st.get_user("1")["balance"] == 905
+        assert st.totals() == (2, 1045, 3, 0, 0)
+    finally:
+        st.close()
+
+def write_lines(path, records):
+    with open(path, "w") as f:
+        f.writelines(json.dumps(r) + "\n" for r in records)
+
+def test_json_snapshot_and_ledger_in_rupees(tmp_path):
+    data = str(tmp_path)
+    # A snapshot from before paise (users inline, no "money") at seq 3,
+    # and the ledger that wrote it plus three rupee records after it
+    snapshot = {
+        "seq": 3,
+        "stats": {"users": 1, "balance": 9.05, "proofs": 0, "verified": 1, "verified_amount": 1.1},
+        "users": {"1": {"name": "One", "username": "one", "balance": 12.35 - 3.3, "proofs": 0}},
+        "verified": {"11111111": 1.1},
+        "withdrawals": {"3": {
+            "id": 3, "uid": "1", "amount": 3.3, "method": "UPI", "detail": "x@upi", "ts": 102
+        }},
+    }
+    with open(f"{data}/snapshot.json", "w") as f:
+        json.dump(snapshot, f)
+    os.makedirs(f"{data}/ledger")
+    write_lines(f"{data}/ledger/000000000001.jsonl", [
+        {"s": 1, "ts": 100, "t": "user", "u": "1", "n": "One", "un": "one"},
+        {"s": 2, "ts": 101, "t": "admin_add", "u": "1", "a": 12.35},
+        {"s": 3, "ts": 102, "t": "withdraw", "u": "1", "a": -3.3, "m": "UPI", "d": "x@upi"},
+        {"s": 4, "ts": 103, "t": "admin_add", "u": "1", "a": 0.1},
+        {"s": 5, "ts": 104, "t": "vset", "p": [["22222222", 2.5]]},
+        {"s": 6, "ts": 105, "t": "proof", "u": "1", "a": 2.5, "v": "22222222"},
+    ])
+    expected = [
+        ("proof", 250, "22222222"),
+        ("admin_add", 10, None),
+        ("withdraw", -330, "3"),
+        ("admin_add", 1235, None),
+    ]
+
+    st = open_storage("json", data)
+    try:
+        assert st.converted
+        assert st.get_user("1")["balance"] == 1165
+        assert st.get_user("1")["proofs"] == 1
+        assert st.totals() == (1, 1165, 1, 1, 110)
+        assert [(w["id"], w["amount"]) for w in st.pending_withdrawals()] == [(3, 330)]
+        assert history(st, "1") == expected
+        st.adjust_balance("1", 500, ADMIN_ADD)
+        expected.insert(0, ("admin_add", 500, None))
+    finally:
+        st.close()
+
+    # Reopened: the rupee records before the conversion are not replayed
+    # again and the paise one after it is not converted
+    st = open_storage("json", data)
+    try:
+        assert not st.converted
+        assert st.get_user("1")["balance"] == 1665
+        assert st.totals() == (1, 1665, 1, 1, 110)
+        assert history(st, "1") == expected
+        asyncio.run(st.snapshot())
+    finally:
+        st.close()
+
+    st = open_storage("json", data)
+    try:
+        assert st.get_user("1")["balance"] == 1665
+        assert [(w["id"], w["amount"]) for w in st.pending_withdrawals()] == [(3, 330)]
+        assert history(st, "1") == expected
+    finally:
+        st.close()
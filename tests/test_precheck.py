@@ -0,0 +1,47 @@
+import validator
+from precheck import Precheck
+from storage import open_storage
+
+LINK = "https://t.me/SomeBot?start=123456789"
+
+def gate():
+    return Precheck(rate=10, burst=10, ttl=3600, retry_ttl=60)
+
+def claim(gate, st, uid, link):
+    """What proof_link does with a link: the gate, then storage."""
+    key, reason = gate.check(uid, link)
+    if reason is not None:
+        return reason
+    found = st.find_verified(validator.check(link).ids)
+    amount = st.consume_verified_id(found[0], uid) if found else None
+    gate.record(uid, key, amount is not None)
+    return "paid" if amount is not None else "rejected"
+
+def test_one_worker_turns_a_taken_link_away():
+    class Storage:
+        # Never reached: the gate answers
+        def find_verified(self, runs):
+            raise AssertionError("storage touched")
+
+    g = gate()
+    st = Storage()
+    key, reason = g.check("1", LINK)
+    g.record("1", key, True)
+    assert claim(g, st, "1", LINK) == "repeat"
+    assert claim(g, st, "2", "https://telegram.me/somebot/?start=123456789&utm_source=x") == "taken"
+
+def test_link_sent_to_two_workers_pays_once(tmp_path):
+    # Two workers on one data directory, each with its own gate
+    workers = [(gate(), open_storage("sqlite", str(tmp_path))) for _ in range(2)]
+    try:
+        st = workers[0][1]
+        for uid in ("1", "2"):
+            st.ensure_user(uid, f"U{uid}", None)
+        st.add_verified([("123456789", 500)])
+
+        results = [claim(g, st, uid, LINK) for (g, st), uid in zip(workers, ("1", "2"))]
+        assert results == ["paid", "rejected"]
+        assert [st.get_user(uid)["balance"] for uid in ("1", "2")] == [500, 0]
+    finally:
+        for _, st in workers:
+            st.close()
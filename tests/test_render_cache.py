@@ -0,0 +1,71 @@
+import pytest
+
+import bot
+import metrics
+from storage import open_storage, ADMIN_ADD
+
+def serve(kind, data, monkeypatch):
+    """A storage with a few users, behind a fresh render cache."""
+    st = open_storage(kind, data)
+    for i in range(5):
+        st.ensure_user(str(i), f"U{i}", None)
+    st.adjust_balance("1", 1000, ADMIN_ADD)
+    monkeypatch.setattr(bot, "storage", st)
+    monkeypatch.setattr(bot, "render_cache", bot.RenderCache(16))
+    monkeypatch.setattr(metrics, "counters", {})
+    return st
+
+@pytest.fixture(params=["json", "sqlite"])
+def st(request, tmp_path, monkeypatch):
+    st = serve(request.param, str(tmp_path), monkeypatch)
+    yield st
+    st.close()
+
+def show():
+    """Both panels, as the admin commands get them."""
+    bot.render_cache.get(("total_users",), "totals", bot.totals_panel)
+    bot.render_cache.get(("user_details", "new", 0, None, None), "users", lambda: bot.users_page("new", 0))
+
+def misses():
+    counts = metrics.counters.get("render_cache_total", {})
+    return {
+        dict(labels)["panel"]: n for labels, n in counts.items()
+        if dict(labels)["result"] == "miss"
+    }
+
+def test_panels_survive_unrelated_writes(st):
+    show()
+    assert misses() == {"total_users": 1, "user_details": 1}
+
+    st.set_blocked("2", True)
+    st.ensure_user("1", "U1", None)
+    show()
+    assert misses() == {"total_users": 1, "user_details": 1}
+
+    # The pages do not show the verified pool; the totals do
+    st.add_verified([("123456789", 500)])
+    show()
+    assert misses() == {"total_users": 2, "user_details": 1}
+
+    st.adjust_balance("3", 200, ADMIN_ADD)
+    show()
+    assert misses() == {"total_users": 3, "user_details": 2}
+    st.ensure_user("9", "U9", None)
+    show()
+    assert misses() == {"total_users": 4, "user_details": 3}
+
+def test_another_worker_invalidates(tmp_path, monkeypatch):
+    # Only sqlite is shared between workers
+    st = serve("sqlite", str(tmp_path), monkeypatch)
+    other = open_storage("sqlite", str(tmp_path))
+    try:
+        show()
+        other.set_blocked("2", True)
+        show()
+        assert misses() == {"total_users": 1, "user_details": 1}
+        other.adjust_balance("4", 300, ADMIN_ADD)
+        show()
+        assert misses() == {"total_users": 2, "user_details": 2}
+    finally:
+        other.close()
+        st.close()
@@ -0,0 +1,44 @@
+import asyncio
+import time
+from datetime import datetime
+
+from telegram import Chat, Message, Update, User
+
+from bot import PerUserUpdateProcessor
+
+def update_from(update_id, uid):
+    message = Message(
+        update_id, datetime.now(), Chat(uid, Chat.PRIVATE),
+        from_user=User(uid, f"U{uid}", False), text="hi"
+    )
+    return Update(update_id, message=message)
+
+def test_busy_user_holds_one_slot():
+    async def run():
+        processor = PerUserUpdateProcessor(4)
+        running = []
+        handled = []
+        done = {}
+
+        async def handle(uid, n):
+            running.append(uid)
+            # A user's updates never overlap
+            assert running.count(uid) == 1
+            await asyncio.sleep(0.05)
+            running.remove(uid)
+            handled.append((uid, n))
+            done[uid] = time.monotonic()
+
+        start = time.monotonic()
+        tasks = [
+            asyncio.create_task(processor.process_update(update_from(i, 1), handle(1, i)))
+            for i in range(20)
+        ]
+        tasks.append(asyncio.create_task(processor.process_update(update_from(20, 2), handle(2, 0))))
+        await asyncio.gather(*tasks)
+        return start, done, handled
+
+    start, done, handled = asyncio.run(run())
+    # User 2 is served in parallel with user 1's backlog, not after it
+    assert done[2] - start < 0.3
+    assert [n for uid, n in handled if uid == 1] == list(range(20))
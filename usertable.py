@@ -0,0 +1,216 @@
+import json
+import mmap
+import struct
+import hashlib
+from array import array
+from bisect import bisect_left
+
+# ================= USER TABLE =================
+# The JSON backend's users as of the last snapshot, in data/users-<seq>.dat.
+# The file is memory-mapped rather than parsed, so opening it costs the
+# same whatever the number of users, and a user is decoded only when the
+# bot first asks for them.
+#
+#   header    magic, byte-order mark, n (users), size of the names area
+#   names     one line per user in creation order: ["uid","name","username"]
+#   starts    n+1 offsets of those lines
+#   balance   n paise
+#   proofs    n
+#   hist      n x (segment, offset, size) of the newest history block
+#   keys      n uid hashes, sorted
+#   rows      n rows, in the order of keys
+#
+# Numbers are 64-bit in the machine's byte order. A user's row (their
+# position in creation order) never changes and names are never
+# rewritten, so a snapshot copies the previous table, patches the rows
+# that changed and appends the users created since.
+
+MAGIC = b"UTB1"
+BOM = 0x0102030405060708
+HEADER = struct.Struct("=4sQQQ")
+
+class User:
+    """
+    A user record. Reads like the dict it replaced (user["balance"],
+    user.get("name")) in a third of the memory. row is the user's
+    position in creation order.
+    """
+    __slots__ = ("balance", "proofs", "name", "username", "row")
+
+    def __init__(self, name, username, balance=0, proofs=0, row=None):
+        self.name = name
+        self.username = username
+        self.balance = balance
+        self.proofs = proofs
+        self.row = row
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+def uid_key(uid):
+    return int.from_bytes(hashlib.blake2b(uid.encode(), digest_size=8).digest(), "little")
+
+def name_line(uid, name, username):
+    # ensure_ascii keeps every line valid on its own, whatever the names
+    return (json.dumps([uid, name, username], separators=(",", ":")) + "\n").encode()
+
+def padding(size):
+    return b"\0" * (-size % 8)
+
+class UserTable:
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, bom, n, names_size = HEADER.unpack_from(self.mm)
+        if magic != MAGIC or bom != BOM:
+            self.mm.close()
+            raise ValueError(f"{path} is not a user table written on this machine")
+        self.n = n
+        self.view = memoryview(self.mm)
+        pos = HEADER.size
+        self.names_area = self.view[pos:pos + names_size]
+        pos += names_size + len(padding(names_size))
+        self.views = []
+        def column(fmt, count):
+            nonlocal pos
+            col = self.view[pos:pos + 8 * count].cast(fmt)
+            self.views.append(col)
+            pos += 8 * count
+            return col
+        self.starts = column("Q", n + 1)
+        self.balance = column("q", n)
+        self.proofs = column("q", n)
+        self.hist = column("q", 3 * n)
+        self.keys = column("Q", n)
+        self.rows = column("q", n)
+
+    def __len__(self):
+        return self.n
+
+    def close(self):
+        for col in self.views + [self.names_area, self.view]:
+            col.release()
+        self.mm.close()
+
+    def names(self, row):
+        """[uid, name, username] of a row."""
+        start = HEADER.size
+        return json.loads(self.mm[start + self.starts[row]:start + self.starts[row + 1]])
+
+    def columns(self):
+        """Lists of every row's uid, name, username, balance and proofs."""
+        if not self.n:
+            return [], [], [], [], []
+        # One parse of the whole names area instead of n small ones
+        area = self.mm[HEADER.size:HEADER.size + len(self.names_area) - 1]
+        rows = json.loads(b"[" + area.replace(b"\n", b",") + b"]")
+        return (
+            [r[0] for r in rows], [r[1] for r in rows], [r[2] for r in rows],
+            self.balance.tolist(), self.proofs.tolist()
+        )
+
+    def release(self):
+        """
+        Drop the pages read so far from the process's RSS after a full
+        scan; the file stays in the page cache and is read back on use.
+        """
+        if hasattr(mmap, "MADV_DONTNEED"):
+            self.mm.madvise(mmap.MADV_DONTNEED)
+
+    def records(self, chunk=8192):
+        """
+        [uid, name, username] of every row, parsed chunk rows at a time so
+        no one parse holds the GIL for long.
+        """
+        start = HEADER.size
+        for a in range(0, self.n, chunk):
+            b = min(a + chunk, self.n)
+            area = self.mm[start + self.starts[a]:start + self.starts[b] - 1]
+            yield from json.loads(b"[" + area.replace(b"\n", b",") + b"]")
+
+    def find(self, uid):
+        """Row of uid, or None."""
+        key = uid_key(uid)
+        i = bisect_left(self.keys, key)
+        while i < self.n and self.keys[i] == key:
+            row = self.rows[i]
+            if self.names(row)[0] == uid:
+                return row
+            i += 1
+        return None
+
+    def user(self, row):
+        _, name, username = self.names(row)
+        return User(name, username, self.balance[row], self.proofs[row], row)
+
+    def get(self, uid):
+        row = self.find(uid)
+        return None if row is None else self.user(row)
+
+    def head(self, row):
+        """Newest history block [segment, offset, size] of a row, or None."""
+        seg, offset, size = self.hist[3 * row:3 * row + 3]
+        return [seg, offset, size] if seg else None
+
+def build(base, added, values, heads):
+    """
+    The chunks of a new table: base (a UserTable or None) with values
+    ({row: (balance, proofs)}) and heads ({row: [segment, offset, size]})
+    patched in and added ([(uid, name, username, balance, proofs)], rows
+    len(base) onwards) appended. Unchanged parts of base are not copied
+    until they are written out.
+    """
+    n0 = len(base) if base is not None else 0
+    n = n0 + len(added)
+    names_size = len(base.names_area) if base is not None else 0
+    starts = array("Q")
+    balance = array("q")
+    proofs = array("q")
+    hist = array("q")
+    keys = array("Q")
+    rows = array("q")
+    if base is not None:
+        starts.frombytes(base.starts.cast("B"))
+        balance.frombytes(base.balance.cast("B"))
+        proofs.frombytes(base.proofs.cast("B"))
+        hist.frombytes(base.hist.cast("B"))
+    else:
+        starts.append(0)
+    for row, (b, p) in values.items():
+        balance[row] = b
+        proofs[row] = p
+    lines = []
+    for uid, name, username, b, p in added:
+        line = name_line(uid, name, username)
+        lines.append(line)
+        names_size += len(line)
+        starts.append(names_size)
+        balance.append(b)
+        proofs.append(p)
+    hist.frombytes(bytes(24 * len(added)))
+    for row, block in heads.items():
+        hist[3 * row:3 * row + 3] = array("q", block)
+    # Merge the new users' keys into the sorted base keys
+    pos = 0
+    for key, row in sorted((uid_key(a[0]), n0 + i) for i, a in enumerate(added)):
+        if base is not None:
+            i = bisect_left(base.keys, key, pos)
+            keys.frombytes(base.keys[pos:i].cast("B"))
+            rows.frombytes(base.rows[pos:i].cast("B"))
+            pos = i
+        keys.append(key)
+        rows.append(row)
+    if base is not None:
+        keys.frombytes(base.keys[pos:].cast("B"))
+        rows.frombytes(base.rows[pos:].cast("B"))
+    return [
+        HEADER.pack(MAGIC, BOM, n, names_size),
+        base.names_area if base is not None else b"",
+        b"".join(lines),
+        padding(names_size),
+        starts, balance, proofs, hist, keys, rows,
+    ]
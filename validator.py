@@ -0,0 +1,54 @@
+import re
+from collections import namedtuple
+
+# ================= LINK VALIDATOR =================
+# Decides whether a proof submission looks like a referral link, in one
+# match against a pattern compiled at import. The rules are the ones the
+# bot has always applied, tried in the same order; each alternative is a
+# named group, so the group that matched is the kind of link:
+#
+#   url      scheme:// or www. prefix
+#   code     8+ letters/digits
+#   email    name@domain.tld
+#   param    key=value
+#   ref      ref/CODE
+#   invite   invite/CODE
+#   path     CODE1/CODE2 (5+ each)
+#   domain   anything containing .com .in .org .net .co .io .me .app
+#
+# The digit runs of the link are returned with it: a verified ID is a
+# digit string, so it can only sit inside one of them (see find_verified).
+
+LINK_RE = re.compile(
+    r"(?P<url>(?:[a-z0-9]+://|www\.).*)"
+    r"|(?P<code>[a-z0-9]{8,})"
+    r"|(?P<email>[a-z0-9._%+-]+@[a-z0-9.-]+\.[a-z]{2,})"
+    r"|(?P<param>[a-z0-9]+=[a-z0-9]+)"
+    r"|(?P<ref>ref/[a-z0-9]+)"
+    r"|(?P<invite>invite/[a-z0-9]+)"
+    r"|(?P<path>[a-z0-9]{5,}/[a-z0-9]{5,})"
+    # ".co" also covers ".com"; ASCII-only case folding, as str.lower()
+    # never turns anything else into these letters
+    r"|(?P<domain>.*?\.(?a:co|in|org|net|io|me|app).*)",
+    re.IGNORECASE | re.DOTALL
+)
+DIGIT_RUN = re.compile(r"\d+")
+
+LinkCheck = namedtuple("LinkCheck", "kind ids reason")
+# Rejections carry nothing link-specific, so they are built once
+EMPTY = LinkCheck(None, (), "empty")
+BAD_FORMAT = LinkCheck(None, (), "format")
+
+def check(link):
+    """
+    LinkCheck(kind, ids, reason) for a submitted link. reason is None for
+    an acceptable link, else "empty" or "format" (and kind is None, ids
+    empty); ids are the link's digit runs, for storage.find_verified().
+    """
+    link = link.strip()
+    if not link:
+        return EMPTY
+    m = LINK_RE.fullmatch(link)
+    if m is None:
+        return BAD_FORMAT
+    return LinkCheck(m.lastgroup, DIGIT_RUN.findall(link), None)